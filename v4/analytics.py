@@ -0,0 +1,157 @@
+from datetime import date
+from typing import Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+
+from db_setup import engine
+from db_utils import phrase_lookup_keys, same_or_null_filter
+from models import Dynamics, DynamicsPoint, DynamicsRollup, SearchPhrase
+
+# все функции ниже работают с "широкой" таблицей: индекс — даты точек, колонки — фразы,
+# поэтому операции над тысячами фраз векторизованы и не проходят по строкам в python
+
+
+def load_series(
+    phrases: Optional[Sequence[str]] = None,
+    period: str = "weekly",
+    region_id: Optional[int] = None,
+    device: Optional[str] = None,
+    from_date: Optional[date] = None,
+    to_date: Optional[date] = None,
+    from_rollups: bool = False,
+    complete_only: bool = True,
+) -> pd.DataFrame:
+    # точки всех фраз одним запросом, в "длинном" виде: phrase, point_date, count, share;
+    # complete_only — для агрегатов: без неполных недель и месяцев (края ряда, пропуски)
+    if from_rollups:
+        return _load_rollup_series(phrases, period, region_id, device, from_date, to_date, complete_only)
+    query = (
+        select(
+            SearchPhrase.phrase,
+            DynamicsPoint.point_date,
+            DynamicsPoint.count,
+            DynamicsPoint.share,
+        )
+        .join(Dynamics, Dynamics.id == DynamicsPoint.dynamics_id)
+        .join(SearchPhrase, SearchPhrase.id == Dynamics.search_phrase_id)
+        .where(
+            Dynamics.period == period,
+            same_or_null_filter(Dynamics.region_id, region_id),
+            same_or_null_filter(Dynamics.device, device),
+        )
+        .order_by(Dynamics.id)
+    )
+    if phrases:
+        query = query.where(SearchPhrase.phrase.in_(phrase_lookup_keys(phrases)))
+    if from_date:
+        query = query.where(DynamicsPoint.point_date >= from_date)
+    if to_date:
+        query = query.where(DynamicsPoint.point_date <= to_date)
+
+    with engine.connect() as conn:
+        frame = pd.read_sql(query, conn, parse_dates=["point_date"])
+    # одна и та же дата могла прийти в нескольких выгрузках — беру самую свежую
+    return frame.drop_duplicates(["phrase", "point_date"], keep="last").reset_index(drop=True)
+
+
+def _load_rollup_series(
+    phrases: Optional[Sequence[str]],
+    period: str,
+    region_id: Optional[int],
+    device: Optional[str],
+    from_date: Optional[date],
+    to_date: Optional[date],
+    complete_only: bool,
+) -> pd.DataFrame:
+    # недели и месяцы, собранные из дневных рядов (см. rollups.py), без обхода сырых точек
+    query = (
+        select(
+            SearchPhrase.phrase,
+            DynamicsRollup.period_start.label("point_date"),
+            DynamicsRollup.count,
+            DynamicsRollup.share,
+            DynamicsRollup.days,
+        )
+        .join(SearchPhrase, SearchPhrase.id == DynamicsRollup.search_phrase_id)
+        .where(
+            DynamicsRollup.period == period,
+            same_or_null_filter(DynamicsRollup.region_id, region_id),
+            same_or_null_filter(DynamicsRollup.device, device),
+        )
+    )
+    if phrases:
+        query = query.where(SearchPhrase.phrase.in_(phrase_lookup_keys(phrases)))
+    if from_date:
+        query = query.where(DynamicsRollup.period_start >= from_date)
+    if to_date:
+        query = query.where(DynamicsRollup.period_start <= to_date)
+    with engine.connect() as conn:
+        frame = pd.read_sql(query, conn, parse_dates=["point_date"])
+    if period == "weekly":
+        period_days = pd.Series(7, index=frame.index)
+    else:
+        period_days = frame["point_date"].dt.days_in_month
+    frame["complete"] = frame["days"] >= period_days
+    if complete_only:
+        frame = frame[frame["complete"]].reset_index(drop=True)
+    return frame
+
+
+def to_matrix(series: pd.DataFrame, value: str = "count") -> pd.DataFrame:
+    matrix = series.pivot(index="point_date", columns="phrase", values=value).sort_index()
+    matrix.columns.name = None
+    return matrix
+
+
+def weekly_totals(counts: pd.DataFrame) -> pd.DataFrame:
+    # дневные точки сворачиваются в недели, начинающиеся с понедельника (как weekly в wordstat)
+    return counts.resample("W-MON", label="left", closed="left").sum(min_count=1)
+
+
+def week_over_week(counts: pd.DataFrame, daily: bool = False) -> pd.DataFrame:
+    # относительный прирост к предыдущей неделе; рост с нуля — NaN, а не inf
+    weekly = weekly_totals(counts) if daily else counts
+    growth = weekly.pct_change(fill_method=None)
+    return growth.replace([np.inf, -np.inf], np.nan)
+
+
+def rolling_mean(counts: pd.DataFrame, window: int = 4, min_periods: int = 1) -> pd.DataFrame:
+    return counts.rolling(window, min_periods=min_periods).mean()
+
+
+def seasonality_index(counts: pd.DataFrame, by: str = "month") -> pd.DataFrame:
+    # среднее по месяцу (или неделе года, дню недели) относительно среднего за весь ряд:
+    # 1.0 — обычный уровень, 1.3 — на 30% выше
+    keys = {
+        "month": counts.index.month,
+        "week": counts.index.isocalendar().week.to_numpy(),
+        "weekday": counts.index.weekday,
+    }
+    if by not in keys:
+        raise ValueError(f"неизвестная группировка сезонности: {by}")
+    overall = counts.mean().replace(0, np.nan)
+    index = counts.groupby(keys[by]).mean() / overall
+    index.index.name = by
+    return index
+
+
+def normalize_share(values: pd.DataFrame) -> pd.DataFrame:
+    # доля каждой фразы среди выбранных на каждую дату: строки суммируются в 1
+    totals = values.sum(axis=1).replace(0, np.nan)
+    return values.div(totals, axis=0)
+
+
+def top_movers(counts: pd.DataFrame, n: int = 10, periods: int = 1, by: str = "growth") -> pd.DataFrame:
+    # фразы с наибольшим изменением последней точки к точке periods назад;
+    # by="growth" — по относительному приросту, by="change" — по абсолютному
+    if len(counts) <= periods:
+        return pd.DataFrame(columns=["previous", "current", "change", "growth"])
+    previous = counts.iloc[-1 - periods]
+    current = counts.iloc[-1]
+    movers = pd.DataFrame({"previous": previous, "current": current})
+    movers["change"] = current - previous
+    movers["growth"] = (movers["change"] / previous.replace(0, np.nan)).replace([np.inf, -np.inf], np.nan)
+    ranked = movers.dropna(subset=[by])
+    return ranked.reindex(ranked[by].abs().sort_values(ascending=False).index).head(n)
@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from typing import List
+
+# бенчмарк работает на временной sqlite и локальном фейковом сервере, в настоящий api не ходит
+_tmp_dir = tempfile.mkdtemp(prefix="wordstat_bench_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp_dir, 'bench.db')}"
+os.environ.setdefault("YANDEX_WORDSTAT_TOKEN", "bench-token")
+
+from db_setup import get_session, init_db  # noqa: E402
+from fake_wordstat_server import FakeWordstatServer  # noqa: E402
+from metrics import BatchSummary  # noqa: E402
+from models import TopRequestItem  # noqa: E402
+from rate_limiter import RateLimiter  # noqa: E402
+from retry_policy import RetryPolicy  # noqa: E402
+from save_top_requests import save_top_requests  # noqa: E402
+from yandex_wordstat_connector_v4 import AsyncYandexWordstatConnector, YandexWordstatConnector  # noqa: E402
+
+TOKEN = "bench-token"
+
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def report(label: str, phrases: int, elapsed: float, latencies: List[float]) -> None:
+    print(
+        f"{label}: {phrases / elapsed:,.1f} фраз/с, "
+        f"p50={statistics.median(latencies) * 1000:.1f}ms, p99={_percentile(latencies, 0.99) * 1000:.1f}ms"
+    )
+
+
+def _connector_options(args) -> dict:
+    # лимит клиента не должен быть узким местом, если квоту не имитирует сервер
+    return dict(
+        rate_limiter=RateLimiter(rps=args.client_rps, burst=max(int(args.client_rps), 1)),
+        retry_policy=RetryPolicy(base_delay=0.05, max_delay=1.0),
+        regions_cache_path=None,
+    )
+
+
+def bench_sync(base_url: str, phrases: List[str], args) -> None:
+    latencies = []
+    with YandexWordstatConnector(TOKEN, base_url=base_url, **_connector_options(args)) as client:
+        started = time.perf_counter()
+        for phrase in phrases:
+            call_started = time.perf_counter()
+            client.get_top_requests(phrase)
+            latencies.append(time.perf_counter() - call_started)
+        elapsed = time.perf_counter() - started
+    report("sync", len(phrases), elapsed, latencies)
+
+
+def bench_async(base_url: str, phrases: List[str], args) -> None:
+    async def timed(client, phrase, latencies, slots):
+        # время считаю с момента, когда запрос реально уходит, а не с постановки в очередь
+        async with slots:
+            call_started = time.perf_counter()
+            await client.get_top_requests(phrase)
+            latencies.append(time.perf_counter() - call_started)
+
+    async def run():
+        latencies: List[float] = []
+        slots = asyncio.Semaphore(args.concurrency)
+        async with AsyncYandexWordstatConnector(
+            TOKEN, concurrency=args.concurrency, base_url=base_url, **_connector_options(args)
+        ) as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(timed(client, phrase, latencies, slots) for phrase in phrases))
+            return time.perf_counter() - started, latencies
+
+    elapsed, latencies = asyncio.run(run())
+    report(f"async (concurrency={args.concurrency})", len(phrases), elapsed, latencies)
+
+
+def bench_db(base_url: str, phrases: List[str], args) -> None:
+    # конвейер save_top_requests целиком: http через фейковый сервер + запись в sqlite
+    batch = BatchSummary()
+    with YandexWordstatConnector(TOKEN, base_url=base_url, **_connector_options(args)) as client:
+        started = time.perf_counter()
+        save_top_requests(phrases, regions=[213], connector=client, summary=batch)
+        elapsed = time.perf_counter() - started
+    with get_session() as session:
+        rows = session.query(TopRequestItem).count()
+    print(f"save_top_requests: {len(phrases) / elapsed:,.1f} фраз/с, {rows / elapsed:,.0f} строк/с в бд")
+    summary = batch.summary()
+    print(
+        f"  http {summary['http_seconds']:.2f} с, квота {summary['quota_wait_seconds']:.2f} с, "
+        f"бд {summary['db_seconds']:.2f} с; ошибок {summary['errors']:.0f}, повторов {summary['retries']:.0f}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="нагрузочный бенчмарк коннекторов на фейковом сервере wordstat")
+    parser.add_argument("--phrases", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа сервера, с")
+    parser.add_argument("--latency-jitter", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--quota-rps", type=float, help="квота сервера, сверх нее — 429")
+    parser.add_argument("--client-rps", type=float, default=10_000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+
+    init_db()
+    with FakeWordstatServer(
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+        quota_rps=args.quota_rps,
+        retry_after=1,
+    ) as server:
+        # у каждого прогона свои фразы, чтобы не мешали кэш и склейка повторов
+        bench_sync(server.base_url, [f"sync {i}" for i in range(args.phrases)], args)
+        bench_async(server.base_url, [f"async {i}" for i in range(args.phrases)], args)
+        bench_db(server.base_url, [f"db {i}" for i in range(args.phrases)], args)
+        print(f"ответы сервера: {dict(server.stats)}")
@@ -0,0 +1,133 @@
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# бенчмарк работает на временной sqlite и не ходит в api
+_tmp_dir = tempfile.mkdtemp(prefix="wordstat_bench_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp_dir, 'bench.db')}"
+
+from sqlalchemy import select, text  # noqa: E402
+
+from db_setup import engine, init_db  # noqa: E402
+from models import Base, Dynamics, DynamicsPoint, TopRequest  # noqa: E402
+
+PHRASES = 10_000
+POINTS_PER_SERIES = 500
+
+
+def fill(rows: int) -> None:
+    # генерирую строки прямо в sqlite рекурсивным cte — на порядки быстрее вставки из python
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "INSERT INTO search_phrases (id, phrase, created_at) "
+                "WITH RECURSIVE seq(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM seq LIMIT :n) "
+                "SELECT x, 'phrase ' || x, datetime('now') FROM seq"
+            ),
+            {"n": PHRASES},
+        )
+        conn.execute(
+            text(
+                "INSERT INTO top_requests (search_phrase_id, requested_at, region_id, device, total_count) "
+                "WITH RECURSIVE seq(x) AS (SELECT 0 UNION ALL SELECT x + 1 FROM seq LIMIT :n) "
+                "SELECT x % :phrases + 1, datetime('2020-01-01', '+' || (x / :phrases) || ' hours'), "
+                "CASE x % 3 WHEN 0 THEN 213 WHEN 1 THEN 2 ELSE NULL END, "
+                "CASE x % 2 WHEN 0 THEN 'phone' ELSE 'desktop' END, x FROM seq"
+            ),
+            {"n": rows, "phrases": PHRASES},
+        )
+        series = max(rows // POINTS_PER_SERIES, 1)
+        conn.execute(
+            text(
+                "INSERT INTO dynamics (id, search_phrase_id, requested_at, from_date, to_date, period, region_id, device) "
+                "WITH RECURSIVE seq(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM seq LIMIT :n) "
+                "SELECT x, x % :phrases + 1, datetime('now'), '2020-01-01', '2021-05-15', 'daily', 213, 'all' FROM seq"
+            ),
+            {"n": series, "phrases": PHRASES},
+        )
+        conn.execute(
+            text(
+                "INSERT INTO dynamics_points (dynamics_id, point_date, count, share) "
+                "WITH RECURSIVE seq(x) AS (SELECT 0 UNION ALL SELECT x + 1 FROM seq LIMIT :n) "
+                "SELECT x / :per_series + 1, date('2020-01-01', '+' || (x % :per_series) || ' days'), x % 1000, 0.001 "
+                "FROM seq"
+            ),
+            {"n": series * POINTS_PER_SERIES, "per_series": POINTS_PER_SERIES},
+        )
+    print(f"заполнено {rows:,} top_requests и {series * POINTS_PER_SERIES:,} dynamics_points за {time.perf_counter() - started:.1f}s")
+
+
+def dedup_query(conn, phrase_ids):
+    day = datetime(2020, 1, 2)
+    return conn.execute(
+        select(TopRequest.search_phrase_id).where(
+            TopRequest.search_phrase_id.in_(phrase_ids),
+            TopRequest.region_id == 213,
+            TopRequest.device == "phone",
+            TopRequest.requested_at >= day,
+            TopRequest.requested_at < day + timedelta(days=1),
+        )
+    ).all()
+
+
+def history_query(conn, phrase_id):
+    return conn.execute(
+        select(DynamicsPoint.point_date, DynamicsPoint.count)
+        .join(Dynamics, Dynamics.id == DynamicsPoint.dynamics_id)
+        .where(
+            Dynamics.search_phrase_id == phrase_id,
+            Dynamics.period == "daily",
+            DynamicsPoint.point_date >= datetime(2020, 3, 1).date(),
+            DynamicsPoint.point_date < datetime(2020, 6, 1).date(),
+        )
+        .order_by(DynamicsPoint.point_date)
+    ).all()
+
+
+def measure(label: str, repeats: int) -> None:
+    dedup, history = [], []
+    with engine.connect() as conn:
+        for i in range(repeats):
+            phrase_ids = [(i * 100 + j) % PHRASES + 1 for j in range(100)]
+            started = time.perf_counter()
+            dedup_query(conn, phrase_ids)
+            dedup.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            history_query(conn, i % PHRASES + 1)
+            history.append(time.perf_counter() - started)
+    print(
+        f"{label}: проверка дублей (100 фраз) p50={statistics.median(dedup) * 1000:.2f}ms, "
+        f"история фразы p50={statistics.median(history) * 1000:.2f}ms"
+    )
+
+
+def set_indexes(enabled: bool) -> None:
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if enabled:
+                    index.create(bind=conn, checkfirst=True)
+                else:
+                    index.drop(bind=conn, checkfirst=True)
+        conn.execute(text("ANALYZE"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="задержка проверки дублей и выборки истории с индексами и без")
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    init_db()
+    set_indexes(False)
+    fill(args.rows)
+    measure("без индексов", max(args.repeats // 4, 1))
+    started = time.perf_counter()
+    set_indexes(True)
+    print(f"индексы построены за {time.perf_counter() - started:.1f}s")
+    measure("с индексами", args.repeats)
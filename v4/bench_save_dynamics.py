@@ -0,0 +1,59 @@
+import argparse
+import os
+import tempfile
+import time
+from datetime import date, timedelta
+
+# бенчмарк работает на временной sqlite и не ходит в api
+_tmp_dir = tempfile.mkdtemp(prefix="wordstat_bench_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp_dir, 'bench.db')}"
+os.environ.setdefault("YANDEX_WORDSTAT_TOKEN", "bench-token")
+
+from db_setup import get_session, init_db  # noqa: E402
+from models import DynamicsPoint  # noqa: E402
+from save_dynamics import save_dynamics  # noqa: E402
+
+FROM_DATE = date(2022, 1, 1)
+
+
+class MockConnector:
+    # отдает дневную динамику заданной длины для каждой фразы
+    def __init__(self, points_per_phrase: int):
+        dates = [(FROM_DATE + timedelta(days=i)).isoformat() for i in range(points_per_phrase)]
+        self.series = [
+            {"date": d, "count": 100 + i, "share": 0.001 * (i % 10)} for i, d in enumerate(dates)
+        ]
+
+    def iter_dynamics(self, phrases, period, from_date, to_date=None, regions=None, devices=None, pause_seconds=None):
+        for phrase in phrases:
+            yield phrase, {"requestPhrase": phrase, "dynamics": self.series}
+
+
+def run(phrases_count: int, points_per_phrase: int) -> None:
+    init_db()
+    connector = MockConnector(points_per_phrase)
+    phrases = [f"bench phrase {i}" for i in range(phrases_count)]
+
+    started = time.perf_counter()
+    save_dynamics(
+        phrases,
+        period="daily",
+        from_date=FROM_DATE.isoformat(),
+        regions=[213],
+        devices=["all"],
+        connector=connector,
+    )
+    elapsed = time.perf_counter() - started
+
+    with get_session() as session:
+        stored = session.query(DynamicsPoint).count()
+    print(f"фраз: {phrases_count}, точек на фразу: {points_per_phrase}, сохранено точек: {stored}")
+    print(f"итого: {elapsed:.3f}s, {stored / elapsed:,.0f} точек/с")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="скорость записи DynamicsPoint через save_dynamics")
+    parser.add_argument("--phrases", type=int, default=100)
+    parser.add_argument("--points", type=int, default=1000)
+    args = parser.parse_args()
+    run(args.phrases, args.points)
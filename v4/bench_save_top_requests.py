@@ -0,0 +1,57 @@
+import argparse
+import os
+import tempfile
+import time
+
+# бенчмарк работает на временной sqlite и не ходит в api
+_tmp_dir = tempfile.mkdtemp(prefix="wordstat_bench_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp_dir, 'bench.db')}"
+os.environ.setdefault("YANDEX_WORDSTAT_TOKEN", "bench-token")
+
+from db_setup import init_db  # noqa: E402
+from save_top_requests import save_top_requests  # noqa: E402
+
+
+class MockConnector:
+    # имитирует iter_top_requests: фиксированная задержка на каждый вызов api
+    def __init__(self, items_per_phrase: int, latency: float):
+        self.items_per_phrase = items_per_phrase
+        self.latency = latency
+        self.calls = 0
+
+    def iter_top_requests(self, phrases, regions=None, devices=None, pause_seconds=None):
+        for phrase in phrases:
+            self.calls += 1
+            if self.latency:
+                time.sleep(self.latency)
+            yield phrase, {
+                "requestPhrase": phrase,
+                "totalCount": 1000,
+                "topRequests": [
+                    {"phrase": f"{phrase} {i}", "count": 1000 - i}
+                    for i in range(self.items_per_phrase)
+                ],
+            }
+
+
+def run(phrases_count: int, items_per_phrase: int, latency: float) -> None:
+    init_db()
+    connector = MockConnector(items_per_phrase, latency)
+    phrases = [f"bench phrase {i}" for i in range(phrases_count)]
+
+    started = time.perf_counter()
+    save_top_requests(phrases, regions=[213], devices=["phone"], connector=connector)
+    elapsed = time.perf_counter() - started
+
+    fetch_time = connector.calls * latency
+    print(f"фраз: {phrases_count}, элементов на фразу: {items_per_phrase}, задержка api: {latency}s")
+    print(f"итого: {elapsed:.3f}s, из них имитация api: {fetch_time:.3f}s, запись в бд: {elapsed - fetch_time:.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="end-to-end время save_top_requests с подменным коннектором")
+    parser.add_argument("--phrases", type=int, default=100)
+    parser.add_argument("--items", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    run(args.phrases, args.items, args.latency)
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, make_url, text
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
 import os
@@ -9,16 +9,101 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("Не найдена переменная окружения DATABASE_URL")
 
-engine = create_engine(DATABASE_URL, echo=False)
+# профили подключения, выбираются через DB_PROFILE (по умолчанию concurrent):
+# concurrent — несколько воркеров пишут и читают одновременно: WAL, busy_timeout, пул с pre_ping
+# bulk — одиночная массовая загрузка: на sqlite без fsync на каждый коммит (при сбое питания
+#        можно потерять последние транзакции, но не испортить базу)
+# plain — настройки sqlalchemy и базы по умолчанию, как было раньше
+SQLITE_PRAGMAS = {
+    "concurrent": {
+        "journal_mode": "WAL",  # читатели не блокируют писателя и наоборот
+        "synchronous": "NORMAL",  # в режиме WAL надежно, fsync только на checkpoint
+        "busy_timeout": 5000,  # ждать блокировку до 5 с вместо мгновенного "database is locked"
+        "cache_size": -64000,  # 64 МБ страничного кэша (отрицательное значение — в КБ)
+        "mmap_size": 268435456,  # 256 МБ чтения через mmap
+        "temp_store": "MEMORY",
+    },
+    "bulk": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "busy_timeout": 5000,
+        "cache_size": -256000,
+        "mmap_size": 1073741824,
+        "temp_store": "MEMORY",
+    },
+    "plain": {},
+}
+POSTGRES_POOL = {
+    "concurrent": {"pool_size": 10, "max_overflow": 20, "pool_timeout": 30, "pool_recycle": 1800, "pool_pre_ping": True},
+    "bulk": {"pool_size": 2, "max_overflow": 2, "pool_timeout": 30, "pool_recycle": 1800, "pool_pre_ping": True},
+    "plain": {},
+}
+DEFAULT_PROFILE = "concurrent"
+
+
+def engine_options(url, profile=None):
+    # параметры create_engine и PRAGMA для профиля; DB_POOL_SIZE / DB_MAX_OVERFLOW переопределяют пул
+    profile = profile or os.getenv("DB_PROFILE", DEFAULT_PROFILE)
+    if profile not in SQLITE_PRAGMAS:
+        raise ValueError(f"неизвестный профиль бд: {profile}, доступны: {', '.join(SQLITE_PRAGMAS)}")
+    backend = make_url(url).get_backend_name()
+    if backend == "sqlite":
+        return {}, dict(SQLITE_PRAGMAS[profile])
+    if backend != "postgresql":
+        return {}, {}
+    options = dict(POSTGRES_POOL[profile])
+    for option, variable in (("pool_size", "DB_POOL_SIZE"), ("max_overflow", "DB_MAX_OVERFLOW")):
+        if os.getenv(variable):
+            options[option] = int(os.getenv(variable))
+    return options, {}
+
+
+def create_db_engine(url, profile=None):
+    options, pragmas = engine_options(url, profile)
+    db_engine = create_engine(url, echo=False, **options)
+    if pragmas:
+        # PRAGMA действуют на соединение, поэтому выставляются на каждое новое соединение пула
+        @event.listens_for(db_engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
+
+    return db_engine
+
+
+engine = create_db_engine(DATABASE_URL)
 SessionLocal = sessionmaker(bind=engine)
 
 # импортирую Base из models.py, чтобы использовать правильный metadata
 from models import Base
+from phrase_search import create_search_index
 
 
 def init_db():
    
     Base.metadata.create_all(bind=engine)
+    migrate_db()
+
+
+def migrate_db():
+    # create_all не трогает уже существующие таблицы, поэтому старые базы догоняю здесь
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        # в ранних версиях колонка точки динамики называлась date
+        if inspector.has_table("dynamics_points"):
+            columns = {c["name"] for c in inspector.get_columns("dynamics_points")}
+            if "date" in columns and "point_date" not in columns:
+                conn.execute(text("ALTER TABLE dynamics_points RENAME COLUMN date TO point_date"))
+
+        # индексы из models.py, которых еще нет в базе
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+
+        # полнотекстовый индекс по фразам из топов (fts5 / pg_trgm), его нет в metadata
+        create_search_index(conn)
 
 
 def get_session():
@@ -28,4 +113,4 @@ def get_session():
 
 if __name__ == "__main__":
     init_db()
-    print("Таблицы созданы (если их не было).")
+    print("Таблицы и индексы созданы (если их не было).")
@@ -0,0 +1,229 @@
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import and_, bindparam, insert, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from models import SearchPhrase
+from rate_limiter import RateLimiter
+from response_cache import normalize_phrase
+from yandex_wordstat_connector_v4 import YandexWordstatConnector
+
+DEFAULT_CHUNK_SIZE = 1000  # строк на один executemany
+DEFAULT_COMMIT_CHUNK = 100  # фраз на одну транзакцию в save_*
+
+
+def chunked(rows: Sequence[Any], size: int) -> Iterator[Sequence[Any]]:
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def iter_chunks(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    # то же для потока неизвестной длины: в памяти не больше одной пачки
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def same_or_null_filter(column, value):
+    return (column == value) if value is not None else column.is_(None)
+
+
+def single_value(name: str, values: Optional[Sequence[Any]]) -> Any:
+    # в бд у выборки одно значение региона/устройства или NULL (без фильтра); сумму по нескольким
+    # значениям с NULL не отличить от запроса без фильтра, поэтому ее не сохраняю — разбивка через fanout
+    distinct = list(dict.fromkeys(values or []))
+    if len(distinct) > 1:
+        raise ValueError(
+            f"{name}: несколько значений ({distinct}) нельзя сохранить одной выборкой — "
+            f"запросите их по отдельности (fanout.save_*_matrix)"
+        )
+    return distinct[0] if distinct else None
+
+
+def dialect_name(session: Session) -> str:
+    return session.get_bind().dialect.name
+
+
+def insert_returning_ids(
+    session: Session,
+    model: Any,
+    rows: List[Dict[str, Any]],
+    key_columns: List[str],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Dict[Tuple[Any, ...], int]:
+    # bulk insert с возвратом id; id сопоставляются строкам по key_columns (уникальным в пределах пачки),
+    # т.к. sqlite не гарантирует порядок RETURNING для executemany
+    table = model.__table__
+    ids: Dict[Tuple[Any, ...], int] = {}
+    if session.get_bind().dialect.insert_executemany_returning:
+        stmt = insert(table).returning(table.c.id, *(table.c[name] for name in key_columns))
+        for chunk in chunked(rows, chunk_size):
+            for row_id, *key in session.execute(stmt, list(chunk)):
+                ids[tuple(key)] = row_id
+    else:
+        for row in rows:
+            result = session.execute(insert(table).values(row))
+            ids[tuple(row[name] for name in key_columns)] = result.inserted_primary_key[0]
+    return ids
+
+
+@contextmanager
+def connector_or_own(
+    connector: Optional[YandexWordstatConnector], token: str, rate_limiter: Optional[RateLimiter] = None
+) -> Iterator[YandexWordstatConnector]:
+    # переданный коннектор не закрывается, свой — закрывается по выходу
+    if connector is not None:
+        yield connector
+        return
+    with YandexWordstatConnector(token, rate_limiter=rate_limiter) as own_connector:
+        yield own_connector
+
+
+def phrase_lookup_keys(phrases: Iterable[str]) -> List[str]:
+    # новые фразы хранятся нормализованными (wordstat не различает регистр и пробелы, "Котики" и
+    # "котики" — одна строка search_phrases); исходное написание — для строк, сохраненных раньше
+    return list(dict.fromkeys(key for phrase in phrases for key in (normalize_phrase(phrase), phrase)))
+
+
+def match_phrase(found: Dict[str, Any], phrase: str) -> Any:
+    # значение, найденное по phrase_lookup_keys, для фразы в написании вызывающего
+    key = normalize_phrase(phrase)
+    return found[key] if key in found else found.get(phrase)
+
+
+def resolve_phrase_ids(
+    session: Session, phrases: List[str], created_at: datetime, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Dict[str, int]:
+    # id всех фраз одним IN-запросом на чанк, недостающие вставляются пачкой; ключи ответа —
+    # фразы в написании вызывающего, разные написания одной фразы получают один id
+    phrases = list(dict.fromkeys(phrases))
+    found: Dict[str, int] = {}
+
+    def load(values):
+        for chunk in chunked(values, chunk_size):
+            rows = session.execute(
+                select(SearchPhrase.phrase, SearchPhrase.id).where(SearchPhrase.phrase.in_(chunk))
+            )
+            found.update((phrase, phrase_id) for phrase, phrase_id in rows)
+
+    load(phrase_lookup_keys(phrases))
+    missing = list(
+        dict.fromkeys(normalize_phrase(phrase) for phrase in phrases if match_phrase(found, phrase) is None)
+    )
+    if missing:
+        upsert_rows(
+            session,
+            SearchPhrase,
+            [{"phrase": phrase, "created_at": created_at} for phrase in missing],
+            index_elements=["phrase"],
+        )
+        load(missing)
+    return {phrase: match_phrase(found, phrase) for phrase in phrases}
+
+
+def unique_by_id(phrases: Iterable[str], phrase_ids: Dict[str, int]) -> List[str]:
+    # из написаний одной фразы в пачке сохраняется первое: данные у них одни и те же
+    seen = set()
+    unique = []
+    for phrase in phrases:
+        if phrase_ids[phrase] not in seen:
+            seen.add(phrase_ids[phrase])
+            unique.append(phrase)
+    return unique
+
+
+def _dialect_insert(dialect: str):
+    if dialect == "sqlite":
+        return sqlite.insert
+    if dialect == "postgresql":
+        return postgresql.insert
+    return None
+
+
+def upsert_rows(
+    session: Session,
+    model: Any,
+    rows: List[Dict[str, Any]],
+    index_elements: List[str],
+    update_columns: Optional[List[str]] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> None:
+    # INSERT ... ON CONFLICT пачками; без update_columns существующие строки не трогаются
+    if not rows:
+        return
+    dialect_insert = _dialect_insert(dialect_name(session))
+    if dialect_insert is None:
+        _upsert_rows_generic(session, model, rows, index_elements, update_columns, chunk_size)
+        return
+
+    stmt = dialect_insert(model.__table__)
+    if update_columns:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column: stmt.excluded[column] for column in update_columns},
+        )
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=index_elements)
+    for chunk in chunked(rows, chunk_size):
+        session.execute(stmt, list(chunk))
+
+
+def _upsert_rows_generic(
+    session: Session,
+    model: Any,
+    rows: List[Dict[str, Any]],
+    index_elements: List[str],
+    update_columns: Optional[List[str]],
+    chunk_size: int,
+) -> None:
+    # для остальных диалектов: select существующих ключей, затем bulk insert и bulk update;
+    # составной ключ ищется через OR из AND — без tuple IN, который есть не во всех базах
+    table = model.__table__
+    columns = [table.c[name] for name in index_elements]
+
+    def row_key(row: Dict[str, Any]) -> tuple:
+        return tuple(row[name] for name in index_elements)
+
+    existing = set()
+    for chunk in chunked(rows, chunk_size):
+        keys = list(dict.fromkeys(row_key(row) for row in chunk))
+        if len(columns) == 1:
+            condition = columns[0].in_([key[0] for key in keys])
+        else:
+            condition = or_(*(and_(*(c == v for c, v in zip(columns, key))) for key in keys))
+        existing.update(tuple(found) for found in session.execute(select(*columns).where(condition)))
+
+    new_rows = []
+    for row in rows:
+        key = row_key(row)
+        # повтор ключа внутри rows вставляется один раз, как при ON CONFLICT DO NOTHING
+        if key not in existing:
+            existing.add(key)
+            new_rows.append(row)
+    for chunk in chunked(new_rows, chunk_size):
+        session.execute(insert(table), list(chunk))
+
+    if update_columns:
+        stmt = (
+            update(table)
+            .where(and_(*(table.c[name] == bindparam(f"_key_{name}") for name in index_elements)))
+            .values({column: bindparam(column) for column in update_columns})
+        )
+        inserted = {id(row) for row in new_rows}
+        changed = [
+            {
+                **{f"_key_{name}": row[name] for name in index_elements},
+                **{column: row[column] for column in update_columns},
+            }
+            for row in rows
+            if id(row) not in inserted
+        ]
+        for chunk in chunked(changed, chunk_size):
+            session.execute(stmt, list(chunk))
@@ -0,0 +1,236 @@
+import argparse
+import csv
+import gzip
+import os
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence
+
+from sqlalchemy import Select, select
+
+from db_setup import engine
+from db_utils import phrase_lookup_keys
+from models import Dynamics, DynamicsPoint, Region, SearchPhrase, TopRequest, TopRequestItem
+from logger import get_logger
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as pa_ipc
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow нужен только для parquet/arrow, csv работает без него
+    pa = pa_ipc = pq = None
+
+logger = get_logger(__name__)
+
+DEFAULT_BATCH_SIZE = 50_000  # строк на одну выборку с сервера и один record batch
+FORMATS = ("csv", "parquet", "arrow")
+
+
+class ExportFilters(NamedTuple):
+    from_date: Optional[date] = None
+    to_date: Optional[date] = None  # включительно
+    phrases: Optional[Sequence[str]] = None
+    regions: Optional[Sequence[int]] = None
+
+
+def top_requests_query(filters: ExportFilters) -> Select:
+    # одна строка — один элемент топа вместе с фразой, регионом и шапкой выборки
+    query = (
+        select(
+            SearchPhrase.phrase,
+            TopRequest.requested_at,
+            TopRequest.region_id,
+            Region.label.label("region_label"),
+            TopRequest.device,
+            TopRequest.total_count,
+            TopRequestItem.phrase.label("item_phrase"),
+            TopRequestItem.count.label("item_count"),
+        )
+        .join(TopRequest, TopRequest.id == TopRequestItem.top_request_id)
+        .join(SearchPhrase, SearchPhrase.id == TopRequest.search_phrase_id)
+        .outerjoin(Region, Region.id == TopRequest.region_id)
+        .order_by(TopRequestItem.id)
+    )
+    if filters.from_date:
+        query = query.where(TopRequest.requested_at >= filters.from_date)
+    if filters.to_date:
+        query = query.where(TopRequest.requested_at < filters.to_date + timedelta(days=1))
+    return _common_filters(query, TopRequest.region_id, filters)
+
+
+def dynamics_query(filters: ExportFilters) -> Select:
+    query = (
+        select(
+            SearchPhrase.phrase,
+            Dynamics.period,
+            Dynamics.region_id,
+            Region.label.label("region_label"),
+            Dynamics.device,
+            DynamicsPoint.point_date,
+            DynamicsPoint.count,
+            DynamicsPoint.share,
+            Dynamics.requested_at,
+        )
+        .join(Dynamics, Dynamics.id == DynamicsPoint.dynamics_id)
+        .join(SearchPhrase, SearchPhrase.id == Dynamics.search_phrase_id)
+        .outerjoin(Region, Region.id == Dynamics.region_id)
+        .order_by(DynamicsPoint.id)
+    )
+    if filters.from_date:
+        query = query.where(DynamicsPoint.point_date >= filters.from_date)
+    if filters.to_date:
+        query = query.where(DynamicsPoint.point_date <= filters.to_date)
+    return _common_filters(query, Dynamics.region_id, filters)
+
+
+def _common_filters(query: Select, region_column: Any, filters: ExportFilters) -> Select:
+    if filters.phrases:
+        query = query.where(SearchPhrase.phrase.in_(phrase_lookup_keys(filters.phrases)))
+    if filters.regions:
+        query = query.where(region_column.in_(list(filters.regions)))
+    return query
+
+
+def _arrow_schema(table: str) -> "pa.Schema":
+    if table == "top_requests":
+        return pa.schema(
+            [
+                ("phrase", pa.string()),
+                ("requested_at", pa.timestamp("us")),
+                ("region_id", pa.int64()),
+                ("region_label", pa.string()),
+                ("device", pa.string()),
+                ("total_count", pa.int64()),
+                ("item_phrase", pa.string()),
+                ("item_count", pa.int64()),
+            ]
+        )
+    return pa.schema(
+        [
+            ("phrase", pa.string()),
+            ("period", pa.string()),
+            ("region_id", pa.int64()),
+            ("region_label", pa.string()),
+            ("device", pa.string()),
+            ("point_date", pa.date32()),
+            ("count", pa.int64()),
+            ("share", pa.float64()),
+            ("requested_at", pa.timestamp("us")),
+        ]
+    )
+
+
+QUERIES: Dict[str, Callable[[ExportFilters], Select]] = {
+    "top_requests": top_requests_query,
+    "dynamics": dynamics_query,
+}
+
+
+def iter_batches(query: Select, batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[List[tuple]]:
+    # строки читаются серверным курсором (на postgresql) пачками по batch_size:
+    # в памяти не больше одной пачки, ORM-объекты не создаются
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+        for partition in result.partitions():
+            yield [tuple(row) for row in partition]
+
+
+def write_csv(path: str, columns: List[str], batches: Iterable[List[tuple]]) -> int:
+    opener = gzip.open if path.endswith(".gz") else open
+    rows = 0
+    with opener(path, "wt", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for batch in batches:
+            writer.writerows(batch)
+            rows += len(batch)
+    return rows
+
+
+def _record_batch(schema: "pa.Schema", batch: List[tuple]) -> "pa.RecordBatch":
+    columns = list(zip(*batch))
+    return pa.RecordBatch.from_arrays(
+        [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+        schema=schema,
+    )
+
+
+def write_parquet(path: str, schema: "pa.Schema", batches: Iterable[List[tuple]]) -> int:
+    rows = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for batch in batches:
+            writer.write_batch(_record_batch(schema, batch))
+            rows += len(batch)
+    return rows
+
+
+def write_arrow(path: str, schema: "pa.Schema", batches: Iterable[List[tuple]]) -> int:
+    rows = 0
+    with pa.OSFile(path, "wb") as sink, pa_ipc.new_file(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(_record_batch(schema, batch))
+            rows += len(batch)
+    return rows
+
+
+def _format_from_path(path: str) -> str:
+    name = path[:-3] if path.endswith(".gz") else path
+    extension = os.path.splitext(name)[1].lstrip(".").lower()
+    if extension in ("feather", "ipc"):
+        return "arrow"
+    return extension if extension in FORMATS else "csv"
+
+
+def export_table(
+    table: str,
+    path: str,
+    fmt: Optional[str] = None,
+    filters: ExportFilters = ExportFilters(),
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> int:
+    if table not in QUERIES:
+        raise ValueError(f"неизвестная таблица для выгрузки: {table}")
+    fmt = fmt or _format_from_path(path)
+    if fmt not in FORMATS:
+        raise ValueError(f"неизвестный формат: {fmt}")
+    if fmt != "csv" and pa is None:
+        raise RuntimeError("для выгрузки в parquet/arrow нужен pyarrow: pip install pyarrow")
+
+    query = QUERIES[table](filters)
+    batches = iter_batches(query, batch_size)
+    if fmt == "csv":
+        rows = write_csv(path, [column.name for column in query.selected_columns], batches)
+    elif fmt == "parquet":
+        rows = write_parquet(path, _arrow_schema(table), batches)
+    else:
+        rows = write_arrow(path, _arrow_schema(table), batches)
+    logger.info("выгружено %s строк %s в %s (%s)", rows, table, path, fmt)
+    return rows
+
+
+def _read_phrases(path: str) -> List[str]:
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="потоковая выгрузка статистики из базы")
+    parser.add_argument("table", choices=list(QUERIES))
+    parser.add_argument("output", help="файл выгрузки: .csv, .csv.gz, .parquet, .arrow")
+    parser.add_argument("--format", choices=FORMATS, help="по умолчанию — по расширению файла")
+    parser.add_argument("--from-date", type=date.fromisoformat)
+    parser.add_argument("--to-date", type=date.fromisoformat)
+    parser.add_argument("--phrase", action="append", dest="phrases", help="можно повторять")
+    parser.add_argument("--phrases-file", help="файл с фразами, по одной на строку")
+    parser.add_argument("--region", action="append", type=int, dest="regions", help="можно повторять")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    phrases = list(args.phrases or [])
+    if args.phrases_file:
+        phrases.extend(_read_phrases(args.phrases_file))
+    filters = ExportFilters(args.from_date, args.to_date, phrases or None, args.regions)
+    export_table(args.table, args.output, args.format, filters, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# локальная замена api wordstat для тестов и бенчмарков: те же эндпоинты и формат ответов,
+# что в postman-коллекции, данные детерминированы по тексту фразы
+
+REGIONS_TREE = [
+    {
+        "value": "225",
+        "label": "Россия",
+        "children": [
+            {
+                "value": "3",
+                "label": "Центральный федеральный округ",
+                "children": [
+                    {"value": "1", "label": "Москва и Московская область", "children": [
+                        {"value": "213", "label": "Москва", "children": None},
+                    ]},
+                ],
+            },
+            {
+                "value": "17",
+                "label": "Северо-Западный федеральный округ",
+                "children": [
+                    {"value": "10174", "label": "Санкт-Петербург и Ленинградская область", "children": [
+                        {"value": "2", "label": "Санкт-Петербург", "children": None},
+                    ]},
+                ],
+            },
+            {"value": "54", "label": "Екатеринбург", "children": None},
+        ],
+    }
+]
+CITIES = [213, 2, 54]
+PERIOD_STEP = {"daily": 1, "weekly": 7}
+
+
+def _rng(*parts: Any) -> random.Random:
+    seed = hashlib.md5(json.dumps(parts, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+    return random.Random(int(seed[:16], 16))
+
+
+def _period_dates(period: str, from_date: date, to_date: date) -> List[date]:
+    dates = []
+    current = from_date
+    while current <= to_date:
+        dates.append(current)
+        if period == "monthly":
+            current = (current.replace(day=28) + timedelta(days=4)).replace(day=1)
+        else:
+            current += timedelta(days=PERIOD_STEP.get(period, 1))
+    return dates
+
+
+def top_requests_response(body: Dict[str, Any], items: int = 50) -> Dict[str, Any]:
+    phrase = body["phrase"]
+    rng = _rng(phrase, body.get("regions"), body.get("devices"))
+    total = rng.randint(1_000, 1_000_000)
+    counts = sorted((rng.randint(1, total) for _ in range(items)), reverse=True)
+    return {
+        "requestPhrase": phrase,
+        "totalCount": total,
+        "topRequests": [{"phrase": f"{phrase} {i}", "count": count} for i, count in enumerate(counts)],
+        "associations": [{"phrase": f"{phrase} похожий {i}", "count": count // 3} for i, count in enumerate(counts[:5])],
+    }
+
+
+def dynamics_response(body: Dict[str, Any]) -> Dict[str, Any]:
+    phrase = body["phrase"]
+    from_date = date.fromisoformat(body["fromDate"])
+    to_date = date.fromisoformat(body["toDate"]) if body.get("toDate") else date.today()
+    rng = _rng(phrase, body.get("regions"), body.get("devices"), body.get("period"))
+    base = rng.randint(100, 100_000)
+    return {
+        "requestPhrase": phrase,
+        "dynamics": [
+            {
+                "date": d.isoformat(),
+                "count": int(base * (1 + 0.3 * _rng(phrase, d.isoformat()).random())),
+                "share": round(rng.random() / 1000, 8),
+            }
+            for d in _period_dates(body.get("period", "daily"), from_date, to_date)
+        ],
+    }
+
+
+def regions_response(body: Dict[str, Any]) -> Dict[str, Any]:
+    phrase = body["phrase"]
+    rng = _rng(phrase, body.get("regionType"), body.get("devices"))
+    return {
+        "requestPhrase": phrase,
+        "regions": [
+            {
+                "regionId": region_id,
+                "count": rng.randint(10, 100_000),
+                "share": round(rng.random() / 100, 8),
+                "affinityIndex": round(rng.uniform(20, 300), 2),
+            }
+            for region_id in CITIES
+        ],
+    }
+
+
+class FakeWordstatServer:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        error_rate: float = 0.0,
+        quota_rps: Optional[float] = None,
+        retry_after: int = 1,
+        token: Optional[str] = None,
+        items_per_phrase: int = 50,
+        seed: int = 0,
+    ):
+        # latency (+ равномерный jitter) — задержка каждого ответа; error_rate — доля ответов 503;
+        # quota_rps — больше запросов в секунду отклоняются с 429 и Retry-After;
+        # token — если задан, запросы с другим токеном получают 401
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.quota_rps = quota_rps
+        self.retry_after = retry_after
+        self.token = token
+        self.items_per_phrase = items_per_phrase
+        self.stats: Counter = Counter()
+        self._random = random.Random(seed)
+        self._recent: deque = deque()
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeWordstatServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def serve_forever(self) -> None:
+        # запуск в текущем потоке, для командной строки
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+
+    def __enter__(self) -> "FakeWordstatServer":
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.stop()
+
+    def _over_quota(self) -> bool:
+        # скользящее окно в одну секунду
+        if not self.quota_rps:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0] >= 1.0:
+                self._recent.popleft()
+            if len(self._recent) >= self.quota_rps:
+                return True
+            self._recent.append(now)
+            return False
+
+    def _fail_randomly(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def _delay(self) -> float:
+        with self._lock:
+            return self.latency + self._random.uniform(0, self.latency_jitter)
+
+    def respond(self, path: str, headers: Dict[str, str], raw_body: bytes) -> Tuple[int, Dict[str, str], Any]:
+        if self.token and headers.get("Authorization") != f"Bearer {self.token}":
+            return 401, {}, {"message": "Unauthorized"}
+        if self._over_quota():
+            return 429, {"Retry-After": str(self.retry_after)}, {"message": "Quota exceeded"}
+        delay = self._delay()
+        if delay:
+            time.sleep(delay)
+        if self._fail_randomly():
+            return 503, {}, {"message": "Service unavailable"}
+
+        try:
+            body = json.loads(raw_body or b"{}")
+        except ValueError:
+            return 400, {}, {"message": "Invalid JSON"}
+        if path == "/v1/getRegionsTree":
+            return 200, {}, REGIONS_TREE
+        if path not in ("/v1/topRequests", "/v1/dynamics", "/v1/regions"):
+            return 404, {}, {"message": "Not found"}
+        if not body.get("phrase"):
+            return 400, {}, {"message": "phrase is required"}
+        if path == "/v1/topRequests":
+            return 200, {}, top_requests_response(body, self.items_per_phrase)
+        if path == "/v1/regions":
+            return 200, {}, regions_response(body)
+        if not body.get("period") or not body.get("fromDate"):
+            return 400, {}, {"message": "period and fromDate are required"}
+        try:
+            return 200, {}, dynamics_response(body)
+        except ValueError as e:
+            return 400, {}, {"message": str(e)}
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего api
+            disable_nagle_algorithm = True  # заголовки и тело уходят разными write
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw_body = self.rfile.read(length) if length else b""
+                status, headers, payload = server.respond(self.path, dict(self.headers), raw_body)
+                with server._lock:
+                    server.stats[(self.path, status)] += 1
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="локальный фейковый сервер api wordstat")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--latency-jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--quota-rps", type=float)
+    parser.add_argument("--token")
+    args = parser.parse_args()
+
+    fake = FakeWordstatServer(
+        args.host,
+        args.port,
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+        quota_rps=args.quota_rps,
+        token=args.token,
+    )
+    logger.info("фейковый wordstat слушает %s", fake.base_url)
+    try:
+        fake.serve_forever()
+    except KeyboardInterrupt:
+        pass
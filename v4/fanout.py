@@ -0,0 +1,248 @@
+import asyncio
+import os
+from collections import defaultdict
+from itertools import product
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from sqlalchemy.orm import Session
+
+from db_setup import get_session
+from db_utils import DEFAULT_COMMIT_CHUNK
+from rate_limiter import RateLimiter
+from save_dynamics import persist_dynamics
+from save_top_requests import persist_top_requests
+from yandex_wordstat_connector_v4 import AsyncYandexWordstatConnector, DEFAULT_CONCURRENCY
+from logger import get_logger
+
+from dotenv import load_dotenv
+
+load_dotenv()
+TOKEN = os.getenv("YANDEX_WORDSTAT_TOKEN")
+
+logger = get_logger(__name__)
+
+
+class RequestCell(NamedTuple):
+    # ячейка матрицы запросов: фраза и фильтры, которые уходят в api (None — без фильтра)
+    phrase: str
+    regions: Optional[Tuple[int, ...]]
+    devices: Optional[Tuple[str, ...]]
+
+
+def _as_list(values: Optional[Sequence[Any]]) -> Optional[List[Any]]:
+    return list(values) if values else None
+
+
+def _axis(values: Optional[Iterable[Any]], split: bool) -> List[Optional[Tuple[Any, ...]]]:
+    values = list(dict.fromkeys(values or []))
+    if not values:
+        return [None]
+    if split:
+        return [(value,) for value in values]
+    # без разбивки — один комбинированный запрос, api сам суммирует по всем значениям
+    return [tuple(values)]
+
+
+def is_combined(cell: RequestCell) -> bool:
+    return any(values is not None and len(values) > 1 for values in (cell.regions, cell.devices))
+
+
+def _require_savable(
+    regions: Optional[List[int]], devices: Optional[List[str]], split_regions: bool, split_devices: bool
+) -> None:
+    # сумма по нескольким регионам/устройствам легла бы в бд с NULL и выглядела бы как запрос
+    # без фильтра (и мешала бы его дедупликации), поэтому такие ячейки не сохраняются;
+    # проверка до запросов, чтобы не тратить квоту
+    for name, values, split in (("regions", regions, split_regions), ("devices", devices, split_devices)):
+        if not split and len(set(values or [])) > 1:
+            raise ValueError(
+                f"{name}: комбинированный фильтр без разбивки нельзя сохранить в бд — "
+                f"включите split_{name} или используйте aiter_*_matrix без записи"
+            )
+
+
+def plan_requests(
+    phrases: Iterable[str],
+    regions: Optional[List[int]] = None,
+    devices: Optional[List[str]] = None,
+    split_regions: bool = True,
+    split_devices: bool = True,
+) -> Iterator[RequestCell]:
+    # раскладывает фразы × регионы × устройства на отдельные запросы; измерение без разбивки
+    # запрашивается одним вызовом (сумма по переданным значениям) — такие ячейки только для чтения
+    region_axis = _axis(regions, split_regions)
+    device_axis = _axis(devices, split_devices)
+    for phrase in dict.fromkeys(phrases):
+        for region_cell, device_cell in product(region_axis, device_axis):
+            yield RequestCell(phrase, region_cell, device_cell)
+
+
+def aiter_top_requests_matrix(
+    connector: AsyncYandexWordstatConnector, cells: Iterable[RequestCell]
+) -> AsyncIterator[Tuple[RequestCell, Dict[str, Any]]]:
+    return connector.aiter_requests(
+        cells,
+        lambda cell: connector.get_top_requests(
+            cell.phrase, regions=_as_list(cell.regions), devices=_as_list(cell.devices)
+        ),
+    )
+
+
+def aiter_dynamics_matrix(
+    connector: AsyncYandexWordstatConnector,
+    cells: Iterable[RequestCell],
+    period: str,
+    from_date: str,
+    to_date: Optional[str] = None,
+) -> AsyncIterator[Tuple[RequestCell, Dict[str, Any]]]:
+    return connector.aiter_requests(
+        cells,
+        lambda cell: connector.get_dynamics(
+            phrase=cell.phrase,
+            period=period,
+            from_date=from_date,
+            to_date=to_date,
+            regions=_as_list(cell.regions),
+            devices=_as_list(cell.devices),
+        ),
+    )
+
+
+Persist = Callable[[Session, List[str], Dict[str, Dict[str, Any]], Optional[List[int]], Optional[List[str]]], int]
+
+
+def persist_cells(
+    session: Session, chunk: List[Tuple[RequestCell, Dict[str, Any]]], persist: Persist
+) -> int:
+    # ячейки с одинаковыми фильтрами пишутся одной пачкой, у каждой — свои region_id/device
+    groups: Dict[Tuple[Any, Any], Dict[str, Dict[str, Any]]] = defaultdict(dict)
+    for cell, result in chunk:
+        if is_combined(cell):
+            raise ValueError(f"комбинированную ячейку нельзя сохранить в бд: {cell}")
+        groups[(cell.regions, cell.devices)][cell.phrase] = result
+    saved = 0
+    for (regions, devices), results in groups.items():
+        saved += persist(session, list(results), results, _as_list(regions), _as_list(devices))
+    return saved
+
+
+async def _save_stream(
+    stream: AsyncIterator[Tuple[RequestCell, Dict[str, Any]]],
+    persist: Persist,
+    chunk_size: int,
+) -> int:
+    processed = saved = 0
+    chunk: List[Tuple[RequestCell, Dict[str, Any]]] = []
+    with get_session() as session:
+        async for item in stream:
+            chunk.append(item)
+            if len(chunk) < chunk_size:
+                continue
+            saved += persist_cells(session, chunk, persist)
+            session.commit()
+            processed += len(chunk)
+            chunk = []
+            logger.info("пачка сохранена: обработано ячеек — %s", processed)
+        if chunk:
+            saved += persist_cells(session, chunk, persist)
+            session.commit()
+            processed += len(chunk)
+    logger.info("матрица обработана: ячеек — %s, сохранено — %s", processed, saved)
+    return saved
+
+
+def _run(
+    connector: Optional[AsyncYandexWordstatConnector],
+    concurrency: int,
+    rate_limiter: Optional[RateLimiter],
+    save: Callable[[AsyncYandexWordstatConnector], Awaitable[int]],
+) -> int:
+    async def main() -> int:
+        if connector is not None:
+            return await save(connector)
+        if not TOKEN:
+            raise RuntimeError("не найден токен YANDEX_WORDSTAT_TOKEN в .env")
+        async with AsyncYandexWordstatConnector(
+            TOKEN, concurrency=concurrency, rate_limiter=rate_limiter
+        ) as own_connector:
+            return await save(own_connector)
+
+    return asyncio.run(main())
+
+
+def save_top_requests_matrix(
+    phrases: Iterable[str],
+    regions: Optional[List[int]] = None,
+    devices: Optional[List[str]] = None,
+    split_regions: bool = True,
+    split_devices: bool = True,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    rate_limiter: Optional[RateLimiter] = None,
+    connector: Optional[AsyncYandexWordstatConnector] = None,
+    chunk_size: int = DEFAULT_COMMIT_CHUNK,
+) -> int:
+    # запросы матрицы идут параллельно (до concurrency в полете), темп держит общий rate_limiter
+    _require_savable(regions, devices, split_regions, split_devices)
+    cells = plan_requests(phrases, regions, devices, split_regions, split_devices)
+    return _run(
+        connector,
+        concurrency,
+        rate_limiter,
+        lambda client: _save_stream(
+            aiter_top_requests_matrix(client, cells), persist_top_requests, chunk_size
+        ),
+    )
+
+
+def save_dynamics_matrix(
+    phrases: Iterable[str],
+    period: str,
+    from_date: str,
+    to_date: Optional[str] = None,
+    regions: Optional[List[int]] = None,
+    devices: Optional[List[str]] = None,
+    split_regions: bool = True,
+    split_devices: bool = True,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    rate_limiter: Optional[RateLimiter] = None,
+    connector: Optional[AsyncYandexWordstatConnector] = None,
+    chunk_size: int = DEFAULT_COMMIT_CHUNK,
+) -> int:
+    _require_savable(regions, devices, split_regions, split_devices)
+    cells = plan_requests(phrases, regions, devices, split_regions, split_devices)
+
+    def persist(session, phrases_, results, regions_, devices_):
+        return persist_dynamics(
+            session, phrases_, results, period, from_date, to_date, regions_, devices_
+        )
+
+    return _run(
+        connector,
+        concurrency,
+        rate_limiter,
+        lambda client: _save_stream(
+            aiter_dynamics_matrix(client, cells, period, from_date, to_date), persist, chunk_size
+        ),
+    )
+
+
+if __name__ == "__main__":
+    # пример запуска: топы по каждому региону и устройству отдельно
+    save_top_requests_matrix(
+        ["купить телефон", "пицца москва"],
+        regions=[213, 2],
+        devices=["phone", "tablet"],
+    )
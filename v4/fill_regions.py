@@ -1,4 +1,10 @@
+from typing import Any, Dict, List, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
 from db_setup import get_session
+from db_utils import upsert_rows
 from models import Region
 from yandex_wordstat_connector_v4 import YandexWordstatConnector
 from logger import get_logger
@@ -15,32 +21,49 @@ if not TOKEN:
 
 logger = get_logger(__name__)
 
+def sync_regions(session: Session, regions_data: List[Dict[str, Any]]) -> Tuple[int, int]:
+    # один select по всей таблице, дальше пишутся только новые и изменившиеся регионы
+    existing = dict(session.execute(select(Region.id, Region.label)).all())
+    incoming = {int(region["value"]): region["label"] for region in regions_data}
+
+    new_rows = [
+        {"id": region_id, "label": label}
+        for region_id, label in incoming.items()
+        if region_id not in existing
+    ]
+    changed_rows = [
+        {"id": region_id, "label": label}
+        for region_id, label in incoming.items()
+        if region_id in existing and existing[region_id] != label
+    ]
+    upsert_rows(
+        session,
+        Region,
+        new_rows + changed_rows,
+        index_elements=["id"],
+        update_columns=["label"],
+    )
+    return len(new_rows), len(changed_rows)
+
+
 def fill_regions():
     connector = YandexWordstatConnector(token=TOKEN)
 
     try:
         regions_data = connector.get_regions()
-        logger.info(f"получено {len(regions_data)} регионов")
+        logger.info("получено %s регионов", len(regions_data))
 
         with get_session() as session:
-            added = 0
-            for region in regions_data:
-                region_id = int(region["value"])
-                label = region["label"]
-
-                # есть ли уже такой регион в БД
-                exists = session.query(Region).filter_by(id=region_id).first()
-                if not exists:
-                    session.add(Region(id=region_id, label=label))
-                    added += 1
-
+            added, updated = sync_regions(session, regions_data)
             session.commit()
-            logger.info(f"добавлено {added} новых регионов в базу данных")
+            logger.info("добавлено %s новых регионов, обновлено названий: %s", added, updated)
 
     except IntegrityError as e:
-        logger.error(f"ошибка целостности при добавлении регионов: {e}")
+        logger.error("ошибка целостности при добавлении регионов: %s", e)
     except Exception as e:
-        logger.error(f"произошла ошибка при загрузке регионов: {e}")
+        logger.error("произошла ошибка при загрузке регионов: %s", e)
+    finally:
+        connector.close()
 
 if __name__ == "__main__":
     fill_regions()
@@ -1,22 +1,160 @@
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
 
+# настройка из окружения (или явно через configure_logging):
+# LOG_FORMAT=text|json — строки для человека или одна json-запись на строку
+# LOG_ASYNC=1 — запись через QueueHandler/QueueListener: вывод и форматирование в отдельном потоке
+# LOG_LEVEL=INFO — уровень по умолчанию
+# LOG_LEVELS=yandex_wordstat_connector_v4=WARNING,save_top_requests=INFO — уровни по модулям
+# LOG_SAMPLING=yandex_wordstat_connector_v4=0.01 — какая доля INFO/DEBUG модуля пишется,
+# WARNING и выше пишутся всегда
 
-def setup_logger(name=None, level=logging.INFO):
-    logger = logging.getLogger(name)
-    logger.setLevel(level)
-    if logger.handlers:
-        return logger
-    formatter = logging.Formatter(
-        fmt="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# стандартные атрибуты LogRecord; все остальное пришло через extra= и попадает в json отдельными полями
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+_settings = {}
+_loggers = {}
+_handler = None
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": f"{self.formatTime(record, DATE_FORMAT)}.{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # из очереди запись приходит с уже отформатированным исключением
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    # стоит на самом логгере, поэтому отброшенная запись не форматируется и не попадает в очередь
+    def __init__(self, rate, seed=None):
+        super().__init__()
+        self.rate = rate
+        self._random = random.Random(seed)
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self._random.random() < self.rate
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # в вызывающем потоке подставляются только аргументы сообщения (как в стандартном prepare(),
+    # пока они не изменились); дата, уровень, json и вывод — в потоке QueueListener
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+def _parse_mapping(value):
+    mapping = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            name, setting = item.split("=", 1)
+            mapping[name.strip()] = setting.strip()
+    return mapping
+
+
+def _module_setting(mapping, name):
+    # настройка модуля или ближайшего родителя: для "a.b" сначала "a.b", потом "a"
+    while name:
+        if name in mapping:
+            return mapping[name]
+        name = name.rpartition(".")[0]
+    return None
+
+
+def stop_logging():
+    # дописывает очередь и останавливает поток записи; регистрируется в atexit
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def configure_logging(fmt=None, use_queue=None, level=None, levels=None, sampling=None, stream=None):
+    # явные аргументы важнее переменных окружения; уже созданные логгеры перенастраиваются
+    global _handler, _listener
+    _settings.update(
+        fmt=fmt or os.getenv("LOG_FORMAT", "text"),
+        use_queue=use_queue if use_queue is not None else os.getenv("LOG_ASYNC", "") in ("1", "true", "yes"),
+        level=level or os.getenv("LOG_LEVEL", "INFO"),
+        levels=levels if levels is not None else _parse_mapping(os.getenv("LOG_LEVELS")),
+        sampling={
+            name: float(rate)
+            for name, rate in (sampling if sampling is not None else _parse_mapping(os.getenv("LOG_SAMPLING"))).items()
+        },
     )
-    handler = logging.StreamHandler()
-    handler.setLevel(logging.INFO)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    stop_logging()
+    old_handler = _handler
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    if _settings["fmt"] == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter(fmt=TEXT_FORMAT, datefmt=DATE_FORMAT))
+    if _settings["use_queue"]:
+        log_queue = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+        _listener.start()
+        _handler = DeferredQueueHandler(log_queue)
+    else:
+        _handler = output
+
+    for logger, level in _loggers.values():
+        if old_handler is not None:
+            logger.removeHandler(old_handler)
+        _apply(logger, level)
 
+
+def _apply(logger, level=None):
+    logger.setLevel(level or _module_setting(_settings["levels"], logger.name) or _settings["level"])
+    for old_filter in [f for f in logger.filters if isinstance(f, SamplingFilter)]:
+        logger.removeFilter(old_filter)
+    rate = _module_setting(_settings["sampling"], logger.name)
+    if rate is not None and rate < 1:
+        logger.addFilter(SamplingFilter(rate))
+    logger.addHandler(_handler)
+
+
+def setup_logger(name=None, level=None):
+    logger = logging.getLogger(name)
+    if name in _loggers:
+        return logger
+    if not _settings:
+        configure_logging()
+    _loggers[name] = (logger, level)
+    _apply(logger, level)
     return logger
 
 
 def get_logger(name=None):
     return setup_logger(name)
+
+
+atexit.register(stop_logging)
@@ -11,18 +11,18 @@ if __name__ == "__main__":
     client = YandexWordstatConnector(token=TOKEN)
 
     valid_regions = client.get_regions()
-    logger.info(f"Первые 10 регионов{valid_regions[:10]}")
+    logger.info("Первые 10 регионов%s", valid_regions[:10])
 
     # пример использования
     raw_input = "купить телефон, пицца москва\nманикюр на дому"
     phrases = client.phrases_to_list(raw_input)
-    logger.info(f"Введенные фразы: {phrases}")
+    logger.info("Введенные фразы: %s", phrases)
 
     # пример запроса топов
     result1 = client.get_top_requests_batch(
         phrases=phrases, regions=[213], devices=["phone"]
     )
-    logger.info(f"Результат выполнения запросов топов: {result1}")
+    logger.info("Результат выполнения запросов топов: %s", result1)
 
     # пример запроса динамики
     result2 = client.get_dynamics_batch(
@@ -32,6 +32,6 @@ if __name__ == "__main__":
         regions=[2],
         devices=["desktop"],
     )
-    logger.info(f"Результат выполнения запросов динамики: {result2}")
+    logger.info("Результат выполнения запросов динамики: %s", result2)
 
     pass
@@ -0,0 +1,302 @@
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# секунды: от быстрых ответов из локальной сети до медленных ответов api под нагрузкой
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+@dataclass
+class RequestEvent:
+    # одно событие коннектора: http-попытка, ответ из кэша или ожидание чужого запроса в полете
+    endpoint: str
+    method: str = "POST"
+    status: Optional[int] = None  # None — сетевая ошибка или ответ без http
+    latency: float = 0.0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    attempt: int = 0  # 0 — первая попытка, дальше — повторы
+    quota_wait: float = 0.0  # сколько ждали rate_limiter перед попыткой
+    cache_hit: bool = False
+    coalesced: bool = False
+    error: Optional[str] = None
+
+
+def _format_labels(labelnames: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: object) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: object) -> float:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        return self._values.get(key, 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # по ключу меток: счетчики по корзинам (без накопления), сумма и количество
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: object) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    labels = _format_labels(self.labelnames, key, f'le="{le}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {total:g}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self) -> str:
+        # текстовый формат prometheus (text/plain; version=0.0.4)
+        lines: List[str] = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str) -> None:
+        # для textfile collector node_exporter: файл подменяется атомарно
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics_", suffix=".prom")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def start_http_server(self, port: int = 9108, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                data = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info("метрики доступны на http://%s:%s/metrics", host, server.server_address[1])
+        return server
+
+
+DEFAULT_REGISTRY = MetricsRegistry()
+
+
+class PrometheusHook:
+    # хук коннектора: раскладывает события по счетчикам и гистограммам реестра
+    def __init__(self, registry: MetricsRegistry = DEFAULT_REGISTRY):
+        self.requests = registry.counter(
+            "wordstat_requests_total", "HTTP-попытки к API по эндпоинту и статусу", ("endpoint", "status")
+        )
+        self.latency = registry.histogram(
+            "wordstat_request_duration_seconds", "Время HTTP-попытки к API", ("endpoint",)
+        )
+        self.quota_wait = registry.histogram(
+            "wordstat_quota_wait_seconds", "Ожидание rate_limiter перед попыткой", ("endpoint",)
+        )
+        self.bytes_received = registry.counter(
+            "wordstat_response_bytes_total", "Размер ответов API", ("endpoint",)
+        )
+        self.retries = registry.counter("wordstat_retries_total", "Повторные попытки", ("endpoint",))
+        self.cache_hits = registry.counter("wordstat_cache_hits_total", "Ответы из кэша", ("endpoint",))
+        self.coalesced = registry.counter(
+            "wordstat_coalesced_total", "Запросы, дождавшиеся такого же запроса в полете", ("endpoint",)
+        )
+
+    def __call__(self, event: RequestEvent) -> None:
+        if event.cache_hit:
+            self.cache_hits.inc(endpoint=event.endpoint)
+            return
+        if event.coalesced:
+            self.coalesced.inc(endpoint=event.endpoint)
+            return
+        self.requests.inc(endpoint=event.endpoint, status=event.status or "error")
+        self.latency.observe(event.latency, endpoint=event.endpoint)
+        self.quota_wait.observe(event.quota_wait, endpoint=event.endpoint)
+        self.bytes_received.inc(event.bytes_received, endpoint=event.endpoint)
+        if event.attempt:
+            self.retries.inc(endpoint=event.endpoint)
+
+
+class BatchSummary:
+    # хук-накопитель для одного батча: в конце summary() показывает, во что упирались —
+    # в задержку api (latency), в квоту (quota_wait, 429) или в запись в бд (db_seconds)
+    def __init__(self):
+        self.events: List[RequestEvent] = []
+        self.db_seconds = 0.0
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, event: RequestEvent) -> None:
+        with self._lock:
+            self.events.append(event)
+
+    def add_db_time(self, seconds: float) -> None:
+        with self._lock:
+            self.db_seconds += seconds
+
+    def summary(self) -> Dict[str, float]:
+        with self._lock:
+            http = [e for e in self.events if not e.cache_hit and not e.coalesced]
+            latencies = sorted(e.latency for e in http)
+
+        def percentile(q: float) -> float:
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0.0
+
+        return {
+            "wall_seconds": time.perf_counter() - self.started,
+            "http_requests": len(http),
+            "errors": sum(1 for e in http if e.status != 200),
+            "quota_errors": sum(1 for e in http if e.status == 429),
+            "retries": sum(1 for e in http if e.attempt),
+            "cache_hits": sum(1 for e in self.events if e.cache_hit),
+            "coalesced": sum(1 for e in self.events if e.coalesced),
+            "bytes_received": sum(e.bytes_received for e in http),
+            "latency_p50": percentile(0.5),
+            "latency_p99": percentile(0.99),
+            "http_seconds": sum(latencies),
+            "quota_wait_seconds": sum(e.quota_wait for e in http),
+            "db_seconds": self.db_seconds,
+        }
+
+
+@contextmanager
+def attached_hooks(
+    connector: Any,
+    hooks: Optional[Iterable[Callable[[RequestEvent], None]]] = None,
+    summary: Optional[BatchSummary] = None,
+) -> Iterator[None]:
+    # хуки (и сводка как хук) висят на коннекторе только на время одного запуска конвейера
+    added = list(hooks or []) + ([summary] if summary is not None else [])
+    if not added:
+        yield
+        return
+    connector.hooks.extend(added)
+    try:
+        yield
+    finally:
+        for hook in added:
+            connector.hooks.remove(hook)
+
+
+def log_batch(
+    log, processed: int, fetch_seconds: float, db_seconds: float, summary: Optional[BatchSummary] = None
+) -> None:
+    # время пачки делится на загрузку из api и запись в бд — видно, что из них узкое место
+    if summary is not None:
+        summary.add_db_time(db_seconds)
+    log.info(
+        "пачка сохранена: обработано фраз — %s (api %.2f с, бд %.2f с)", processed, fetch_seconds, db_seconds
+    )
+
+
+def log_summary(log, summary: Optional[BatchSummary]) -> None:
+    if summary is None:
+        return
+    stats = summary.summary()
+    log.info(
+        "сводка запуска: %.2f с, http-попыток %d (%.2f с, p50 %.3f с, p99 %.3f с), ожидание квоты %.2f с, "
+        "429 — %d, повторов %d, из кэша %d, запись в бд %.2f с",
+        stats["wall_seconds"],
+        stats["http_requests"],
+        stats["http_seconds"],
+        stats["latency_p50"],
+        stats["latency_p99"],
+        stats["quota_wait_seconds"],
+        stats["quota_errors"],
+        stats["retries"],
+        stats["cache_hits"],
+        stats["db_seconds"],
+    )
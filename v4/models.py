@@ -1,6 +1,6 @@
 from datetime import datetime, date
 from typing import Optional, List
-from sqlalchemy import Integer, String, Text, DateTime, Date, Float, ForeignKey
+from sqlalchemy import Integer, String, Text, DateTime, Date, Float, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column
 
 
@@ -37,6 +37,10 @@ class Region(Base):
 
 class TopRequest(Base):
     __tablename__ = "top_requests"
+    __table_args__ = (
+        # проверка "уже сохраняли сегодня" в save_top_requests
+        Index("ix_top_requests_dedup", "search_phrase_id", "region_id", "device", "requested_at"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     search_phrase_id: Mapped[int] = mapped_column(ForeignKey("search_phrases.id"), nullable=False)
@@ -55,6 +59,7 @@ class TopRequest(Base):
 
 class TopRequestItem(Base):
     __tablename__ = "top_request_items"
+    __table_args__ = (Index("ix_top_request_items_top_request_id", "top_request_id"),)
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     top_request_id: Mapped[int] = mapped_column(ForeignKey("top_requests.id"), nullable=False)
@@ -69,6 +74,10 @@ class TopRequestItem(Base):
 
 class Dynamics(Base):
     __tablename__ = "dynamics"
+    __table_args__ = (
+        # поиск рядов фразы по периоду/региону/устройству
+        Index("ix_dynamics_series", "search_phrase_id", "period", "region_id", "device"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     search_phrase_id: Mapped[int] = mapped_column(ForeignKey("search_phrases.id"), nullable=False)
@@ -89,6 +98,10 @@ class Dynamics(Base):
 
 class DynamicsPoint(Base):
     __tablename__ = "dynamics_points"
+    __table_args__ = (
+        # join с dynamics, выборка истории по диапазону дат и слияние точек при дозагрузке
+        Index("uq_dynamics_points_dynamics_date", "dynamics_id", "point_date", unique=True),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     dynamics_id: Mapped[int] = mapped_column(ForeignKey("dynamics.id"), nullable=False)
@@ -99,4 +112,52 @@ class DynamicsPoint(Base):
     dynamics: Mapped["Dynamics"] = relationship(back_populates="points")
 
     def __repr__(self):
-        return f"<DynamicsPoint(date={self.date}, count={self.count}, share={self.share})>"
+        return f"<DynamicsPoint(date={self.point_date}, count={self.count}, share={self.share})>"
+
+
+class DynamicsRollup(Base):
+    # недельные и месячные агрегаты дневной динамики, пересчитываются при записи дневных точек
+    __tablename__ = "dynamics_rollups"
+    __table_args__ = (
+        Index("ix_dynamics_rollups_series", "search_phrase_id", "period", "region_id", "device", "period_start"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    search_phrase_id: Mapped[int] = mapped_column(ForeignKey("search_phrases.id"), nullable=False)
+    period: Mapped[str] = mapped_column(String, nullable=False)  # weekly / monthly
+    region_id: Mapped[Optional[int]] = mapped_column(ForeignKey("regions.id"), nullable=True)
+    device: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    period_start: Mapped[date] = mapped_column(Date, nullable=False)
+    count: Mapped[int] = mapped_column(Integer, nullable=False)
+    share: Mapped[float] = mapped_column(Float, nullable=False)
+    days: Mapped[int] = mapped_column(Integer, nullable=False)  # сколько дневных точек попало в период
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<DynamicsRollup(period={self.period}, start={self.period_start}, count={self.count})>"
+
+
+class FetchTask(Base):
+    # очередь заданий на загрузку: одна строка — одна фраза с параметрами запроса
+    __tablename__ = "fetch_tasks"
+    __table_args__ = (
+        UniqueConstraint("endpoint", "phrase", "params", name="uq_fetch_tasks_request"),
+        Index("ix_fetch_tasks_status", "status", "id"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    endpoint: Mapped[str] = mapped_column(String, nullable=False)
+    phrase: Mapped[str] = mapped_column(Text, nullable=False)
+    params: Mapped[str] = mapped_column(Text, nullable=False)  # json с параметрами запроса
+    status: Mapped[str] = mapped_column(String, nullable=False, default="pending")
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    worker_id: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    claim_token: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    claimed_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    next_attempt_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)  # раньше не забирается
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<FetchTask(id={self.id}, endpoint={self.endpoint}, phrase='{self.phrase}', status={self.status})>"
@@ -0,0 +1,148 @@
+from typing import Dict, List, NamedTuple
+
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from db_utils import DEFAULT_CHUNK_SIZE, chunked, dialect_name, iter_chunks
+from models import TopRequestItem
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# на sqlite — отдельная таблица fts5 с триграммным токенайзером (поиск подстрок от 3 символов),
+# на postgresql — gin-индексы pg_trgm и tsvector('russian') прямо по top_request_items
+FTS_TABLE = "top_request_items_fts"
+MIN_TRIGRAM = 3
+
+_PG_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_top_request_items_phrase_trgm ON top_request_items "
+    "USING gin ((replace(lower(phrase), 'ё', 'е')) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_top_request_items_phrase_tsv ON top_request_items "
+    "USING gin (to_tsvector('russian', phrase))",
+)
+
+
+class SearchHit(NamedTuple):
+    item_id: int
+    phrase: str
+    count: int
+    rank: float
+
+
+def normalize_text(value: str) -> str:
+    # регистр и ё/е в русских запросах не различаем
+    return " ".join(value.lower().replace("ё", "е").split())
+
+
+def create_search_index(conn: Connection) -> None:
+    # вызывается из migrate_db; на существующей базе индекс заполняется по уже сохраненным фразам
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        if inspect(conn).has_table(FTS_TABLE):
+            return
+        conn.execute(text(f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(phrase, tokenize='trigram')"))
+        rows = conn.execute(select(TopRequestItem.id, TopRequestItem.phrase))
+        for chunk in iter_chunks(rows, DEFAULT_CHUNK_SIZE):
+            _insert_fts(conn, chunk)
+    elif dialect == "postgresql":
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        for statement in _PG_INDEXES:
+            conn.execute(text(statement))
+    else:
+        logger.warning("индекса для поиска по фразам в %s нет, search_items будет искать через LIKE", dialect)
+
+
+def _insert_fts(conn, rows: List[tuple]) -> None:
+    conn.execute(
+        text(f"INSERT INTO {FTS_TABLE} (rowid, phrase) VALUES (:id, :phrase)"),
+        [{"id": item_id, "phrase": normalize_text(phrase)} for item_id, phrase in rows],
+    )
+
+
+def _like_pattern(word: str) -> str:
+    return "%{}%".format(word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+
+
+def index_items(session: Session, top_request_ids: List[int]) -> None:
+    # вызывается из persist_top_requests для только что вставленных элементов топа;
+    # на postgresql индексы по выражениям обновляет сама база
+    if dialect_name(session) != "sqlite":
+        return
+    for chunk in chunked(top_request_ids, DEFAULT_CHUNK_SIZE):
+        rows = session.execute(
+            select(TopRequestItem.id, TopRequestItem.phrase).where(
+                TopRequestItem.top_request_id.in_(chunk)
+            )
+        ).all()
+        if rows:
+            _insert_fts(session, rows)
+
+
+def _sqlite_search(session: Session, words: List[str], limit: int, offset: int):
+    params: Dict[str, object] = {"limit": limit, "offset": offset}
+    conditions = []
+    # слова от 3 символов ищутся по триграммному индексу, короткие досеиваются LIKE
+    long_words = [w for w in words if len(w) >= MIN_TRIGRAM]
+    if long_words:
+        params["match"] = " AND ".join('"{}"'.format(w.replace('"', '""')) for w in long_words)
+        conditions.append(f"{FTS_TABLE} MATCH :match")
+    for i, word in enumerate(w for w in words if len(w) < MIN_TRIGRAM):
+        params[f"w{i}"] = _like_pattern(word)
+        conditions.append(f"f.phrase LIKE :w{i} ESCAPE '\\'")
+    score = f"bm25({FTS_TABLE})" if long_words else "0.0"
+    query = text(
+        f"SELECT i.id, i.phrase, i.count, {score} AS score "
+        f"FROM {FTS_TABLE} AS f JOIN top_request_items AS i ON i.id = f.rowid "
+        f"WHERE {' AND '.join(conditions)} "
+        "ORDER BY score, i.count DESC, i.id LIMIT :limit OFFSET :offset"
+    )
+    # bm25 в sqlite — чем меньше, тем лучше; наружу отдаю "чем больше, тем лучше"
+    return [
+        SearchHit(item_id, phrase, count, -score)
+        for item_id, phrase, count, score in session.execute(query, params)
+    ]
+
+
+def _postgres_search(session: Session, words: List[str], limit: int, offset: int):
+    params: Dict[str, object] = {"query": " ".join(words), "limit": limit, "offset": offset}
+    conditions = []
+    for i, word in enumerate(words):
+        params[f"w{i}"] = _like_pattern(word)
+        conditions.append(f"replace(lower(phrase), 'ё', 'е') LIKE :w{i} ESCAPE '\\'")
+    # словоформы (русская морфология) поднимают выше, при равенстве — похожесть и частота
+    query = text(
+        "SELECT id, phrase, count, "
+        "ts_rank(to_tsvector('russian', phrase), plainto_tsquery('russian', :query)) "
+        "+ similarity(replace(lower(phrase), 'ё', 'е'), :query) AS score "
+        f"FROM top_request_items WHERE {' AND '.join(conditions)} "
+        "ORDER BY score DESC, count DESC, id LIMIT :limit OFFSET :offset"
+    )
+    return [SearchHit(*row) for row in session.execute(query, params)]
+
+
+def _like_search(session: Session, words: List[str], limit: int, offset: int):
+    # остальные диалекты: те же подстроки через LIKE без индекса (полный просмотр), без ранжирования
+    phrase = func.replace(func.lower(TopRequestItem.phrase), "ё", "е")
+    query = (
+        select(TopRequestItem.id, TopRequestItem.phrase, TopRequestItem.count)
+        .where(*(phrase.like(_like_pattern(word), escape="\\") for word in words))
+        .order_by(TopRequestItem.count.desc(), TopRequestItem.id)
+        .limit(limit)
+        .offset(offset)
+    )
+    return [SearchHit(item_id, text_, count, 0.0) for item_id, text_, count in session.execute(query)]
+
+
+def search_items(session: Session, query: str, limit: int = 20, offset: int = 0) -> List[SearchHit]:
+    # элементы топов, содержащие все слова запроса как подстроки ("доставк" найдет и "доставки");
+    # сортировка по релевантности, затем по частоте; limit/offset — постраничная выдача
+    words = normalize_text(query).split()
+    if not words:
+        return []
+    dialect = dialect_name(session)
+    if dialect == "sqlite":
+        return _sqlite_search(session, words, limit, offset)
+    if dialect == "postgresql":
+        return _postgres_search(session, words, limit, offset)
+    return _like_search(session, words, limit, offset)
@@ -0,0 +1,279 @@
+import cProfile
+import glob
+import json
+import os
+import pstats
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TypeVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from logger import get_logger
+from metrics import RequestEvent
+
+logger = get_logger(__name__)
+
+T = TypeVar("T")
+
+# профилирование ночных запусков включается переменными окружения (или аргументом profile=True):
+# WORDSTAT_PROFILE=1 — таймеры этапов, счетчик sql-запросов и http-попыток, отчет в json
+# WORDSTAT_PROFILE_DIR — каталог отчетов (по умолчанию profiles)
+# WORDSTAT_PROFILE_CPROFILE=1 — дополнительно cProfile, дамп .prof рядом с отчетом
+# WORDSTAT_PROFILE_TRACEMALLOC=1 — дополнительно tracemalloc: пик памяти и главные места выделения
+DEFAULT_PROFILE_DIR = "profiles"
+TOP_ALLOCATIONS = 10
+
+
+def _env_flag(name: str) -> bool:
+    return os.getenv(name, "").lower() in ("1", "true", "yes")
+
+
+def profiling_enabled(profile: Optional[bool] = None) -> bool:
+    return _env_flag("WORDSTAT_PROFILE") if profile is None else profile
+
+
+class _Stage:
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.sql_seconds = 0.0
+        self.statements = 0
+
+
+class RunProfile:
+    # один запуск конвейера: время по этапам (fetch/persist/commit), sql-запросы через события
+    # engine с привязкой к текущему этапу, http-попытки через хук коннектора
+    enabled = True
+
+    def __init__(
+        self,
+        name: str,
+        engine: Engine,
+        report_dir: Optional[str] = None,
+        use_cprofile: Optional[bool] = None,
+        use_tracemalloc: Optional[bool] = None,
+    ):
+        self.name = name
+        self.engine = engine
+        self.report_dir = report_dir or os.getenv("WORDSTAT_PROFILE_DIR", DEFAULT_PROFILE_DIR)
+        self.use_cprofile = _env_flag("WORDSTAT_PROFILE_CPROFILE") if use_cprofile is None else use_cprofile
+        self.use_tracemalloc = (
+            _env_flag("WORDSTAT_PROFILE_TRACEMALLOC") if use_tracemalloc is None else use_tracemalloc
+        )
+        self.stages: Dict[str, _Stage] = defaultdict(_Stage)
+        self.statements: Counter = Counter()
+        self.sql_seconds = 0.0
+        self.requests: List[RequestEvent] = []
+        self.report: Dict[str, Any] = {}
+        self._active: List[str] = []
+        self._connectors: List[Any] = []
+        self._profiler: Optional[cProfile.Profile] = None
+        self._started = 0.0
+        self._started_at = datetime.now()
+
+    # события engine: время считаю от before до after_cursor_execute в том же соединении
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["profile_started"].pop()
+        self.sql_seconds += elapsed
+        self.statements[statement.lstrip().split(None, 1)[0].upper()] += 1
+        if self._active:
+            stage = self.stages[self._active[-1]]
+            stage.sql_seconds += elapsed
+            stage.statements += 1
+
+    def on_request(self, request_event: RequestEvent) -> None:
+        self.requests.append(request_event)
+
+    def attach(self, connector: Any) -> None:
+        # хук на время запуска; снимается в __exit__
+        connector.hooks.append(self.on_request)
+        self._connectors.append(connector)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        stage = self.stages[name]
+        self._active.append(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage.seconds += time.perf_counter() - started
+            stage.calls += 1
+            self._active.pop()
+
+    def iter_stage(self, name: str, iterable: Iterable[T]) -> Iterator[T]:
+        # время ожидания каждого следующего элемента — для ленивых потоков вроде fetch_*
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def __enter__(self) -> "RunProfile":
+        event.listen(self.engine, "before_cursor_execute", self._before_execute)
+        event.listen(self.engine, "after_cursor_execute", self._after_execute)
+        if self.use_tracemalloc:
+            tracemalloc.start()
+        if self.use_cprofile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        wall_seconds = time.perf_counter() - self._started
+        if self._profiler is not None:
+            self._profiler.disable()
+        event.remove(self.engine, "before_cursor_execute", self._before_execute)
+        event.remove(self.engine, "after_cursor_execute", self._after_execute)
+        for connector in self._connectors:
+            connector.hooks.remove(self.on_request)
+
+        memory = None
+        if self.use_tracemalloc:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            memory = {
+                "peak_bytes": peak,
+                "top": [str(stat) for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]],
+            }
+        self.report = self._build_report(wall_seconds, memory, failed=exc_type is not None)
+        self._write_report()
+
+    def _build_report(self, wall_seconds: float, memory: Optional[Dict[str, Any]], failed: bool) -> Dict[str, Any]:
+        http = [e for e in self.requests if not e.cache_hit and not e.coalesced]
+        http_seconds = sum(e.latency for e in http)
+        quota_wait = sum(e.quota_wait for e in http)
+        stages = {
+            name: {
+                "seconds": round(stage.seconds, 6),
+                "calls": stage.calls,
+                # время этапа без sql — построение объектов orm, разбор ответов и прочий python
+                "python_seconds": round(stage.seconds - stage.sql_seconds, 6),
+                "sql_seconds": round(stage.sql_seconds, 6),
+                "statements": stage.statements,
+            }
+            for name, stage in self.stages.items()
+        }
+        fetch = self.stages.get("fetch")
+        return {
+            "name": self.name,
+            "started_at": self._started_at.isoformat(timespec="seconds"),
+            "failed": failed,
+            "wall_seconds": round(wall_seconds, 6),
+            "stages": stages,
+            "sql": {
+                "statements": sum(self.statements.values()),
+                "by_kind": dict(self.statements),
+                "seconds": round(self.sql_seconds, 6),
+            },
+            "http": {
+                "requests": len(http),
+                "errors": sum(1 for e in http if e.status != 200),
+                "retries": sum(1 for e in http if e.attempt),
+                "cache_hits": sum(1 for e in self.requests if e.cache_hit),
+                "seconds": round(http_seconds, 6),
+                "quota_wait_seconds": round(quota_wait, 6),
+                "bytes_received": sum(e.bytes_received for e in http),
+                # загрузка без сети и квоты: разбор json и работа коннектора
+                "decode_seconds": round(max(fetch.seconds - http_seconds - quota_wait, 0.0), 6) if fetch else None,
+            },
+            "memory": memory,
+        }
+
+    def _write_report(self) -> None:
+        os.makedirs(self.report_dir, exist_ok=True)
+        stamp = self._started_at.strftime("%Y%m%d-%H%M%S-%f")
+        base = os.path.join(self.report_dir, f"{self.name}-{stamp}")
+        previous = _latest_report(self.report_dir, self.name)
+        if self._profiler is not None:
+            self._profiler.dump_stats(f"{base}.prof")
+            self.report["cprofile"] = f"{base}.prof"
+            # 20 функций с наибольшим накопленным временем (ct в pstats)
+            stats = pstats.Stats(self._profiler).stats
+            self.report["cprofile_top"] = [
+                f"{func[0]}:{func[1]}({func[2]}) {stat[3]:.3f}s"
+                for func, stat in sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:20]
+            ]
+        with open(f"{base}.json", "w", encoding="utf-8") as f:
+            json.dump(self.report, f, ensure_ascii=False, indent=2)
+        logger.info("профиль %s: %s; отчет — %s.json", self.name, format_report(self.report, previous), base)
+
+
+class NullProfile:
+    # профилирование выключено: те же методы, без таймеров и подписок на события
+    enabled = False
+    report: Dict[str, Any] = {}
+
+    def attach(self, connector: Any) -> None:
+        pass
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        yield
+
+    def iter_stage(self, name: str, iterable: Iterable[T]) -> Iterable[T]:
+        return iterable
+
+    def __enter__(self) -> "NullProfile":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+def profile_run(name: str, engine: Engine, profile: Optional[bool] = None, **options: Any):
+    return RunProfile(name, engine, **options) if profiling_enabled(profile) else NullProfile()
+
+
+def _latest_report(report_dir: str, name: str) -> Optional[Dict[str, Any]]:
+    paths = sorted(glob.glob(os.path.join(report_dir, f"{name}-*.json")))
+    if not paths:
+        return None
+    with open(paths[-1], encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _delta(current: float, previous: Optional[float]) -> str:
+    if not previous:
+        return ""
+    return f" ({(current - previous) / previous:+.0%})"
+
+
+def format_report(report: Dict[str, Any], previous: Optional[Dict[str, Any]] = None) -> str:
+    # одна строка для лога; в скобках — изменение к предыдущему отчету того же конвейера
+    previous_stages = (previous or {}).get("stages", {})
+    parts = [f"всего {report['wall_seconds']:.2f} с{_delta(report['wall_seconds'], (previous or {}).get('wall_seconds'))}"]
+    for name, stage in report["stages"].items():
+        parts.append(
+            f"{name} {stage['seconds']:.2f} с{_delta(stage['seconds'], previous_stages.get(name, {}).get('seconds'))}"
+        )
+    parts.append(f"sql-запросов {report['sql']['statements']} ({report['sql']['seconds']:.2f} с)")
+    parts.append(f"http {report['http']['requests']} ({report['http']['seconds']:.2f} с)")
+    return ", ".join(parts)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="сравнение двух отчетов профилирования")
+    parser.add_argument("previous")
+    parser.add_argument("current")
+    args = parser.parse_args()
+    with open(args.previous, encoding="utf-8") as f:
+        previous_report = json.load(f)
+    with open(args.current, encoding="utf-8") as f:
+        current_report = json.load(f)
+    print(format_report(current_report, previous_report))
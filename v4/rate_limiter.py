@@ -0,0 +1,112 @@
+import asyncio
+import os
+import threading
+import time
+from datetime import date
+from typing import Callable, Optional
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_RPS = 1.0  # запросов в секунду
+DEFAULT_BURST = 1  # сколько запросов можно сделать подряд без ожидания
+
+
+class DailyQuotaExceeded(Exception):
+    pass
+
+
+class RateLimiter:
+    # token bucket: токены копятся со скоростью rps до burst, каждый запрос забирает один.
+    # один объект можно делить между потоками, корутинами и коннекторами
+    def __init__(
+        self,
+        rps: float = DEFAULT_RPS,
+        burst: int = DEFAULT_BURST,
+        daily_limit: Optional[int] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if rps <= 0:
+            raise ValueError("rps должен быть больше нуля")
+        if burst < 1:
+            raise ValueError("burst должен быть не меньше 1")
+        self.rps = rps
+        self.burst = burst
+        self.daily_limit = daily_limit
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated_at = clock()
+        self._day = date.today()
+        self._used_today = 0
+
+    @property
+    def used_today(self) -> int:
+        with self._lock:
+            self._roll_day()
+            return self._used_today
+
+    @property
+    def remaining_today(self) -> Optional[int]:
+        if self.daily_limit is None:
+            return None
+        return max(self.daily_limit - self.used_today, 0)
+
+    def _roll_day(self) -> None:
+        today = date.today()
+        if today != self._day:
+            self._day = today
+            self._used_today = 0
+
+    def _reserve(self) -> float:
+        # забирает токен (при необходимости в долг) и возвращает, сколько ждать до его появления
+        with self._lock:
+            self._roll_day()
+            if self.daily_limit is not None and self._used_today >= self.daily_limit:
+                raise DailyQuotaExceeded(
+                    f"исчерпан дневной лимит запросов: {self.daily_limit}"
+                )
+            now = self._clock()
+            elapsed = now - self._updated_at
+            self._tokens = min(float(self.burst), self._tokens + elapsed * self.rps)
+            self._updated_at = now
+            self._tokens -= 1
+            self._used_today += 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rps
+
+    def acquire(self) -> None:
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+_default_limiter: Optional[RateLimiter] = None
+_default_lock = threading.Lock()
+
+
+def get_default_rate_limiter() -> RateLimiter:
+    # общий лимитер процесса, параметры квоты берутся из окружения
+    global _default_limiter
+    with _default_lock:
+        if _default_limiter is None:
+            daily_limit = os.getenv("WORDSTAT_DAILY_LIMIT")
+            _default_limiter = RateLimiter(
+                rps=float(os.getenv("WORDSTAT_RPS", DEFAULT_RPS)),
+                burst=int(os.getenv("WORDSTAT_BURST", DEFAULT_BURST)),
+                daily_limit=int(daily_limit) if daily_limit else None,
+            )
+            logger.info(
+                "лимит запросов: rps=%s, burst=%s, в сутки=%s",
+                _default_limiter.rps,
+                _default_limiter.burst,
+                _default_limiter.daily_limit,
+            )
+        return _default_limiter
@@ -0,0 +1,108 @@
+import json
+import os
+import tempfile
+import time
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_REGIONS_CACHE_PATH = os.getenv(
+    "WORDSTAT_REGIONS_CACHE",
+    os.path.join(tempfile.gettempdir(), "wordstat_regions_tree.json"),
+)
+DEFAULT_REGIONS_TTL = 7 * 24 * 3600  # дерево регионов меняется редко
+
+
+class RegionsIndex:
+    # плоские словари поверх дерева регионов: поиск метки, родителя и детей за O(1)
+    def __init__(self, tree: List[Dict[str, Any]]):
+        self.labels: Dict[int, str] = {}
+        self.parent: Dict[int, Optional[int]] = {}
+        self.children: Dict[int, List[int]] = {}
+        self._raw_values: Dict[int, Any] = {}
+        self._order: List[int] = []
+        self._descendants: Dict[int, FrozenSet[int]] = {}
+
+        stack = [(node, None) for node in reversed(tree)]
+        while stack:
+            node, parent_id = stack.pop()
+            node_id = parent_id
+            if "value" in node:
+                node_id = int(node["value"])
+                self.labels[node_id] = node["label"]
+                self.parent[node_id] = parent_id
+                self.children.setdefault(node_id, [])
+                self._raw_values[node_id] = node["value"]
+                self._order.append(node_id)
+                if parent_id is not None:
+                    self.children[parent_id].append(node_id)
+            if isinstance(node.get("children"), list):
+                stack.extend((child, node_id) for child in reversed(node["children"]))
+
+        self.ids: FrozenSet[int] = frozenset(self.labels)
+
+    def __contains__(self, region_id: int) -> bool:
+        return region_id in self.ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def label(self, region_id: int) -> Optional[str]:
+        return self.labels.get(region_id)
+
+    def validate(self, regions: Optional[Iterable[int]]) -> bool:
+        if not regions:
+            return True
+        return all(region_id in self.ids for region_id in regions)
+
+    def descendants(self, region_id: int) -> FrozenSet[int]:
+        # все потомки региона (без него самого), считаются один раз и запоминаются
+        cached = self._descendants.get(region_id)
+        if cached is not None:
+            return cached
+        found = set()
+        stack = list(self.children.get(region_id, []))
+        while stack:
+            child = stack.pop()
+            found.add(child)
+            stack.extend(self.children.get(child, []))
+        result = frozenset(found)
+        self._descendants[region_id] = result
+        return result
+
+    def to_flat_list(self) -> List[Dict[str, Any]]:
+        # тот же формат и порядок, что раньше отдавал get_regions
+        return [
+            {"value": self._raw_values[region_id], "label": self.labels[region_id]}
+            for region_id in self._order
+        ]
+
+
+def load_regions_tree(
+    fetch: Callable[[], List[Dict[str, Any]]],
+    cache_path: Optional[str] = DEFAULT_REGIONS_CACHE_PATH,
+    ttl: float = DEFAULT_REGIONS_TTL,
+) -> List[Dict[str, Any]]:
+    if cache_path and os.path.exists(cache_path):
+        age = time.time() - os.path.getmtime(cache_path)
+        if age < ttl:
+            try:
+                with open(cache_path, encoding="utf-8") as f:
+                    return json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning("не удалось прочитать кэш регионов %s: %s", cache_path, e)
+
+    tree = fetch()
+    if cache_path:
+        # пишу во временный файл и подменяю, чтобы параллельные процессы не прочли половину
+        directory = os.path.dirname(os.path.abspath(cache_path))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(tree, f, ensure_ascii=False)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning("не удалось сохранить кэш регионов %s: %s", cache_path, e)
+    return tree
@@ -0,0 +1,240 @@
+import json
+import sqlite3
+import threading
+import time
+from calendar import monthrange
+from collections import OrderedDict
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+TOP_REQUESTS_ENDPOINT = "/v1/topRequests"
+DYNAMICS_ENDPOINT = "/v1/dynamics"
+
+# время жизни ответа по эндпоинту в секундах, None — хранить бессрочно
+DEFAULT_TTL: Dict[str, Optional[float]] = {
+    TOP_REQUESTS_ENDPOINT: 24 * 3600,
+    DYNAMICS_ENDPOINT: 6 * 3600,
+}
+DEFAULT_MAX_ENTRIES = 10_000
+
+_MISSING = object()
+
+
+class MemoryCacheBackend:
+    # lru в памяти процесса: при переполнении вытесняется давно не читанная запись
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[Optional[float], Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[Optional[float], Any]]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+            return entry
+
+    def set(self, key: str, value: Any, expires_at: Optional[float]) -> None:
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteCacheBackend:
+    # кэш на диске, переживает перезапуски; вытеснение — по времени последнего чтения
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "expires_at REAL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_response_cache_accessed_at "
+            "ON response_cache (accessed_at)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[Tuple[Optional[float], Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT expires_at, value FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE response_cache SET accessed_at = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self._conn.commit()
+        return row[0], json.loads(row[1])
+
+    def set(self, key: str, value: Any, expires_at: Optional[float]) -> None:
+        payload = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, payload, expires_at, time.time()),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        self._conn.execute(
+            "DELETE FROM response_cache WHERE expires_at IS NOT NULL AND expires_at <= ?",
+            (time.time(),),
+        )
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                "SELECT key FROM response_cache ORDER BY accessed_at, rowid LIMIT ?)",
+                (overflow,),
+            )
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM response_cache")
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+
+
+def normalize_phrase(phrase: str) -> str:
+    # wordstat не различает регистр и лишние пробелы, поэтому и мы не различаем
+    return " ".join(phrase.split()).lower()
+
+
+def normalize_request(json_data: Dict[str, Any]) -> Dict[str, Any]:
+    # одинаковые по смыслу запросы должны давать один ключ: порядок регионов/устройств не важен
+    normalized = dict(json_data)
+    if isinstance(normalized.get("phrase"), str):
+        normalized["phrase"] = normalize_phrase(normalized["phrase"])
+    for field in ("regions", "devices"):
+        if normalized.get(field):
+            normalized[field] = sorted(set(normalized[field]))
+        else:
+            normalized.pop(field, None)
+    return normalized
+
+
+def make_cache_key(endpoint: str, json_data: Dict[str, Any]) -> str:
+    body = json.dumps(
+        normalize_request(json_data),
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return f"{endpoint}:{body}"
+
+
+def _period_end(period: str, day: date) -> date:
+    if period == "weekly":
+        return day + timedelta(days=6 - day.weekday())
+    if period == "monthly":
+        return day.replace(day=monthrange(day.year, day.month)[1])
+    return day
+
+
+def is_closed_period(json_data: Dict[str, Any], today: Optional[date] = None) -> bool:
+    # динамика за полностью прошедшие периоды больше не меняется
+    to_date = json_data.get("toDate")
+    if not to_date:
+        return False
+    today = today or date.today()
+    period_end = _period_end(json_data.get("period", "daily"), date.fromisoformat(to_date))
+    return period_end < today
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        backend: Optional[Any] = None,
+        ttl: Optional[Dict[str, Optional[float]]] = None,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.backend = backend if backend is not None else MemoryCacheBackend()
+        self.ttl = {**DEFAULT_TTL, **(ttl or {})}
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def ttl_for(self, endpoint: str, json_data: Dict[str, Any]) -> Optional[float]:
+        if endpoint == DYNAMICS_ENDPOINT and is_closed_period(json_data):
+            return None
+        return self.ttl.get(endpoint)
+
+    def get(self, endpoint: str, json_data: Dict[str, Any]) -> Optional[Any]:
+        key = make_cache_key(endpoint, json_data)
+        entry = self.backend.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at is None or expires_at > self._clock():
+                self._count(hit=True)
+                return value
+            self.backend.delete(key)
+        self._count(hit=False)
+        return None
+
+    def set(self, endpoint: str, json_data: Dict[str, Any], value: Any, ttl: Any = _MISSING) -> None:
+        if ttl is _MISSING:
+            ttl = self.ttl_for(endpoint, json_data)
+        if ttl is not None and ttl <= 0:
+            return
+        expires_at = None if ttl is None else self._clock() + ttl
+        self.backend.set(make_cache_key(endpoint, json_data), value, expires_at)
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self.backend),
+        }
+
+    def clear(self) -> None:
+        self.backend.clear()
+        with self._lock:
+            self.hits = self.misses = 0
@@ -0,0 +1,102 @@
+import random
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+class WordstatError(Exception):
+    def __init__(
+        self,
+        message: str,
+        status_code: Optional[int] = None,
+        retry_after: Optional[float] = None,
+    ):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class WordstatAuthError(WordstatError):
+    # 401/403: токен невалиден или нет доступа, повторять бессмысленно
+    pass
+
+
+class WordstatQuotaError(WordstatError):
+    # 429: превышена квота
+    pass
+
+
+class WordstatTransientError(WordstatError):
+    # 5xx и сетевые ошибки: скорее всего пройдут при повторе
+    pass
+
+
+class WordstatClientError(WordstatError):
+    # прочие 4xx: ошибка в самом запросе
+    pass
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # Retry-After бывает числом секунд или http-датой
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return max((moment - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def error_from_status(status_code: int, text: str, retry_after: Optional[str] = None) -> WordstatError:
+    message = f"Ошибка при выполнении запроса: {status_code}, {text}"
+    delay = parse_retry_after(retry_after)
+    if status_code in (401, 403):
+        return WordstatAuthError(message, status_code)
+    if status_code == 429:
+        return WordstatQuotaError(message, status_code, delay)
+    if status_code >= 500:
+        return WordstatTransientError(message, status_code, delay)
+    return WordstatClientError(message, status_code)
+
+
+@dataclass
+class RetryPolicy:
+    # отдельные бюджеты повторов для 429 и для 5xx/сетевых ошибок
+    max_quota_retries: int = 5
+    max_transient_retries: int = 3
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+
+    def backoff(self, attempt: int) -> float:
+        # экспоненциальная задержка с джиттером: половина фиксирована, половина случайна
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def next_delay(self, error: Exception, quota_attempts: int, transient_attempts: int) -> Optional[float]:
+        # сколько ждать перед следующей попыткой; None — повторять больше не нужно
+        if isinstance(error, WordstatQuotaError):
+            if quota_attempts >= self.max_quota_retries:
+                return None
+            attempt = quota_attempts
+        elif isinstance(error, WordstatTransientError):
+            if transient_attempts >= self.max_transient_retries:
+                return None
+            attempt = transient_attempts
+        else:
+            return None
+
+        if error.retry_after is not None:
+            # сервер просит ждать дольше, чем мы готовы, — отдаем ошибку наверх
+            if error.retry_after > self.max_delay:
+                return None
+            return error.retry_after
+        return self.backoff(attempt)
+
+
+NO_RETRY = RetryPolicy(max_quota_retries=0, max_transient_retries=0)
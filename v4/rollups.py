@@ -0,0 +1,219 @@
+from calendar import monthrange
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+
+from db_utils import DEFAULT_CHUNK_SIZE, chunked, match_phrase, phrase_lookup_keys, same_or_null_filter
+from models import Dynamics, DynamicsPoint, DynamicsRollup, SearchPhrase
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+ROLLUP_PERIODS = ("weekly", "monthly")
+
+
+def period_start(period: str, day: date) -> date:
+    # границы совпадают с weekly/monthly в wordstat: неделя с понедельника, месяц с 1-го числа
+    if period == "weekly":
+        return day - timedelta(days=day.weekday())
+    if period == "monthly":
+        return day.replace(day=1)
+    raise ValueError(f"нет агрегата для периода: {period}")
+
+
+def period_end(period: str, day: date) -> date:
+    if period == "weekly":
+        return period_start(period, day) + timedelta(days=6)
+    return day.replace(day=monthrange(day.year, day.month)[1])
+
+
+def is_complete(period: str, start: date, days: int) -> bool:
+    # период полный, если в нем есть все дневные точки; края ряда и пропуски дают неполные
+    return days >= (period_end(period, start) - start).days + 1
+
+
+def _load_daily(
+    session: Session,
+    phrase_ids: List[int],
+    from_date: date,
+    to_date: date,
+    region_id: Optional[int],
+    device: Optional[str],
+) -> Dict[Tuple[int, date], Tuple[int, float]]:
+    # дневные точки ряда; дата из нескольких выгрузок берется из самой свежей
+    points = {}
+    for chunk in chunked(phrase_ids, DEFAULT_CHUNK_SIZE):
+        rows = session.execute(
+            select(
+                Dynamics.search_phrase_id,
+                DynamicsPoint.point_date,
+                DynamicsPoint.count,
+                DynamicsPoint.share,
+            )
+            .join(Dynamics, Dynamics.id == DynamicsPoint.dynamics_id)
+            .where(
+                Dynamics.search_phrase_id.in_(chunk),
+                Dynamics.period == "daily",
+                same_or_null_filter(Dynamics.region_id, region_id),
+                same_or_null_filter(Dynamics.device, device),
+                DynamicsPoint.point_date >= from_date,
+                DynamicsPoint.point_date <= to_date,
+            )
+            .order_by(Dynamics.id)
+        )
+        for phrase_id, point_date, count, share in rows:
+            points[(phrase_id, point_date)] = (count, share)
+    return points
+
+
+def update_rollups(
+    session: Session,
+    phrase_ids: Iterable[int],
+    from_date: date,
+    to_date: date,
+    region_id: Optional[int] = None,
+    device: Optional[str] = None,
+) -> int:
+    # пересчитывает недели и месяцы, которые задевают новые дневные точки [from_date, to_date];
+    # периоды берутся целиком, поэтому повторная запись тех же дней агрегаты не искажает
+    phrase_ids = sorted(set(phrase_ids))
+    if not phrase_ids:
+        return 0
+    bounds = {p: (period_start(p, from_date), period_end(p, to_date)) for p in ROLLUP_PERIODS}
+    daily = _load_daily(
+        session,
+        phrase_ids,
+        min(start for start, _ in bounds.values()),
+        max(end for _, end in bounds.values()),
+        region_id,
+        device,
+    )
+
+    # count суммируется, share пересчитывается через общее число запросов за день (count / share)
+    totals: Dict[Tuple[int, str, date], List[Any]] = defaultdict(lambda: [0, 0.0, 0])
+    for (phrase_id, point_date), (count, share) in daily.items():
+        for period, (start, end) in bounds.items():
+            if start <= point_date <= end:
+                bucket = totals[(phrase_id, period, period_start(period, point_date))]
+                bucket[0] += count
+                bucket[1] += count / share if share else 0.0
+                bucket[2] += 1
+
+    now = datetime.utcnow()
+    for period, (start, end) in bounds.items():
+        for chunk in chunked(phrase_ids, DEFAULT_CHUNK_SIZE):
+            session.execute(
+                delete(DynamicsRollup).where(
+                    DynamicsRollup.search_phrase_id.in_(chunk),
+                    DynamicsRollup.period == period,
+                    same_or_null_filter(DynamicsRollup.region_id, region_id),
+                    same_or_null_filter(DynamicsRollup.device, device),
+                    DynamicsRollup.period_start >= start,
+                    DynamicsRollup.period_start <= end,
+                )
+            )
+    rows = [
+        {
+            "search_phrase_id": phrase_id,
+            "period": period,
+            "region_id": region_id,
+            "device": device,
+            "period_start": start,
+            "count": count,
+            "share": count / searches if searches else 0.0,
+            "days": days,
+            "updated_at": now,
+        }
+        for (phrase_id, period, start), (count, searches, days) in totals.items()
+    ]
+    for chunk in chunked(rows, DEFAULT_CHUNK_SIZE):
+        session.execute(insert(DynamicsRollup), list(chunk))
+    return len(rows)
+
+
+def rebuild_rollups(session: Session) -> int:
+    # первичное заполнение по уже сохраненной дневной динамике
+    series = session.execute(
+        select(
+            Dynamics.search_phrase_id,
+            Dynamics.region_id,
+            Dynamics.device,
+            DynamicsPoint.point_date,
+        )
+        .join(DynamicsPoint, DynamicsPoint.dynamics_id == Dynamics.id)
+        .where(Dynamics.period == "daily")
+        .distinct()
+    )
+    ranges: Dict[Tuple[Optional[int], Optional[str]], Dict[int, List[date]]] = defaultdict(dict)
+    for phrase_id, region_id, device, point_date in series:
+        bounds = ranges[(region_id, device)].setdefault(phrase_id, [point_date, point_date])
+        bounds[0], bounds[1] = min(bounds[0], point_date), max(bounds[1], point_date)
+
+    written = 0
+    for (region_id, device), by_phrase in ranges.items():
+        for phrase_id, (first, last) in by_phrase.items():
+            written += update_rollups(session, [phrase_id], first, last, region_id, device)
+    logger.info("агрегаты пересобраны: строк — %s", written)
+    return written
+
+
+def load_rollups(
+    session: Session,
+    phrases: List[str],
+    period: str,
+    from_date: Optional[date] = None,
+    to_date: Optional[date] = None,
+    region_id: Optional[int] = None,
+    device: Optional[str] = None,
+    complete_only: bool = True,
+) -> Dict[str, Dict[str, Any]]:
+    # недельная/месячная динамика из агрегатов в том же виде, что ответ get_dynamics:
+    # {фраза: {"dynamics": [{"date", "count", "share", "days", "complete"}, ...]}} — без запроса к api;
+    # неполные периоды (начало и конец ряда, пропущенные дни) по умолчанию не отдаются, иначе
+    # их суммы сравнивались бы с полными неделями и месяцами как равные
+    if period not in ROLLUP_PERIODS:
+        raise ValueError(f"нет агрегата для периода: {period}")
+    found: Dict[str, Dict[str, Any]] = {}
+    for chunk in chunked(phrase_lookup_keys(phrases), DEFAULT_CHUNK_SIZE):
+        query = (
+            select(
+                SearchPhrase.phrase,
+                DynamicsRollup.period_start,
+                DynamicsRollup.count,
+                DynamicsRollup.share,
+                DynamicsRollup.days,
+            )
+            .join(SearchPhrase, SearchPhrase.id == DynamicsRollup.search_phrase_id)
+            .where(
+                SearchPhrase.phrase.in_(chunk),
+                DynamicsRollup.period == period,
+                same_or_null_filter(DynamicsRollup.region_id, region_id),
+                same_or_null_filter(DynamicsRollup.device, device),
+            )
+            .order_by(DynamicsRollup.period_start)
+        )
+        if from_date:
+            query = query.where(DynamicsRollup.period_start >= period_start(period, from_date))
+        if to_date:
+            query = query.where(DynamicsRollup.period_start <= to_date)
+        for phrase, start, count, share, days in session.execute(query):
+            complete = is_complete(period, start, days)
+            if complete_only and not complete:
+                continue
+            found.setdefault(phrase, {"dynamics": []})["dynamics"].append(
+                {"date": start.isoformat(), "count": count, "share": share, "days": days, "complete": complete}
+            )
+    matched = {phrase: match_phrase(found, phrase) for phrase in dict.fromkeys(phrases)}
+    return {phrase: result for phrase, result in matched.items() if result is not None}
+
+
+if __name__ == "__main__":
+    from db_setup import get_session, init_db
+
+    init_db()
+    with get_session() as session:
+        rebuild_rollups(session)
+        session.commit()
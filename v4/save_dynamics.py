@@ -1,12 +1,34 @@
 import time
+from collections import defaultdict
 from datetime import datetime, date, UTC
-from typing import List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
+from sqlalchemy import func, insert, select, update
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
 
 from db_setup import get_session
-from models import SearchPhrase, Dynamics, DynamicsPoint
-from yandex_wordstat_connector_v4 import YandexWordstatConnector
+from db_utils import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_COMMIT_CHUNK,
+    chunked,
+    connector_or_own,
+    insert_returning_ids,
+    iter_chunks,
+    match_phrase,
+    phrase_lookup_keys,
+    resolve_phrase_ids,
+    same_or_null_filter,
+    single_value,
+    unique_by_id,
+    upsert_rows,
+)
+from models import Dynamics, DynamicsPoint, SearchPhrase
+from metrics import BatchSummary, attached_hooks, log_batch, log_summary
+from profiling import profile_run
+from rollups import update_rollups
+from yandex_wordstat_connector_v4 import RequestHook, YandexWordstatConnector
+from rate_limiter import RateLimiter
 from logger import get_logger
 
 from dotenv import load_dotenv
@@ -28,110 +50,363 @@ def _to_date(d: object) -> date:
     raise ValueError(f"ожидалась дата в формате YYYY-MM-DD, получено: {d!r}")
 
 
-def save_dynamics(
-    phrases: List[str],
+def fetch_dynamics(
+    phrases: Iterable[str],
     period: str,
     from_date: str,
     to_date: Optional[str] = None,
     regions: Optional[List[int]] = None,
     devices: Optional[List[str]] = None,
-    pause_seconds: float = 1.0,
-):
-
-
-    connector = YandexWordstatConnector(TOKEN)
-    results = connector.get_dynamics_batch(
-        phrases=phrases,
+    pause_seconds: Optional[float] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+    connector: Optional[YandexWordstatConnector] = None,
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    # этап загрузки: единственное место, где ждем квоту api; результаты отдаются по одному
+    request = dict(
         period=period,
         from_date=from_date,
         to_date=to_date,
         regions=regions,
         devices=devices,
+        pause_seconds=pause_seconds,
     )
+    with connector_or_own(connector, TOKEN, rate_limiter) as client:
+        yield from client.iter_dynamics(phrases, **request)
+
 
-    region_id = regions[0] if regions and len(regions) == 1 else None
-    device = devices[0] if devices and len(devices) == 1 else None
+def _to_dates(values: List[object], memo: Dict[object, date]) -> List[date]:
+    # даты точек повторяются от фразы к фразе, поэтому каждая строка разбирается один раз
+    parsed = []
+    for value in values:
+        d = memo.get(value)
+        if d is None:
+            d = memo[value] = _to_date(value)
+        parsed.append(d)
+    return parsed
+
+
+class SeriesState(NamedTuple):
+    header_id: int  # последняя шапка ряда — в нее сливаются новые точки
+    last_point: Optional[date]
+    to_date: date
+
+
+def load_series_state(
+    session: Session,
+    phrases: List[str],
+    period: str,
+    region_id: Optional[int] = None,
+    device: Optional[str] = None,
+) -> Dict[str, SeriesState]:
+    # что уже сохранено по рядам (фраза, period, region, device): одним запросом на чанк фраз
+    found = {}
+    for chunk in chunked(phrase_lookup_keys(phrases), DEFAULT_CHUNK_SIZE):
+        rows = session.execute(
+            select(
+                SearchPhrase.phrase,
+                func.max(Dynamics.id),
+                func.max(DynamicsPoint.point_date),
+                func.max(Dynamics.to_date),
+            )
+            .join(Dynamics, Dynamics.search_phrase_id == SearchPhrase.id)
+            .outerjoin(DynamicsPoint, DynamicsPoint.dynamics_id == Dynamics.id)
+            .where(
+                SearchPhrase.phrase.in_(chunk),
+                Dynamics.period == period,
+                same_or_null_filter(Dynamics.region_id, region_id),
+                same_or_null_filter(Dynamics.device, device),
+            )
+            .group_by(SearchPhrase.phrase)
+        )
+        for phrase, header_id, last_point, to_date in rows:
+            found[phrase] = SeriesState(header_id, last_point, to_date)
+    matched = {phrase: match_phrase(found, phrase) for phrase in dict.fromkeys(phrases)}
+    return {phrase: series for phrase, series in matched.items() if series is not None}
+
+
+def persist_dynamics(
+    session: Session,
+    phrases: List[str],
+    results: Dict[str, Dict[str, Any]],
+    period: str,
+    from_date: str,
+    to_date: Optional[str] = None,
+    regions: Optional[List[int]] = None,
+    devices: Optional[List[str]] = None,
+    merge: bool = False,
+    raise_errors: bool = False,
+) -> int:
+    # этап записи в бд: весь батч — пара пакетных запросов, сети и пауз здесь нет
+    # несколько регионов/устройств — ValueError: каждое значение сохраняется отдельно, через fanout
+    # merge=True: точки сливаются в уже сохраненный ряд (дата совпала — значение обновляется)
+    # ошибка бд откатывает транзакцию; raise_errors=True — еще и пробрасывается вызывающему
+    region_id = single_value("regions", regions)
+    device = single_value("devices", devices)
 
     now = datetime.now(UTC).replace(tzinfo=None)
 
     base_from = _to_date(from_date)
     base_to = _to_date(to_date) if to_date else None
 
-    with get_session() as session:
-        for phrase in phrases:
-            try:
-                data = results.get(phrase)
-                if not data or "ошибка" in data:
-                    logger.error(
-                        f"ошибка при получении динамики по фразе '{phrase}': "
-                        f"{data.get('ошибка') if isinstance(data, dict) else 'нет данных'}"
-                    )
-                    continue
+    memo: Dict[object, date] = {}
+    series_by_phrase = {}
+    for phrase in dict.fromkeys(phrases):
+        data = results.get(phrase)
+        if not data or "ошибка" in data:
+            logger.error(
+                "ошибка при получении динамики по фразе '%s': %s",
+                phrase,
+                data.get("ошибка") if isinstance(data, dict) else "нет данных",
+            )
+            continue
+        series = [p for p in data.get("dynamics", []) if p.get("date")]
+        # одна битая точка (дата, count, share) пропускает фразу, а не роняет всю пачку
+        try:
+            dates = _to_dates([p["date"] for p in series], memo)
+            values = [(int(p.get("count", 0)), float(p.get("share", 0.0))) for p in series]
+        except (ValueError, TypeError) as e:
+            logger.error("некорректная точка динамики по фразе '%s': %s", phrase, e)
+            continue
+        series_by_phrase[phrase] = (dates, values)
+    if not series_by_phrase:
+        return 0
 
-                series = data.get("dynamics", [])
+    try:
+        phrase_ids = resolve_phrase_ids(session, list(series_by_phrase), now)
+        unique = unique_by_id(series_by_phrase, phrase_ids)
+        series_by_phrase = {phrase: series_by_phrase[phrase] for phrase in unique}
+        state = (
+            load_series_state(session, list(series_by_phrase), period, region_id, device)
+            if merge
+            else {}
+        )
 
-                # вычисляю to_date, если не передали явно
-                if base_to is None:
-                    if series:
-                        last_date = max(_to_date(p.get("date")) for p in series if p.get("date"))
-                        computed_to = last_date
-                    else:
-                        computed_to = base_from
-                else:
-                    computed_to = base_to
-
-                # создаю SearchPhrase
-                search_phrase = session.query(SearchPhrase).filter_by(phrase=phrase).first()
-                if not search_phrase:
-                    search_phrase = SearchPhrase(phrase=phrase, created_at=now)
-                    session.add(search_phrase)
-                    session.flush()
-
-                # создание Dynamics
-                dynamics = Dynamics(
-                    search_phrase_id=search_phrase.id,
-                    requested_at=now,
-                    from_date=base_from,
-                    to_date=computed_to,
-                    period=period,
-                    region_id=region_id,
-                    device=device,
+        # шапки Dynamics одним executemany; to_date вычисляю, если не передали явно
+        headers, extended = [], []
+        for phrase, (dates, _) in series_by_phrase.items():
+            computed_to = base_to or (max(dates) if dates else base_from)
+            existing = state.get(phrase)
+            if existing is not None:
+                extended.append(
+                    {
+                        "id": existing.header_id,
+                        "requested_at": now,
+                        "to_date": max(existing.to_date, computed_to),
+                    }
                 )
-                session.add(dynamics)
-                session.flush()
-
-                # создание точки DynamicsPoint
-                for pt in series:
-                    pt_date = _to_date(pt.get("date"))
-                    pt_count = int(pt.get("count", 0))
-                    pt_share = float(pt.get("share", 0.0))
-
-                    dp = DynamicsPoint(
-                        dynamics_id=dynamics.id,
-                        date=pt_date,
-                        count=pt_count,
-                        share=pt_share,
-                    )
-                    session.add(dp)
+                continue
+            headers.append(
+                {
+                    "search_phrase_id": phrase_ids[phrase],
+                    "requested_at": now,
+                    "from_date": base_from,
+                    "to_date": computed_to,
+                    "period": period,
+                    "region_id": region_id,
+                    "device": device,
+                }
+            )
+        header_ids = insert_returning_ids(
+            session, Dynamics, headers, key_columns=["search_phrase_id"]
+        )
+        for phrase, existing in state.items():
+            header_ids[(phrase_ids[phrase],)] = existing.header_id
+        if extended:
+            session.execute(update(Dynamics), extended)
+
+        # все точки батча — один executemany
+        points = [
+            {
+                "dynamics_id": header_ids[(phrase_ids[phrase],)],
+                "point_date": pt_date,
+                "count": count,
+                "share": share,
+            }
+            for phrase, (dates, values) in series_by_phrase.items()
+            for pt_date, (count, share) in zip(dates, values)
+        ]
+        if merge:
+            upsert_rows(
+                session,
+                DynamicsPoint,
+                points,
+                index_elements=["dynamics_id", "point_date"],
+                update_columns=["count", "share"],
+            )
+        elif points:
+            session.execute(insert(DynamicsPoint.__table__), points)
 
-                logger.info(
-                    f"сохранена динамика для '{phrase}' "
-                    f"(period={period}, {base_from}–{computed_to}, region={region_id}, device={device}), "
-                    f"точек={len(series)}"
+        # недельные/месячные агрегаты дневных рядов догоняю в той же транзакции
+        if period == "daily" and points:
+            point_dates = [pt["point_date"] for pt in points]
+            update_rollups(
+                session,
+                [phrase_ids[phrase] for phrase in series_by_phrase],
+                min(point_dates),
+                max(point_dates),
+                region_id,
+                device,
+            )
+
+    except SQLAlchemyError as db_err:
+        session.rollback()
+        if raise_errors:
+            raise
+        logger.error("DB error while saving dynamics for %s phrases: %s", len(series_by_phrase), db_err)
+        return 0
+
+    logger.info(
+        "сохранена динамика для %s фраз (period=%s, с %s, region=%s, device=%s), точек=%s",
+        len(series_by_phrase),
+        period,
+        base_from,
+        region_id,
+        device,
+        len(points),
+    )
+    return len(series_by_phrase)
+
+
+def save_dynamics(
+    phrases: Iterable[str],
+    period: str,
+    from_date: str,
+    to_date: Optional[str] = None,
+    regions: Optional[List[int]] = None,
+    devices: Optional[List[str]] = None,
+    pause_seconds: Optional[float] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+    connector: Optional[YandexWordstatConnector] = None,
+    chunk_size: int = DEFAULT_COMMIT_CHUNK,
+    incremental: bool = False,
+    profile: Optional[bool] = None,
+    hooks: Optional[Iterable[RequestHook]] = None,
+    summary: Optional[BatchSummary] = None,
+):
+    # загрузка и запись идут конвейером, каждая пачка из chunk_size фраз коммитится сразу;
+    # profile (или WORDSTAT_PROFILE=1) — отчет по этапам fetch/persist/commit, см. profiling.py;
+    # hooks — хуки метрик коннектора на время запуска, summary — сводка http/квота/бд по запуску
+    # фильтры проверяю до запросов, чтобы не тратить квоту на то, что не сохранится
+    single_value("regions", regions)
+    single_value("devices", devices)
+    if incremental:
+        return _save_dynamics_incremental(
+            phrases,
+            period,
+            from_date,
+            to_date,
+            regions,
+            devices,
+            pause_seconds,
+            rate_limiter,
+            connector,
+            chunk_size,
+            profile,
+            hooks,
+            summary,
+        )
+
+    processed = saved = 0
+    with get_session() as session, connector_or_own(connector, TOKEN, rate_limiter) as client, profile_run(
+        "save_dynamics", session.get_bind(), profile
+    ) as run, attached_hooks(client, hooks, summary):
+        run.attach(client)
+        stream = fetch_dynamics(
+            phrases,
+            period,
+            from_date,
+            to_date=to_date,
+            regions=regions,
+            devices=devices,
+            pause_seconds=pause_seconds,
+            connector=client,
+        )
+        fetch_started = time.perf_counter()
+        for chunk in run.iter_stage("fetch", iter_chunks(stream, chunk_size)):
+            db_started = time.perf_counter()
+            results = dict(chunk)
+            with run.stage("persist"):
+                saved += persist_dynamics(
+                    session, list(results), results, period, from_date, to_date, regions, devices
                 )
+            with run.stage("commit"):
+                session.commit()
+            processed += len(chunk)
+            log_batch(logger, processed, db_started - fetch_started, time.perf_counter() - db_started, summary)
+            fetch_started = time.perf_counter()
+
+    logger.info("обработка завершена: фраз — %s, сохранено — %s", processed, saved)
+    log_summary(logger, summary)
+
 
-                time.sleep(pause_seconds)
+def _save_dynamics_incremental(
+    phrases: Iterable[str],
+    period: str,
+    from_date: str,
+    to_date: Optional[str],
+    regions: Optional[List[int]],
+    devices: Optional[List[str]],
+    pause_seconds: Optional[float],
+    rate_limiter: Optional[RateLimiter],
+    connector: Optional[YandexWordstatConnector],
+    chunk_size: int,
+    profile: Optional[bool],
+    hooks: Optional[Iterable[RequestHook]],
+    summary: Optional[BatchSummary],
+):
+    # у api запрашивается только хвост ряда: с последней сохраненной точки (последний период
+    # мог быть неполным и перезапрашивается), у новых фраз — с from_date
+    base_from = _to_date(from_date)
+    base_to = _to_date(to_date) if to_date else None
+    region_id, device = single_value("regions", regions), single_value("devices", devices)
 
-            except SQLAlchemyError as db_err:
-                session.rollback()
-                logger.error(f"DB error for phrase '{phrase}': {db_err}")
-            except Exception as e:
-                session.rollback()
-                logger.error(f"unexpected error for phrase '{phrase}': {e}")
+    processed = saved = skipped = 0
+    with get_session() as session, connector_or_own(connector, TOKEN, rate_limiter) as client, profile_run(
+        "save_dynamics_incremental", session.get_bind(), profile
+    ) as run, attached_hooks(client, hooks, summary):
+        run.attach(client)
+        for chunk in iter_chunks(dict.fromkeys(phrases), chunk_size):
+            with run.stage("state"):
+                state = load_series_state(session, chunk, period, region_id, device)
+            by_start: Dict[date, List[str]] = defaultdict(list)
+            for phrase in chunk:
+                existing = state.get(phrase)
+                if existing is None or existing.last_point is None:
+                    by_start[base_from].append(phrase)
+                elif base_to and existing.to_date >= base_to:
+                    skipped += 1
+                else:
+                    by_start[max(base_from, existing.last_point)].append(phrase)
 
-        session.commit()
+            fetch_started = time.perf_counter()
+            results = {}
+            with run.stage("fetch"):
+                for start, group in sorted(by_start.items()):
+                    results.update(
+                        client.iter_dynamics(
+                            group,
+                            period=period,
+                            from_date=start.isoformat(),
+                            to_date=to_date,
+                            regions=regions,
+                            devices=devices,
+                            pause_seconds=pause_seconds,
+                        )
+                    )
+            db_started = time.perf_counter()
+            with run.stage("persist"):
+                saved += persist_dynamics(
+                    session, list(results), results, period, from_date, to_date, regions, devices, merge=True
+                )
+            with run.stage("commit"):
+                session.commit()
+            processed += len(chunk)
+            log_batch(logger, processed, db_started - fetch_started, time.perf_counter() - db_started, summary)
 
-    logger.info(f"обработка завершена: фраз — {len(phrases)}")
+    logger.info(
+        "дозагрузка завершена: фраз — %s, обновлено — %s, уже актуальных — %s", processed, saved, skipped
+    )
+    log_summary(logger, summary)
 
 
 if __name__ == "__main__":
@@ -139,7 +414,7 @@ if __name__ == "__main__":
     raw_input = "купить телефон, пицца москва\nманикюр на дому"
     client = YandexWordstatConnector(TOKEN)
     phrases = client.phrases_to_list(raw_input)
-    logger.info(f"Введенные фразы: {phrases}")
+    logger.info("Введенные фразы: %s", phrases)
 
     save_dynamics(
         phrases=phrases,
@@ -1,12 +1,30 @@
 import time
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
+from sqlalchemy import insert, select
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
 
 from db_setup import get_session
-from models import SearchPhrase, TopRequest, TopRequestItem
-from yandex_wordstat_connector_v4 import YandexWordstatConnector
+from db_utils import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_COMMIT_CHUNK,
+    chunked,
+    connector_or_own,
+    insert_returning_ids,
+    iter_chunks,
+    resolve_phrase_ids,
+    same_or_null_filter,
+    single_value,
+    unique_by_id,
+)
+from models import TopRequest, TopRequestItem
+from metrics import BatchSummary, attached_hooks, log_batch, log_summary
+from phrase_search import index_items
+from profiling import profile_run
+from yandex_wordstat_connector_v4 import RequestHook, YandexWordstatConnector
+from rate_limiter import RateLimiter
 from logger import get_logger
 
 from dotenv import load_dotenv
@@ -20,110 +38,190 @@ if not TOKEN:
 logger = get_logger(__name__)
 
 
-def _same_or_null_filter(column, value):
-    return (column == value) if value is not None else column.is_(None)
-
-
-def save_top_requests(
+def fetch_top_requests(
+    phrases: Iterable[str],
+    regions: Optional[List[int]] = None,
+    devices: Optional[List[str]] = None,
+    pause_seconds: Optional[float] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+    connector: Optional[YandexWordstatConnector] = None,
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    # этап загрузки: единственное место, где ждем квоту api; результаты отдаются по одному
+    request = dict(regions=regions, devices=devices, pause_seconds=pause_seconds)
+    with connector_or_own(connector, TOKEN, rate_limiter) as client:
+        yield from client.iter_top_requests(phrases, **request)
+
+
+def persist_top_requests(
+    session: Session,
     phrases: List[str],
+    results: Dict[str, Dict[str, Any]],
     regions: Optional[List[int]] = None,
     devices: Optional[List[str]] = None,
-    pause_seconds: float = 1.0,
-):
-
-    connector = YandexWordstatConnector(TOKEN)
-    results = connector.get_top_requests_batch(
-        phrases, regions=regions, devices=devices, pause_seconds=pause_seconds
-    )
-
-    # поддерживает только один регион/девайс на запрос
-    region_id = regions[0] if regions and len(regions) == 1 else None
-    device = devices[0] if devices and len(devices) == 1 else None
-
-    with get_session() as session:
-        # границы текущего дня 
-        now = datetime.utcnow()
-        start_of_day = datetime.combine(now.date(), datetime.min.time())
-        start_of_next_day = start_of_day + timedelta(days=1)
-
-        for phrase in phrases:
-            try:
-                data = results.get(phrase)
-                if not data or "ошибка" in data:
-                    logger.error(
-                        f"ошибка при получении данных по фразе '{phrase}': "
-                        f"{data.get('ошибка') if isinstance(data, dict) else 'нет данных'}"
-                    )
-                    continue
-
-                # search_phrases (upsert по тексту фразы)
-                search_phrase = (
-                    session.query(SearchPhrase).filter_by(phrase=phrase).first()
-                )
-                if not search_phrase:
-                    search_phrase = SearchPhrase(phrase=phrase, created_at=now)
-                    session.add(search_phrase)
-                    session.flush()  # получаем id
-
-                # проверяю, не сохраняли ли сегодня уже такую же выборку
-                exists_today = (
-                    session.query(TopRequest.id)
-                    .filter(
-                        TopRequest.search_phrase_id == search_phrase.id,
-                        _same_or_null_filter(TopRequest.region_id, region_id),
-                        _same_or_null_filter(TopRequest.device, device),
+    raise_errors: bool = False,
+) -> int:
+    # этап записи в бд: весь батч несколькими пакетными запросами, сети и пауз здесь нет
+    # несколько регионов/устройств — ValueError: каждое значение сохраняется отдельно, через fanout
+    # ошибка бд откатывает транзакцию; raise_errors=True — еще и пробрасывается вызывающему
+    region_id = single_value("regions", regions)
+    device = single_value("devices", devices)
+
+    # границы текущего дня
+    now = datetime.utcnow()
+    start_of_day = datetime.combine(now.date(), datetime.min.time())
+    start_of_next_day = start_of_day + timedelta(days=1)
+
+    fetched = {}
+    for phrase in dict.fromkeys(phrases):
+        data = results.get(phrase)
+        if not data or "ошибка" in data:
+            logger.error(
+                "ошибка при получении данных по фразе '%s': %s",
+                phrase,
+                data.get("ошибка") if isinstance(data, dict) else "нет данных",
+            )
+            continue
+        # числа из ответа приводятся здесь: битое значение пропускает фразу, а не роняет всю пачку
+        try:
+            total_count = data.get("totalCount")
+            fetched[phrase] = (
+                int(total_count) if total_count is not None else None,
+                [(item.get("phrase"), int(item.get("count"))) for item in data.get("topRequests", [])],
+            )
+        except (ValueError, TypeError) as e:
+            logger.error("некорректный ответ topRequests по фразе '%s': %s", phrase, e)
+    if not fetched:
+        return 0
+
+    try:
+        # search_phrases (upsert по тексту фразы)
+        phrase_ids = resolve_phrase_ids(session, list(fetched), now)
+
+        # проверяю одним запросом, какие выборки уже сохранены сегодня
+        saved_today = set()
+        for chunk in chunked(list(phrase_ids.values()), DEFAULT_CHUNK_SIZE):
+            saved_today.update(
+                session.execute(
+                    select(TopRequest.search_phrase_id).where(
+                        TopRequest.search_phrase_id.in_(chunk),
+                        same_or_null_filter(TopRequest.region_id, region_id),
+                        same_or_null_filter(TopRequest.device, device),
                         TopRequest.requested_at >= start_of_day,
                         TopRequest.requested_at < start_of_next_day,
                     )
-                    .first()
-                )
-
-                if exists_today:
-                    logger.info(
-                        f"запрос по фразе '{phrase}' (region={region_id}, device={device}) "
-                        f"уже сохранён за {now.date()} — пропускаю"
-                    )
-                    continue
-
-                # top_requests (шапка)
-                total_count = data.get("totalCount")
-                top_request = TopRequest(
-                    search_phrase_id=search_phrase.id,
-                    requested_at=now,
-                    region_id=region_id,
-                    device=device,
-                    total_count=total_count,
-                )
-                session.add(top_request)
-                session.flush()  # нужен id для items
-
-                # top_request_items (детализация)
-                for item in data.get("topRequests", []):
-                    tr_item = TopRequestItem(
-                        top_request_id=top_request.id,
-                        phrase=item.get("phrase"),
-                        count=item.get("count"),
-                    )
-                    session.add(tr_item)
+                ).scalars()
+            )
 
+        to_save = []
+        for phrase in unique_by_id(fetched, phrase_ids):
+            parsed = fetched[phrase]
+            if phrase_ids[phrase] in saved_today:
                 logger.info(
-                    f"сохранены topRequests для '{phrase}' "
-                    f"(region={region_id}, device={device}), total_count={total_count}"
+                    "запрос по фразе '%s' (region=%s, device=%s) уже сохранён за %s — пропускаю",
+                    phrase,
+                    region_id,
+                    device,
+                    now.date(),
                 )
+                continue
+            to_save.append((phrase, parsed))
+        if not to_save:
+            return 0
+
+        # top_requests (шапки), id нужны для items
+        header_ids = insert_returning_ids(
+            session,
+            TopRequest,
+            [
+                {
+                    "search_phrase_id": phrase_ids[phrase],
+                    "requested_at": now,
+                    "region_id": region_id,
+                    "device": device,
+                    "total_count": total_count,
+                }
+                for phrase, (total_count, _) in to_save
+            ],
+            key_columns=["search_phrase_id"],
+        )
+
+        # top_request_items (детализация) одним executemany на чанк
+        items = [
+            {
+                "top_request_id": header_ids[(phrase_ids[phrase],)],
+                "phrase": item_phrase,
+                "count": count,
+            }
+            for phrase, (_, parsed_items) in to_save
+            for item_phrase, count in parsed_items
+        ]
+        for chunk in chunked(items, DEFAULT_CHUNK_SIZE):
+            session.execute(insert(TopRequestItem), list(chunk))
+        # поисковый индекс по фразам догоняю в той же транзакции
+        index_items(session, list(header_ids.values()))
+
+    except SQLAlchemyError as db_err:
+        session.rollback()
+        if raise_errors:
+            raise
+        logger.error("DB error while saving batch of %s phrases: %s", len(fetched), db_err)
+        return 0
+
+    logger.info(
+        "сохранены topRequests для %s фраз (region=%s, device=%s), элементов: %s",
+        len(to_save),
+        region_id,
+        device,
+        len(items),
+    )
+    return len(to_save)
 
-                # пауза между фразами (чтобы не перегружать сервер)
-                time.sleep(pause_seconds)
-
-            except SQLAlchemyError as db_err:
-                session.rollback()
-                logger.error(f"DB error for phrase '{phrase}': {db_err}")
-            except Exception as e:
-                session.rollback()
-                logger.error(f"unexpected error for phrase '{phrase}': {e}")
-
-        session.commit()
 
-    logger.info(f"обработка завершена: фраз — {len(phrases)}")
+def save_top_requests(
+    phrases: Iterable[str],
+    regions: Optional[List[int]] = None,
+    devices: Optional[List[str]] = None,
+    pause_seconds: Optional[float] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+    connector: Optional[YandexWordstatConnector] = None,
+    chunk_size: int = DEFAULT_COMMIT_CHUNK,
+    profile: Optional[bool] = None,
+    hooks: Optional[Iterable[RequestHook]] = None,
+    summary: Optional[BatchSummary] = None,
+):
+    # загрузка и запись идут конвейером: каждая пачка из chunk_size фраз коммитится сразу,
+    # поэтому память не растет с длиной списка и упавший запуск не теряет уже сохраненное;
+    # profile (или WORDSTAT_PROFILE=1) — отчет по этапам fetch/persist/commit, см. profiling.py;
+    # hooks — хуки метрик коннектора на время запуска, summary — сводка http/квота/бд по запуску
+    # фильтры проверяю до запросов, чтобы не тратить квоту на то, что не сохранится
+    single_value("regions", regions)
+    single_value("devices", devices)
+    processed = saved = 0
+    with get_session() as session, connector_or_own(connector, TOKEN, rate_limiter) as client, profile_run(
+        "save_top_requests", session.get_bind(), profile
+    ) as run, attached_hooks(client, hooks, summary):
+        run.attach(client)
+        stream = fetch_top_requests(
+            phrases,
+            regions=regions,
+            devices=devices,
+            pause_seconds=pause_seconds,
+            connector=client,
+        )
+        fetch_started = time.perf_counter()
+        for chunk in run.iter_stage("fetch", iter_chunks(stream, chunk_size)):
+            db_started = time.perf_counter()
+            results = dict(chunk)
+            with run.stage("persist"):
+                saved += persist_top_requests(session, list(results), results, regions, devices)
+            with run.stage("commit"):
+                session.commit()
+            processed += len(chunk)
+            log_batch(logger, processed, db_started - fetch_started, time.perf_counter() - db_started, summary)
+            fetch_started = time.perf_counter()
+
+    logger.info("обработка завершена: фраз — %s, сохранено — %s", processed, saved)
+    log_summary(logger, summary)
 
 
 if __name__ == "__main__":
@@ -131,6 +229,6 @@ if __name__ == "__main__":
     raw_input = "купить телефон, пицца москва\nманикюр на дому"
     client = YandexWordstatConnector(TOKEN)
     phrases = client.phrases_to_list(raw_input)
-    logger.info(f"введенные фразы: {phrases}")
+    logger.info("введенные фразы: %s", phrases)
 
     save_top_requests(phrases=phrases, regions=[213], devices=["phone"])
@@ -0,0 +1,212 @@
+import json
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional
+
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.orm import Session
+
+from db_utils import DEFAULT_CHUNK_SIZE, chunked, single_value, upsert_rows
+from models import FetchTask
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+TOP_REQUESTS = "topRequests"
+DYNAMICS = "dynamics"
+ENDPOINTS = (TOP_REQUESTS, DYNAMICS)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+DEFAULT_LEASE_SECONDS = 600  # через сколько зависшее задание можно забрать снова
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_DELAY = 60  # пауза перед повтором упавшего задания, удваивается с каждой попыткой
+MAX_RETRY_DELAY = 3600
+
+
+def params_to_json(params: Dict[str, Any]) -> str:
+    # одинаковые параметры дают одну и ту же строку — на ней держится уникальность задания
+    normalized = {key: value for key, value in params.items() if value is not None}
+    for key in ("regions", "devices"):
+        if normalized.get(key):
+            normalized[key] = sorted(set(normalized[key]))
+    return json.dumps(normalized, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
+
+def enqueue_tasks(
+    session: Session, phrases: Iterable[str], endpoint: str, params: Dict[str, Any]
+) -> int:
+    # повторная постановка тех же фраз с теми же параметрами ничего не дублирует
+    if endpoint not in ENDPOINTS:
+        raise ValueError(f"неизвестный эндпоинт: {endpoint}")
+    # воркер сохраняет результаты, поэтому фильтр — одно значение на задание
+    single_value("regions", params.get("regions"))
+    single_value("devices", params.get("devices"))
+    params_json = params_to_json(params)
+    phrases = list(dict.fromkeys(phrases))
+    existing = set()
+    for chunk in chunked(phrases, DEFAULT_CHUNK_SIZE):
+        existing.update(
+            session.scalars(
+                select(FetchTask.phrase).where(
+                    FetchTask.endpoint == endpoint,
+                    FetchTask.params == params_json,
+                    FetchTask.phrase.in_(chunk),
+                )
+            )
+        )
+    new_phrases = [phrase for phrase in phrases if phrase not in existing]
+    upsert_rows(
+        session,
+        FetchTask,
+        [
+            {
+                "endpoint": endpoint,
+                "phrase": phrase,
+                "params": params_json,
+                "status": PENDING,
+                "attempts": 0,
+                "created_at": datetime.utcnow(),
+            }
+            for phrase in new_phrases
+        ],
+        index_elements=["endpoint", "phrase", "params"],
+    )
+    logger.info("в очередь %s добавлено %s заданий из %s", endpoint, len(new_phrases), len(phrases))
+    return len(new_phrases)
+
+
+def requeue_stale(session: Session, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> int:
+    # задания упавших воркеров возвращаются в очередь по истечении аренды
+    deadline = datetime.utcnow() - timedelta(seconds=lease_seconds)
+    result = session.execute(
+        update(FetchTask)
+        .where(FetchTask.status == RUNNING, FetchTask.claimed_at < deadline)
+        .values(status=PENDING, claim_token=None)
+    )
+    return result.rowcount
+
+
+def claim_tasks(
+    session: Session,
+    worker_id: str,
+    limit: int,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+) -> List[FetchTask]:
+    # атомарно переводит до limit заданий pending -> running; на postgresql параллельные
+    # воркеры пропускают чужие строки (SKIP LOCKED), на sqlite их разводит блокировка записи
+    # задания, упавшие недавно, ждут своего next_attempt_at
+    requeue_stale(session, lease_seconds)
+    token = uuid.uuid4().hex
+    now = datetime.utcnow()
+    candidates = (
+        select(FetchTask.id)
+        .where(
+            FetchTask.status == PENDING,
+            or_(FetchTask.next_attempt_at.is_(None), FetchTask.next_attempt_at <= now),
+        )
+        .order_by(FetchTask.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    session.execute(
+        update(FetchTask)
+        .where(FetchTask.id.in_(candidates.scalar_subquery()), FetchTask.status == PENDING)
+        .values(
+            status=RUNNING,
+            worker_id=worker_id,
+            claim_token=token,
+            claimed_at=now,
+            attempts=FetchTask.attempts + 1,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    session.commit()
+    return list(
+        session.scalars(
+            select(FetchTask)
+            .where(FetchTask.claim_token == token)
+            .order_by(FetchTask.id)
+            .execution_options(populate_existing=True)
+        )
+    )
+
+
+def complete_tasks(session: Session, tasks: List[FetchTask]) -> List[int]:
+    # отмечает выполненными только задания, которые все еще за нами (аренду могли отобрать);
+    # вызывать в той же транзакции, что и запись результатов
+    # без UPDATE ... RETURNING (mysql и др.) свои строки сначала выбираются под блокировкой
+    returning = session.get_bind().dialect.update_returning
+    owned = []
+    for token in {task.claim_token for task in tasks}:
+        ids = [task.id for task in tasks if task.claim_token == token]
+        still_ours = (FetchTask.id.in_(ids), FetchTask.claim_token == token, FetchTask.status == RUNNING)
+        stmt = (
+            update(FetchTask)
+            .values(status=DONE, finished_at=datetime.utcnow(), error=None, next_attempt_at=None)
+            .execution_options(synchronize_session=False)
+        )
+        if returning:
+            owned.extend(session.scalars(stmt.where(*still_ours).returning(FetchTask.id)))
+            continue
+        found = list(session.scalars(select(FetchTask.id).where(*still_ours).with_for_update()))
+        if found:
+            session.execute(stmt.where(FetchTask.id.in_(found)))
+        owned.extend(found)
+    return owned
+
+
+def fail_task(
+    session: Session,
+    task: FetchTask,
+    error: str,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    retry_delay: float = DEFAULT_RETRY_DELAY,
+) -> None:
+    # задание вернется в очередь, пока не исчерпаны попытки; повтор — не раньше чем через
+    # retry_delay * 2^(попытка - 1) секунд, чтобы сбой не сжег все попытки подряд
+    status = FAILED if task.attempts >= max_attempts else PENDING
+    now = datetime.utcnow()
+    delay = min(retry_delay * 2 ** max(task.attempts - 1, 0), MAX_RETRY_DELAY)
+    session.execute(
+        update(FetchTask)
+        .where(FetchTask.id == task.id, FetchTask.claim_token == task.claim_token)
+        .values(
+            status=status,
+            error=error,
+            claim_token=None,
+            finished_at=now,
+            next_attempt_at=now + timedelta(seconds=delay) if status == PENDING else None,
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def release_tasks(session: Session, tasks: List[FetchTask], reason: Optional[str] = None) -> None:
+    # возвращает задания в очередь без траты попытки: до них дело не дошло (кончилась квота,
+    # не принят токен), и повтор сейчас упал бы так же
+    for token in {task.claim_token for task in tasks}:
+        ids = [task.id for task in tasks if task.claim_token == token]
+        for chunk in chunked(ids, DEFAULT_CHUNK_SIZE):
+            session.execute(
+                update(FetchTask)
+                .where(FetchTask.id.in_(chunk), FetchTask.claim_token == token, FetchTask.status == RUNNING)
+                .values(
+                    status=PENDING,
+                    claim_token=None,
+                    worker_id=None,
+                    attempts=FetchTask.attempts - 1,
+                    error=reason,
+                )
+                .execution_options(synchronize_session=False)
+            )
+
+
+def queue_stats(session: Session, endpoint: Optional[str] = None) -> Dict[str, int]:
+    query = select(FetchTask.status, func.count()).group_by(FetchTask.status)
+    if endpoint:
+        query = query.where(FetchTask.endpoint == endpoint)
+    return {status: count for status, count in session.execute(query)}
@@ -0,0 +1,973 @@
+import asyncio
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+
+import pytest
+
+# тесты работают на временной sqlite, токен api не нужен
+_tmp_dir = tempfile.mkdtemp(prefix="wordstat_test_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp_dir, 'test.db')}"
+os.environ.setdefault("YANDEX_WORDSTAT_TOKEN", "test-token")
+
+import save_dynamics as save_dynamics_module
+import save_top_requests as save_top_requests_module
+from sqlalchemy import event
+
+from db_setup import create_db_engine, engine, engine_options, init_db, get_session
+from export import ExportFilters, export_table
+from fake_wordstat_server import FakeWordstatServer
+from fanout import plan_requests, save_top_requests_matrix
+from fill_regions import sync_regions
+from logger import configure_logging, get_logger, stop_logging
+from metrics import BatchSummary, MetricsRegistry, PrometheusHook
+from models import Dynamics, DynamicsPoint, FetchTask, Region, SearchPhrase, TopRequest, TopRequestItem
+from rate_limiter import RateLimiter, DailyQuotaExceeded
+from response_cache import ResponseCache, SQLiteCacheBackend, DYNAMICS_ENDPOINT
+from retry_policy import NO_RETRY, RetryPolicy, WordstatAuthError
+from task_queue import DONE, FAILED, TOP_REQUESTS, claim_tasks, enqueue_tasks, queue_stats
+from worker import process_tasks, run_worker
+from yandex_wordstat_connector_v4 import YandexWordstatConnector, AsyncYandexWordstatConnector
+
+
+# подменный транспорт вместо requests.Session: запоминает запросы и отдает заготовленные ответы
+class FakeResponse:
+    def __init__(self, status_code, payload, headers=None):
+        self.status_code = status_code
+        self._payload = payload
+        self.headers = headers or {}
+        self.text = json.dumps(payload, ensure_ascii=False)
+        self.content = self.text.encode("utf-8")
+
+    def json(self):
+        return self._payload
+
+
+class FakeSession:
+    def __init__(self, handler):
+        self.handler = handler
+        self.calls = []
+        self.closed = False
+
+    def request(self, method, url, headers=None, params=None, json=None, timeout=None):
+        self.calls.append({"method": method, "url": url, "json": json, "timeout": timeout})
+        return self.handler(method, url, json)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture(scope="module", autouse=True)
+def database():
+    init_db()
+
+
+def top_requests_handler(method, url, body):
+    return FakeResponse(
+        200,
+        {
+            "requestPhrase": body["phrase"],
+            "totalCount": 100,
+            "topRequests": [{"phrase": body["phrase"], "count": 100}],
+        },
+    )
+
+
+def test_connector_reuses_injected_session():
+    session = FakeSession(top_requests_handler)
+    client = YandexWordstatConnector(
+        "token",
+        base_url="http://fake",
+        session=session,
+        timeout=3,
+        rate_limiter=RateLimiter(rps=1000, burst=10),
+    )
+    with client:
+        client.get_top_requests("котики", regions=[213])
+        client.get_top_requests("собаки")
+
+    assert [c["url"] for c in session.calls] == ["http://fake/v1/topRequests"] * 2
+    assert session.calls[0]["json"] == {"phrase": "котики", "regions": [213]}
+    assert session.calls[0]["timeout"] == 3
+    # чужую сессию коннектор не закрывает
+    assert not session.closed
+
+
+def test_connector_owns_pooled_session():
+    client = YandexWordstatConnector("token", pool_size=3)
+    adapter = client.session.get_adapter("https://api.wordstat.yandex.net")
+    assert adapter._pool_maxsize == 3
+    client.close()
+
+
+def test_async_batch_runs_in_parallel_within_limit():
+    lock = threading.Lock()
+    state = {"active": 0, "peak": 0}
+
+    def handler(method, url, body):
+        with lock:
+            state["active"] += 1
+            state["peak"] = max(state["peak"], state["active"])
+        time.sleep(0.05)
+        with lock:
+            state["active"] -= 1
+        if body["phrase"] == "сломано":
+            return FakeResponse(500, {"error": "boom"})
+        return top_requests_handler(method, url, body)
+
+    phrases = [f"фраза {i}" for i in range(12)] + ["сломано"]
+
+    async def run():
+        async with AsyncYandexWordstatConnector(
+            "token",
+            concurrency=4,
+            base_url="http://fake",
+            session=FakeSession(handler),
+            rate_limiter=RateLimiter(rps=1000, burst=100),
+            retry_policy=NO_RETRY,
+        ) as client:
+            return await client.get_top_requests_batch(phrases, regions=[213])
+
+    started = time.perf_counter()
+    results = asyncio.run(run())
+    elapsed = time.perf_counter() - started
+
+    assert list(results) == phrases
+    assert results["фраза 3"]["totalCount"] == 100
+    assert "ошибка" in results["сломано"]
+    assert state["peak"] == 4
+    assert elapsed < 13 * 0.05
+
+
+def test_rate_limiter_burst_then_steady_rate():
+    now = [0.0]
+    limiter = RateLimiter(rps=2, burst=3, daily_limit=5, clock=lambda: now[0])
+
+    # первые burst запросов проходят сразу, дальше — по 1/rps секунды на токен
+    assert [limiter._reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter._reserve() == pytest.approx(0.5)
+    now[0] = 1.0
+    assert limiter._reserve() == pytest.approx(0.0)
+    assert limiter.remaining_today == 0
+    with pytest.raises(DailyQuotaExceeded):
+        limiter.acquire()
+
+
+def test_save_top_requests_persist_stage_never_sleeps(monkeypatch):
+    class Connector:
+        def iter_top_requests(self, phrases, regions=None, devices=None, pause_seconds=None):
+            for phrase in phrases:
+                yield phrase, {"totalCount": 10, "topRequests": [{"phrase": phrase, "count": 10}]}
+
+    def no_sleep(seconds):
+        raise AssertionError("запись в бд не должна ждать")
+
+    monkeypatch.setattr(time, "sleep", no_sleep)
+    phrases = ["сон 1", "сон 2", "сон 3"]
+    save_top_requests_module.save_top_requests(phrases, regions=[2], connector=Connector())
+
+    with get_session() as session:
+        saved = session.query(TopRequest).filter(TopRequest.region_id == 2).count()
+        items = session.query(TopRequestItem).join(TopRequest).filter(TopRequest.region_id == 2).count()
+    assert saved == 3
+    assert items == 3
+
+
+def test_make_request_retries_quota_and_server_errors(monkeypatch):
+    responses = [
+        FakeResponse(429, {"error": "quota"}, headers={"Retry-After": "2"}),
+        FakeResponse(503, {"error": "unavailable"}),
+        FakeResponse(200, {"totalCount": 5, "topRequests": []}),
+    ]
+    session = FakeSession(lambda method, url, body: responses.pop(0))
+    delays = []
+    monkeypatch.setattr(time, "sleep", delays.append)
+
+    client = YandexWordstatConnector(
+        "token",
+        session=session,
+        rate_limiter=RateLimiter(rps=1000, burst=10),
+        retry_policy=RetryPolicy(base_delay=0.5),
+    )
+    assert client.get_top_requests("котики")["totalCount"] == 5
+    assert len(session.calls) == 3
+    # Retry-After соблюдается, для 503 — экспоненциальная задержка с джиттером
+    assert delays[0] == 2
+    assert 0.25 <= delays[1] <= 0.5
+
+
+def test_make_request_does_not_retry_auth_error():
+    session = FakeSession(lambda method, url, body: FakeResponse(401, {"error": "bad token"}))
+    client = YandexWordstatConnector(
+        "token", session=session, rate_limiter=RateLimiter(rps=1000, burst=10)
+    )
+    with pytest.raises(WordstatAuthError):
+        client.get_top_requests("котики")
+    assert len(session.calls) == 1
+
+
+def test_cache_serves_repeated_requests_without_http():
+    session = FakeSession(top_requests_handler)
+    cache = ResponseCache()
+    client = YandexWordstatConnector(
+        "token", session=session, rate_limiter=RateLimiter(rps=1000, burst=10), cache=cache
+    )
+    first = client.get_top_requests("котики", regions=[213, 2])
+    # порядок регионов и лишние пробелы не меняют ключ кэша
+    second = client.get_top_requests("котики ", regions=[2, 213])
+
+    assert first == second
+    assert len(session.calls) == 1
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_cache_keeps_closed_dynamics_forever_and_evicts_by_size():
+    cache = ResponseCache(backend=SQLiteCacheBackend(os.path.join(_tmp_dir, "cache.db"), max_entries=2))
+    closed = {"phrase": "котики", "period": "monthly", "fromDate": "2024-01-01", "toDate": "2024-03-31"}
+    open_ended = {"phrase": "котики", "period": "monthly", "fromDate": "2024-01-01"}
+    assert cache.ttl_for(DYNAMICS_ENDPOINT, closed) is None
+    assert cache.ttl_for(DYNAMICS_ENDPOINT, open_ended) == 6 * 3600
+
+    for i in range(3):
+        cache.set(DYNAMICS_ENDPOINT, {**closed, "phrase": f"фраза {i}"}, {"dynamics": [i]})
+    assert len(cache.backend) == 2
+    assert cache.get(DYNAMICS_ENDPOINT, {**closed, "phrase": "фраза 0"}) is None
+    assert cache.get(DYNAMICS_ENDPOINT, {**closed, "phrase": "фраза 2"}) == {"dynamics": [2]}
+
+
+REGIONS_TREE = [
+    {
+        "value": "225",
+        "label": "Россия",
+        "children": [
+            {"value": "1", "label": "Москва и область", "children": [{"value": "213", "label": "Москва"}]},
+            {"value": "2", "label": "Санкт-Петербург", "children": None},
+        ],
+    }
+]
+
+
+def test_regions_tree_is_lazy_cached_on_disk_and_indexed():
+    cache_path = os.path.join(_tmp_dir, "regions.json")
+    session = FakeSession(lambda method, url, body: FakeResponse(200, REGIONS_TREE))
+    make_client = lambda: YandexWordstatConnector(
+        "token",
+        session=session,
+        rate_limiter=RateLimiter(rps=1000, burst=10),
+        regions_cache_path=cache_path,
+    )
+
+    client = make_client()
+    assert session.calls == []
+    assert [r["value"] for r in client.get_regions()] == ["225", "1", "213", "2"]
+    assert client.validate_regions([213, 2])
+    assert not client.validate_regions([213, 999])
+    assert client.region_label(213) == "Москва"
+    assert client.regions_index.parent[213] == 1
+    assert client.regions_index.descendants(225) == {1, 213, 2}
+
+    # второй коннектор читает дерево с диска
+    assert make_client().region_label(2) == "Санкт-Петербург"
+    assert len(session.calls) == 1
+
+
+def test_sync_regions_inserts_new_and_updates_changed_labels():
+    regions = [{"value": str(1000 + i), "label": f"регион {i}"} for i in range(1500)]
+    with get_session() as session:
+        assert sync_regions(session, regions) == (1500, 0)
+        session.commit()
+
+        regions[0]["label"] = "переименован"
+        regions.append({"value": "5000", "label": "новый"})
+        assert sync_regions(session, regions) == (1, 1)
+        session.commit()
+
+        assert session.get(Region, 1000).label == "переименован"
+        assert session.get(Region, 5000).label == "новый"
+        # повторная синхронизация без изменений ничего не пишет
+        assert sync_regions(session, regions) == (0, 0)
+
+
+def test_persist_top_requests_uses_a_handful_of_statements():
+    phrases = [f"пакет {i}" for i in range(100)]
+    results = {
+        phrase: {"totalCount": 50, "topRequests": [{"phrase": f"{phrase} {j}", "count": j} for j in range(50)]}
+        for phrase in phrases
+    }
+    results["пакет 0"] = {"ошибка": "boom"}
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        with get_session() as session:
+            saved = save_top_requests_module.persist_top_requests(session, phrases, results, [213], ["desktop"])
+            session.commit()
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+
+    assert saved == 99
+    assert len(statements) <= 15
+    with get_session() as session:
+        # повторное сохранение в тот же день пропускается
+        assert save_top_requests_module.persist_top_requests(session, phrases, results, [213], ["desktop"]) == 0
+        assert session.query(TopRequestItem).join(TopRequest).filter(TopRequest.device == "desktop").count() == 99 * 50
+
+
+def test_save_dynamics_bulk_inserts_points():
+    class Connector:
+        def iter_dynamics(self, phrases, period, from_date, to_date=None, regions=None, devices=None, pause_seconds=None):
+            for phrase in phrases:
+                yield phrase, {
+                    "dynamics": [
+                        {"date": "2025-05-05", "count": 10, "share": 0.1},
+                        {"date": "2025-05-12", "count": 20, "share": 0.2},
+                    ]
+                }
+
+    save_dynamics_module.save_dynamics(
+        ["динамика 1", "динамика 2"], period="weekly", from_date="2025-05-05", regions=[54], connector=Connector()
+    )
+
+    with get_session() as session:
+        headers = session.query(Dynamics).filter(Dynamics.region_id == 54).all()
+        assert len(headers) == 2
+        assert {h.to_date.isoformat() for h in headers} == {"2025-05-12"}
+        points = session.query(DynamicsPoint).filter(DynamicsPoint.dynamics_id.in_([h.id for h in headers])).all()
+        assert sorted((p.point_date.isoformat(), p.count) for p in points) == [
+            ("2025-05-05", 10), ("2025-05-05", 10), ("2025-05-12", 20), ("2025-05-12", 20)
+        ]
+
+
+def test_persist_skips_phrases_with_malformed_numbers():
+    top_results = {
+        "битый топ": {"totalCount": 10, "topRequests": [{"phrase": "битый топ", "count": "n/a"}]},
+        "целый топ": {"totalCount": "10", "topRequests": [{"phrase": "целый топ", "count": 10}]},
+    }
+    dynamics_results = {
+        "битая динамика": {"dynamics": [{"date": "2025-05-05", "count": None, "share": 0.1}]},
+        "целая динамика": {"dynamics": [{"date": "2025-05-05", "count": "7", "share": "0.5"}]},
+    }
+    with get_session() as session:
+        assert save_top_requests_module.persist_top_requests(session, list(top_results), top_results, [57]) == 1
+        assert (
+            save_dynamics_module.persist_dynamics(
+                session, list(dynamics_results), dynamics_results, "weekly", "2025-05-05", regions=[57]
+            )
+            == 1
+        )
+        session.commit()
+
+        assert session.query(TopRequest).filter(TopRequest.region_id == 57).one().total_count == 10
+        point = session.query(DynamicsPoint).join(Dynamics).filter(Dynamics.region_id == 57).one()
+        assert (point.count, point.share) == (7, 0.5)
+
+
+def test_streaming_iterators_lift_the_batch_cap_and_commit_in_chunks():
+    session = FakeSession(top_requests_handler)
+    client = YandexWordstatConnector("token", session=session, rate_limiter=RateLimiter(rps=10000, burst=1000))
+    phrases = [f"поток {i}" for i in range(250)]
+
+    stream = client.iter_top_requests(phrases)
+    assert next(stream)[0] == "поток 0"
+    assert len(session.calls) == 1
+    with pytest.raises(ValueError):
+        client.get_top_requests_batch(phrases)
+
+    save_top_requests_module.save_top_requests(phrases, regions=[11], connector=client, chunk_size=100)
+    with get_session() as db:
+        assert db.query(TopRequest).filter(TopRequest.region_id == 11).count() == 250
+
+
+def test_async_iterator_yields_as_responses_arrive():
+    def handler(method, url, body):
+        if body["phrase"] == "медленно":
+            time.sleep(0.2)
+        return top_requests_handler(method, url, body)
+
+    async def run():
+        async with AsyncYandexWordstatConnector(
+            "token",
+            concurrency=2,
+            session=FakeSession(handler),
+            rate_limiter=RateLimiter(rps=1000, burst=100),
+        ) as client:
+            return [phrase async for phrase, _ in client.aiter_top_requests(["медленно", "a", "b", "c"])]
+
+    order = asyncio.run(run())
+    assert sorted(order) == ["a", "b", "c", "медленно"]
+    assert order[-1] == "медленно"
+
+
+def test_async_close_waits_for_in_flight_requests_without_blocking_the_loop():
+    def slow_handler(method, url, body):
+        time.sleep(0.3)
+        return top_requests_handler(method, url, body)
+
+    async def run():
+        client = AsyncYandexWordstatConnector(
+            "token", session=FakeSession(slow_handler), rate_limiter=RateLimiter(rps=1000, burst=10)
+        )
+        request = asyncio.create_task(client.get_top_requests("закрытие"))
+        await asyncio.sleep(0.05)
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while not request.done():
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(client.close(), ticker())
+        return await request, ticks
+
+    result, ticks = asyncio.run(run())
+    assert result["totalCount"] == 100
+    assert ticks > 5
+
+
+def test_task_queue_is_idempotent_and_resumable():
+    def handler(method, url, body):
+        if body["phrase"] == "сломано":
+            return FakeResponse(400, {"message": "bad phrase"})
+        return top_requests_handler(method, url, body)
+
+    session = FakeSession(handler)
+    client = YandexWordstatConnector(
+        "token", session=session, retry_policy=NO_RETRY, rate_limiter=RateLimiter(rps=10000, burst=1000)
+    )
+    phrases = [f"очередь {i}" for i in range(5)] + ["сломано"]
+    with get_session() as db:
+        assert enqueue_tasks(db, phrases, TOP_REQUESTS, {"regions": [54]}) == 6
+        assert enqueue_tasks(db, phrases, TOP_REQUESTS, {"regions": [54]}) == 0
+        db.commit()
+
+    assert run_worker("w1", claim_size=4, max_attempts=1, connector=client) == 5
+    assert len(session.calls) == 6
+    with get_session() as db:
+        assert queue_stats(db, TOP_REQUESTS) == {DONE: 5, FAILED: 1}
+        assert db.query(FetchTask).filter_by(status=FAILED).one().phrase == "сломано"
+        assert db.query(TopRequest).filter(TopRequest.region_id == 54).count() == 5
+        # повторный запуск и повторная постановка не идут в api заново
+        enqueue_tasks(db, phrases, TOP_REQUESTS, {"regions": [54]})
+        db.commit()
+        assert claim_tasks(db, "w2", 10) == []
+
+    assert run_worker("w2", connector=client) == 0
+    assert len(session.calls) == 6
+
+
+def test_worker_requeues_tasks_when_persist_fails(monkeypatch):
+    from sqlalchemy.exc import OperationalError
+
+    def broken_resolve(*args, **kwargs):
+        raise OperationalError("INSERT", {}, Exception("disk I/O error"))
+
+    client = YandexWordstatConnector(
+        "token", session=FakeSession(top_requests_handler), rate_limiter=RateLimiter(rps=10000, burst=1000)
+    )
+    phrases = ["сбой записи 1", "сбой записи 2"]
+    with get_session() as db:
+        enqueue_tasks(db, phrases, TOP_REQUESTS, {"regions": [55]})
+        db.commit()
+
+    monkeypatch.setattr(save_top_requests_module, "resolve_phrase_ids", broken_resolve)
+    with get_session() as db:
+        claimed = claim_tasks(db, "w-broken", 10)
+        db.expunge_all()
+    assert process_tasks(client, claimed, max_attempts=3) == 0
+    with get_session() as db:
+        tasks = db.query(FetchTask).filter(FetchTask.phrase.in_(phrases)).all()
+        # задания не отмечены выполненными и не висят в running до истечения аренды
+        assert {task.status for task in tasks} == {"pending"}
+        assert all("disk I/O error" in task.error for task in tasks)
+        assert db.query(TopRequest).filter(TopRequest.region_id == 55).count() == 0
+        # повтор — после паузы, а не сразу
+        assert all(task.next_attempt_at > datetime.datetime.utcnow() for task in tasks)
+        assert claim_tasks(db, "w-impatient", 10) == []
+        db.query(FetchTask).filter(FetchTask.phrase.in_(phrases)).update({"next_attempt_at": None})
+        db.commit()
+
+    monkeypatch.undo()
+    assert run_worker("w-fixed", connector=client) == 2
+    with get_session() as db:
+        assert {task.status for task in db.query(FetchTask).filter(FetchTask.phrase.in_(phrases))} == {DONE}
+
+
+def test_worker_stops_without_burning_attempts_when_quota_or_token_fails():
+    session = FakeSession(top_requests_handler)
+    client = YandexWordstatConnector(
+        "token", session=session, rate_limiter=RateLimiter(rps=10000, burst=1000, daily_limit=2)
+    )
+    phrases = [f"квота {i}" for i in range(6)]
+    with get_session() as db:
+        enqueue_tasks(db, phrases, TOP_REQUESTS, {"regions": [59]})
+        db.commit()
+
+    assert run_worker("w-quota", claim_size=4, connector=client) == 2
+    assert len(session.calls) == 2
+
+    def quota_tasks(db):
+        return db.query(FetchTask).filter(FetchTask.phrase.in_(phrases)).all()
+
+    with get_session() as db:
+        tasks = quota_tasks(db)
+        assert sorted(task.status for task in tasks) == [DONE] * 2 + ["pending"] * 4
+        # недошедшие до api задания не потратили попытку и забираются сразу
+        assert {task.attempts for task in tasks if task.status != DONE} == {0}
+        # из забранной пачки (claim_size=4) до api не дошли два задания, остальные не забирались
+        assert sum("лимит" in (task.error or "") for task in tasks) == 2
+
+    # непринятый токен тоже останавливает воркер после первого же ответа
+    denied = FakeSession(lambda method, url, body: FakeResponse(401, {"message": "bad token"}))
+    client = YandexWordstatConnector(
+        "token", session=denied, retry_policy=NO_RETRY, rate_limiter=RateLimiter(rps=10000, burst=1000)
+    )
+    assert run_worker("w-denied", connector=client) == 0
+    assert len(denied.calls) == 1
+    with get_session() as db:
+        assert {(task.status, task.attempts) for task in quota_tasks(db) if task.status != DONE} == {("pending", 0)}
+        db.query(FetchTask).filter(FetchTask.phrase.in_(phrases)).delete()
+        db.commit()
+
+
+def test_fanout_stores_each_cell_with_its_dimensions():
+    cells = list(plan_requests(["a", "b", "a"], regions=[301, 302], devices=["phone", "tablet"]))
+    assert len(cells) == 8
+    assert cells[0] == ("a", (301,), ("phone",))
+
+    # регионы разбиваются по ячейкам, единственное устройство остается фильтром ячейки
+    session = FakeSession(top_requests_handler)
+    client = AsyncYandexWordstatConnector(
+        "token", concurrency=4, session=session, rate_limiter=RateLimiter(rps=10000, burst=1000)
+    )
+    saved = save_top_requests_matrix(
+        ["матрица 1", "матрица 2"],
+        regions=[301, 302, 303],
+        devices=["phone"],
+        split_devices=False,
+        connector=client,
+        chunk_size=4,
+    )
+    # сумма по нескольким устройствам неотличима в бд от запроса без фильтра — не сохраняется
+    with pytest.raises(ValueError):
+        save_top_requests_matrix(
+            ["матрица 3"], regions=[301], devices=["phone", "tablet"], split_devices=False, connector=client
+        )
+    asyncio.run(client.close())
+
+    assert saved == 6
+    assert len(session.calls) == 6
+    assert all(call["json"]["devices"] == ["phone"] for call in session.calls)
+    assert all(len(call["json"]["regions"]) == 1 for call in session.calls)
+    with get_session() as db:
+        rows = db.query(TopRequest.region_id, TopRequest.device).filter(
+            TopRequest.region_id.in_([301, 302, 303])
+        )
+        assert sorted(rows) == [(r, "phone") for r in (301, 301, 302, 302, 303, 303)]
+
+
+
+def test_persist_rejects_combined_filters_before_any_request():
+    results = {"комбо": {"totalCount": 1, "topRequests": []}}
+    with get_session() as db:
+        with pytest.raises(ValueError, match="regions"):
+            save_top_requests_module.persist_top_requests(db, list(results), results, regions=[301, 302])
+        with pytest.raises(ValueError, match="devices"):
+            enqueue_tasks(db, ["комбо"], TOP_REQUESTS, {"devices": ["phone", "tablet"]})
+
+    session = FakeSession(top_requests_handler)
+    client = YandexWordstatConnector("token", session=session, rate_limiter=RateLimiter(rps=10000, burst=1000))
+    with pytest.raises(ValueError):
+        save_dynamics_module.save_dynamics(
+            ["комбо"], period="weekly", from_date="2025-05-05", devices=["phone", "desktop"], connector=client
+        )
+    with pytest.raises(ValueError):
+        save_top_requests_module.save_top_requests(["комбо"], regions=[301, 302], connector=client)
+    assert session.calls == []
+    # повтор одного и того же значения — все еще одиночный фильтр
+    with get_session() as db:
+        assert save_top_requests_module.persist_top_requests(db, list(results), results, regions=[304, 304]) == 1
+        db.commit()
+
+def test_incremental_dynamics_fetches_only_the_tail_and_merges_points():
+    class SeriesConnector:
+        def __init__(self):
+            self.series = {"2025-06-02": 10, "2025-06-09": 20}
+            self.from_dates = []
+
+        def iter_dynamics(self, phrases, period, from_date, to_date=None, regions=None, devices=None, pause_seconds=None):
+            self.from_dates.append(from_date)
+            points = [{"date": d, "count": c, "share": 0.1} for d, c in self.series.items() if d >= from_date]
+            for phrase in phrases:
+                yield phrase, {"dynamics": points}
+
+    connector = SeriesConnector()
+    run = lambda: save_dynamics_module.save_dynamics(
+        ["дозагрузка"], period="weekly", from_date="2025-06-02", regions=[77],
+        connector=connector, incremental=True,
+    )
+    run()
+    # последняя неделя была неполной, добавилась новая
+    connector.series.update({"2025-06-09": 25, "2025-06-16": 30})
+    run()
+    assert connector.from_dates == ["2025-06-02", "2025-06-09"]
+
+    with get_session() as db:
+        headers = db.query(Dynamics).filter(Dynamics.region_id == 77).all()
+        assert len(headers) == 1
+        assert headers[0].to_date.isoformat() == "2025-06-16"
+        points = db.query(DynamicsPoint).filter(DynamicsPoint.dynamics_id == headers[0].id)
+        assert sorted((p.point_date.isoformat(), p.count) for p in points) == [
+            ("2025-06-02", 10), ("2025-06-09", 25), ("2025-06-16", 30)
+        ]
+
+
+def test_duplicate_phrases_and_concurrent_requests_share_one_call():
+    def slow_handler(method, url, body):
+        time.sleep(0.1)
+        return top_requests_handler(method, url, body)
+
+    session = FakeSession(slow_handler)
+    client = YandexWordstatConnector("token", session=session, rate_limiter=RateLimiter(rps=10000, burst=1000))
+
+    batch = client.get_top_requests_batch(["Котики", "  котики ", "собаки", "КОТИКИ"])
+    assert len(session.calls) == 2
+    # нормализация — только для ключа склейки, в api уходит фраза как ее написали
+    assert [call["json"]["phrase"] for call in session.calls] == ["Котики", "собаки"]
+    assert set(batch) == {"Котики", "  котики ", "собаки", "КОТИКИ"}
+    assert batch["КОТИКИ"] is batch["Котики"]
+
+    threads = [threading.Thread(target=client.get_top_requests, args=("хомяки",)) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(session.calls) == 3
+
+    async def run():
+        async with AsyncYandexWordstatConnector(
+            "token", concurrency=4, session=session, rate_limiter=RateLimiter(rps=10000, burst=1000)
+        ) as async_client:
+            return await async_client.get_top_requests_batch(["Рыбки", "рыбки", "рыбки  "])
+
+    results = asyncio.run(run())
+    assert len(session.calls) == 4
+    assert len(results) == 3 and all("ошибка" not in r for r in results.values())
+
+    # разные написания одной фразы — одна строка search_phrases и одна выборка, без копий данных
+    with get_session() as db:
+        saved = save_top_requests_module.persist_top_requests(db, list(batch), batch, regions=[67])
+        db.commit()
+        assert saved == 2
+        stored = db.query(SearchPhrase.phrase).join(TopRequest).filter(TopRequest.region_id == 67)
+        assert sorted(phrase for (phrase,) in stored) == ["котики", "собаки"]
+
+
+def test_export_streams_filtered_rows_to_csv(tmp_path):
+    results = {
+        phrase: {"totalCount": 5, "topRequests": [{"phrase": f"{phrase} {i}", "count": i} for i in range(3)]}
+        for phrase in ("выгрузка 1", "выгрузка 2")
+    }
+    with get_session() as db:
+        save_top_requests_module.persist_top_requests(db, list(results), results, regions=[88])
+        db.commit()
+
+    path = str(tmp_path / "top.csv.gz")
+    filters = ExportFilters(phrases=["выгрузка 1", "нет такой"], regions=[88])
+    assert export_table("top_requests", path, filters=filters, batch_size=2) == 3
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    assert [(r["phrase"], r["region_id"], r["item_phrase"]) for r in rows] == [
+        ("выгрузка 1", "88", f"выгрузка 1 {i}") for i in range(3)
+    ]
+    assert export_table("top_requests", str(tmp_path / "none.csv"), filters=ExportFilters(regions=[89])) == 0
+
+
+def test_analytics_vectorized_series_operations():
+    pd = pytest.importorskip("pandas")
+    import analytics
+
+    results = {
+        "аналитика рост": {"dynamics": [{"date": d, "count": c, "share": 0.1} for d, c in
+                                         (("2025-03-03", 10), ("2025-03-10", 20), ("2025-03-17", 40))]},
+        "аналитика спад": {"dynamics": [{"date": d, "count": c, "share": 0.3} for d, c in
+                                         (("2025-03-03", 30), ("2025-03-10", 30), ("2025-03-17", 15))]},
+    }
+    with get_session() as db:
+        save_dynamics_module.persist_dynamics(db, list(results), results, "weekly", "2025-03-03", regions=[66])
+        db.commit()
+
+    series = analytics.load_series(list(results), period="weekly", region_id=66)
+    counts = analytics.to_matrix(series)
+    assert counts.shape == (3, 2)
+
+    wow = analytics.week_over_week(counts)
+    assert wow["аналитика рост"].tolist()[1:] == [1.0, 1.0]
+    assert wow["аналитика спад"].iloc[-1] == -0.5
+    assert analytics.rolling_mean(counts, window=2)["аналитика рост"].iloc[-1] == 30
+    assert analytics.normalize_share(counts).sum(axis=1).round(6).eq(1).all()
+    assert list(analytics.top_movers(counts, n=1).index) == ["аналитика рост"]
+    season = analytics.seasonality_index(counts)
+    assert season.loc[3].round(6).eq(1).all()
+
+
+def test_daily_dynamics_keep_weekly_and_monthly_rollups_up_to_date():
+    from rollups import load_rollups
+
+    def daily(days):
+        return {"dynamics": [{"date": d, "count": c, "share": 0.5} for d, c in days]}
+
+    # 2025-03-30 — воскресенье, конец марта; 03-31 и 04-01 — следующая неделя
+    with get_session() as db:
+        save_dynamics_module.persist_dynamics(
+            db, ["агрегаты"], {"агрегаты": daily([("2025-03-30", 1), ("2025-03-31", 2), ("2025-04-01", 4)])},
+            "daily", "2025-03-30", regions=[55],
+        )
+        db.commit()
+        # повторная загрузка дня и новый день не задваивают агрегаты
+        save_dynamics_module.persist_dynamics(
+            db, ["агрегаты"], {"агрегаты": daily([("2025-04-01", 5), ("2025-04-02", 10)])},
+            "daily", "2025-04-01", regions=[55], merge=True,
+        )
+        db.commit()
+
+        weekly = load_rollups(db, ["агрегаты"], "weekly", region_id=55, complete_only=False)["агрегаты"]["dynamics"]
+        monthly = load_rollups(db, ["агрегаты"], "monthly", region_id=55, complete_only=False)["агрегаты"]["dynamics"]
+        # по умолчанию неполные недели и месяцы не отдаются
+        assert load_rollups(db, ["агрегаты"], "weekly", region_id=55) == {}
+
+        week = [(f"2025-04-{day:02d}", 1) for day in range(7, 14)]
+        save_dynamics_module.persist_dynamics(
+            db, ["агрегаты"], {"агрегаты": daily(week)}, "daily", "2025-04-07", regions=[55], merge=True,
+        )
+        db.commit()
+        complete = load_rollups(db, ["агрегаты"], "weekly", region_id=55)["агрегаты"]["dynamics"]
+    assert [(p["date"], p["count"]) for p in weekly] == [("2025-03-24", 1), ("2025-03-31", 17)]
+    assert [(p["date"], p["count"]) for p in monthly] == [("2025-03-01", 3), ("2025-04-01", 15)]
+    assert [(p["days"], p["complete"]) for p in weekly] == [(1, False), (3, False)]
+    assert weekly[1]["share"] == pytest.approx(0.5)
+    assert [(p["date"], p["count"], p["days"]) for p in complete] == [("2025-04-07", 7, 7)]
+
+
+def test_phrase_search_finds_substrings_with_ranking_and_pages():
+    from phrase_search import search_items
+
+    items = ["Доставка суши", "доставки пиццы на дом", "суши сет", "ДОСТАВКА ЕДЫ ночью", "ёлка с доставкой"]
+    results = {"поиск": {"totalCount": 1, "topRequests": [{"phrase": p, "count": i + 1} for i, p in enumerate(items)]}}
+    with get_session() as db:
+        save_top_requests_module.persist_top_requests(db, ["поиск"], results, regions=[44])
+        db.commit()
+
+        found = {hit.phrase for hit in search_items(db, "доставк", limit=10)}
+        assert found == {"Доставка суши", "доставки пиццы на дом", "ДОСТАВКА ЕДЫ ночью", "ёлка с доставкой"}
+        assert [hit.phrase for hit in search_items(db, "суши доставка")] == ["Доставка суши"]
+        assert [hit.phrase for hit in search_items(db, "елка")] == ["ёлка с доставкой"]
+        assert [hit.phrase for hit in search_items(db, "на доставк")] == ["доставки пиццы на дом"]
+
+        first = search_items(db, "доставк", limit=2)
+        second = search_items(db, "доставк", limit=2, offset=2)
+        assert len(first) == len(second) == 2
+        assert not {h.item_id for h in first} & {h.item_id for h in second}
+
+
+def test_phrase_search_falls_back_to_like_on_other_dialects(monkeypatch):
+    import phrase_search
+
+    monkeypatch.setattr(phrase_search, "dialect_name", lambda session: "mysql")
+    results = {"без fts": {"totalCount": 1, "topRequests": [{"phrase": "резервная ёлка", "count": 3}]}}
+    with get_session() as db:
+        save_top_requests_module.persist_top_requests(db, ["без fts"], results, regions=[46])
+        db.commit()
+        hits = phrase_search.search_items(db, "резервная ел")
+    assert [(hit.phrase, hit.rank) for hit in hits] == [("резервная ёлка", 0.0)]
+
+
+def test_generic_upsert_handles_composite_keys(monkeypatch):
+    import db_utils
+    from sqlalchemy import select as sa_select
+
+    # на диалектах без ON CONFLICT upsert идет через select существующих ключей и update
+    monkeypatch.setattr(db_utils, "_dialect_insert", lambda dialect: None)
+    with get_session() as db:
+        save_dynamics_module.persist_dynamics(
+            db, ["без on conflict"], {"без on conflict": {"dynamics": [{"date": "2030-01-01", "count": 5, "share": 0.1}]}},
+            "weekly", "2030-01-01", regions=[45],
+        )
+        dynamics_id = db.query(Dynamics.id).filter(Dynamics.region_id == 45).one()[0]
+        rows = [
+            {"dynamics_id": dynamics_id, "point_date": date, "count": count, "share": 0.1}
+            for date, count in ((datetime.date(2030, 1, 1), 1), (datetime.date(2030, 1, 2), 2))
+        ]
+        db_utils.upsert_rows(db, DynamicsPoint, rows, ["dynamics_id", "point_date"], ["count"])
+        rows[1]["count"] = 20
+        rows.append({"dynamics_id": dynamics_id, "point_date": datetime.date(2030, 1, 3), "count": 3, "share": 0.1})
+        db_utils.upsert_rows(db, DynamicsPoint, rows, ["dynamics_id", "point_date"], ["count"])
+        stored = db.execute(
+            sa_select(DynamicsPoint.count)
+            .where(DynamicsPoint.dynamics_id == dynamics_id)
+            .order_by(DynamicsPoint.point_date)
+        ).scalars().all()
+        db.rollback()
+    assert stored == [1, 20, 3]
+
+
+def test_connector_against_local_fake_server():
+    with FakeWordstatServer(token="secret", quota_rps=3, retry_after=1) as server:
+        options = dict(base_url=server.base_url, rate_limiter=RateLimiter(rps=1000, burst=100), regions_cache_path=None)
+        with pytest.raises(WordstatAuthError):
+            YandexWordstatConnector("wrong", **options).get_top_requests("котики")
+
+        with YandexWordstatConnector("secret", **options) as client:
+            assert client.region_label(213) == "Москва"
+            top = client.get_top_requests("котики", regions=[2], devices=["desktop"])
+            assert top == client.get_top_requests("котики", regions=[2], devices=["desktop"])
+            # четвертый запрос за секунду получает 429 и повторяется после Retry-After
+            dynamics = client.get_dynamics("купить ноутбук", "weekly", "2024-02-05", "2024-04-07", regions=[213])
+
+    assert len(top["topRequests"]) == 50
+    assert [p["date"] for p in dynamics["dynamics"]][:2] == ["2024-02-05", "2024-02-12"]
+    assert server.stats[("/v1/dynamics", 429)] == 1
+    assert server.stats[("/v1/dynamics", 200)] == 1
+
+
+def test_connector_hooks_report_attempts_retries_and_cache_hits(monkeypatch):
+    responses = [
+        FakeResponse(429, {"error": "quota"}, headers={"Retry-After": "1"}),
+        FakeResponse(200, {"totalCount": 5, "topRequests": []}),
+    ]
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    registry = MetricsRegistry()
+    batch = BatchSummary()
+
+    def broken_hook(event):
+        raise RuntimeError("сбой хука")
+
+    client = YandexWordstatConnector(
+        "token",
+        session=FakeSession(lambda method, url, body: responses.pop(0)),
+        rate_limiter=RateLimiter(rps=1000, burst=10),
+        cache=ResponseCache(),
+        hooks=[batch, PrometheusHook(registry), broken_hook],
+    )
+    client.get_top_requests("котики")
+    client.get_top_requests("котики")
+
+    summary = batch.summary()
+    assert summary["http_requests"] == 2
+    assert summary["quota_errors"] == 1
+    assert summary["retries"] == 1
+    assert summary["cache_hits"] == 1
+    assert summary["bytes_received"] > 0
+    assert [e.attempt for e in batch.events if not e.cache_hit] == [0, 1]
+
+    text = registry.render()
+    assert 'wordstat_requests_total{endpoint="/v1/topRequests",status="200"} 1' in text
+    assert 'wordstat_requests_total{endpoint="/v1/topRequests",status="429"} 1' in text
+    assert 'wordstat_retries_total{endpoint="/v1/topRequests"} 1' in text
+    assert 'wordstat_cache_hits_total{endpoint="/v1/topRequests"} 1' in text
+    assert 'wordstat_request_duration_seconds_count{endpoint="/v1/topRequests"} 2' in text
+
+
+def test_save_pipeline_feeds_batch_summary_with_http_and_db_time():
+    client = YandexWordstatConnector(
+        "token", session=FakeSession(top_requests_handler), rate_limiter=RateLimiter(rps=1000, burst=10)
+    )
+    batch = BatchSummary()
+    events = []
+    save_top_requests_module.save_top_requests(
+        ["сводка 1", "сводка 2", "сводка 3"], regions=[56], connector=client, chunk_size=2, hooks=[events.append], summary=batch
+    )
+
+    summary = batch.summary()
+    assert summary["http_requests"] == len(events) == 3
+    assert summary["db_seconds"] > 0
+    # хуки снимаются после запуска
+    assert client.hooks == []
+
+
+def test_json_logging_through_queue_with_module_levels_and_sampling():
+    stream = io.StringIO()
+    configure_logging(
+        fmt="json",
+        use_queue=True,
+        levels={"test_logs_quiet": "WARNING"},
+        sampling={"test_logs_noisy": 0.0},
+        stream=stream,
+    )
+    try:
+        get_logger("test_logs").info("фраза %s: %d строк", "котики", 3, extra={"phrase": "котики"})
+        get_logger("test_logs_quiet").info("не должно попасть в лог")
+        noisy = get_logger("test_logs_noisy")
+        noisy.info("отбрасывается сэмплированием")
+        noisy.warning("предупреждения пишутся всегда")
+        # аргументы подставляются при записи в очередь: последующие изменения в лог не попадают
+        batch = ["котики"]
+        get_logger("test_logs").info("пачка: %s", batch)
+        batch.append("собаки")
+        try:
+            raise ValueError("сбой")
+        except ValueError:
+            get_logger("test_logs").exception("ошибка сохранения")
+        stop_logging()
+    finally:
+        configure_logging()
+
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [r["message"] for r in records] == [
+        "фраза котики: 3 строк",
+        "предупреждения пишутся всегда",
+        "пачка: ['котики']",
+        "ошибка сохранения",
+    ]
+    assert "ValueError: сбой" in records[3]["exc_info"]
+    assert records[0]["phrase"] == "котики"
+    assert records[0]["logger"] == "test_logs"
+    assert records[1]["level"] == "WARNING"
+
+
+def test_profiling_reports_stages_sql_and_http(tmp_path, monkeypatch):
+    monkeypatch.setenv("WORDSTAT_PROFILE", "1")
+    monkeypatch.setenv("WORDSTAT_PROFILE_DIR", str(tmp_path))
+    client = YandexWordstatConnector(
+        "token", session=FakeSession(top_requests_handler), rate_limiter=RateLimiter(rps=1000, burst=10)
+    )
+    save_top_requests_module.save_top_requests(["профиль 1", "профиль 2", "профиль 3"], regions=[54], connector=client)
+    save_top_requests_module.save_top_requests(["профиль 4"], regions=[54], connector=client, profile=False)
+
+    reports = sorted(tmp_path.glob("save_top_requests-*.json"))
+    assert len(reports) == 1
+    report = json.loads(reports[0].read_text(encoding="utf-8"))
+    assert set(report["stages"]) == {"fetch", "persist", "commit"}
+    assert report["http"]["requests"] == 3
+    assert report["sql"]["statements"] == sum(stage["statements"] for stage in report["stages"].values())
+    assert report["sql"]["by_kind"]["INSERT"] > 0
+    assert report["stages"]["persist"]["statements"] > 0
+    # хук профиля снимается после запуска
+    assert client.hooks == []
+
+
+def test_engine_profiles_apply_sqlite_pragmas_and_postgres_pool(tmp_path, monkeypatch):
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+
+    plain = create_db_engine(f"sqlite:///{tmp_path / 'plain.db'}", profile="plain")
+    with plain.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "delete"
+    plain.dispose()
+
+    monkeypatch.setenv("DB_POOL_SIZE", "4")
+    options, pragmas = engine_options("postgresql://user@localhost/wordstat", "concurrent")
+    assert options["pool_pre_ping"] is True
+    assert options["pool_size"] == 4
+    assert pragmas == {}
+    with pytest.raises(ValueError):
+        engine_options("sqlite://", "fastest")
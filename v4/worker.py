@@ -0,0 +1,263 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from db_setup import get_session, init_db
+from models import FetchTask
+from rate_limiter import DailyQuotaExceeded, RateLimiter
+from retry_policy import WordstatAuthError
+from save_dynamics import persist_dynamics
+from save_top_requests import persist_top_requests
+from task_queue import (
+    DEFAULT_LEASE_SECONDS,
+    DEFAULT_MAX_ATTEMPTS,
+    DEFAULT_RETRY_DELAY,
+    DYNAMICS,
+    ENDPOINTS,
+    TOP_REQUESTS,
+    claim_tasks,
+    complete_tasks,
+    enqueue_tasks,
+    fail_task,
+    queue_stats,
+    release_tasks,
+)
+from yandex_wordstat_connector_v4 import YandexWordstatConnector
+from logger import get_logger
+
+from dotenv import load_dotenv
+
+load_dotenv()
+TOKEN = os.getenv("YANDEX_WORDSTAT_TOKEN")
+
+logger = get_logger(__name__)
+
+DEFAULT_CLAIM_SIZE = 50  # заданий, которые воркер забирает за раз
+
+
+class WorkerStopped(Exception):
+    # дальше разбирать очередь нет смысла: квота на сегодня кончилась или токен не принят
+    def __init__(self, cause: Exception, done: int):
+        super().__init__(str(cause))
+        self.cause = cause
+        self.done = done
+
+
+# после этих ошибок упадут и все следующие запросы, поэтому задания не тратят на них попытки
+STOP_ERRORS = (DailyQuotaExceeded, WordstatAuthError)
+
+
+def _fetch(
+    connector: YandexWordstatConnector, endpoint: str, phrases: List[str], params: dict
+) -> Tuple[Dict[str, dict], Optional[Exception]]:
+    # ошибка по фразе становится ее результатом, а на STOP_ERRORS загрузка обрывается:
+    # фразы без результата вернутся в очередь
+    request = connector.get_top_requests if endpoint == TOP_REQUESTS else connector.get_dynamics
+    results: Dict[str, dict] = {}
+    for phrase in phrases:
+        try:
+            results[phrase] = request(phrase, **params)
+        except STOP_ERRORS as e:
+            return results, e
+        except Exception as e:
+            results[phrase] = {"ошибка": str(e)}
+    return results, None
+
+
+def _persist(session, endpoint: str, phrases: List[str], results: Dict[str, dict], params: dict) -> int:
+    # ошибки бд не глотаются: их откат снимает и отметки заданий, это решает _complete_group
+    if endpoint == TOP_REQUESTS:
+        return persist_top_requests(
+            session, phrases, results, params.get("regions"), params.get("devices"), raise_errors=True
+        )
+    return persist_dynamics(
+        session,
+        phrases,
+        results,
+        params["period"],
+        params["from_date"],
+        params.get("to_date"),
+        params.get("regions"),
+        params.get("devices"),
+        raise_errors=True,
+    )
+
+
+def _complete_group(
+    endpoint: str,
+    params: dict,
+    group: List[FetchTask],
+    results: Dict[str, dict],
+    max_attempts: int,
+    retry_delay: float,
+) -> int:
+    # в одной транзакции запись результатов и отметка о выполнении — повторный запуск не задвоит данные
+    errors: Dict[int, str] = {}
+    for task in group:
+        result = results.get(task.phrase) or {"ошибка": "нет ответа"}
+        if "ошибка" in result:
+            errors[task.id] = str(result["ошибка"])
+    succeeded = [task for task in group if task.id not in errors]
+
+    with get_session() as session:
+        try:
+            for task in group:
+                if task.id in errors:
+                    fail_task(session, task, errors[task.id], max_attempts, retry_delay)
+            owned = set(complete_tasks(session, succeeded))
+            phrases = [task.phrase for task in succeeded if task.id in owned]
+            if phrases:
+                _persist(session, endpoint, phrases, results, params)
+            session.commit()
+        except SQLAlchemyError as db_err:
+            # откат убрал и отметки о выполнении: вся пачка возвращается в очередь
+            # (или падает по исчерпании попыток) уже в новой транзакции
+            session.rollback()
+            logger.error("воркер: ошибка бд при записи %s заданий: %s", len(group), db_err)
+            for task in group:
+                fail_task(session, task, errors.get(task.id) or f"ошибка бд: {db_err}", max_attempts, retry_delay)
+            session.commit()
+            return 0
+    return len(phrases)
+
+
+def process_tasks(
+    connector: YandexWordstatConnector,
+    tasks: List[FetchTask],
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    retry_delay: float = DEFAULT_RETRY_DELAY,
+) -> int:
+    # задания с одинаковыми параметрами идут одной пачкой: загрузка, затем запись и отметки;
+    # на STOP_ERRORS незагруженные задания отпускаются без траты попытки и поднимается WorkerStopped
+    groups: Dict[Tuple[str, str], List[FetchTask]] = defaultdict(list)
+    for task in tasks:
+        groups[(task.endpoint, task.params)].append(task)
+
+    done = 0
+    pending = list(groups.items())
+    while pending:
+        (endpoint, params_json), group = pending.pop(0)
+        params = json.loads(params_json)
+        results, stop = _fetch(connector, endpoint, [task.phrase for task in group], params)
+        fetched = [task for task in group if task.phrase in results]
+        if fetched:
+            done += _complete_group(endpoint, params, fetched, results, max_attempts, retry_delay)
+        if stop is not None:
+            untouched = [task for task in group if task.phrase not in results]
+            untouched += [task for _, rest in pending for task in rest]
+            with get_session() as session:
+                release_tasks(session, untouched, str(stop))
+                session.commit()
+            raise WorkerStopped(stop, done)
+    return done
+
+
+def run_worker(
+    worker_id: Optional[str] = None,
+    claim_size: int = DEFAULT_CLAIM_SIZE,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    connector: Optional[YandexWordstatConnector] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+    wait_for_tasks: bool = False,
+    poll_interval: float = 5.0,
+    retry_delay: float = DEFAULT_RETRY_DELAY,
+) -> int:
+    # разбирает очередь, пока она не опустеет (или ждет новых заданий при wait_for_tasks);
+    # кончилась дневная квота или не принят токен — останавливается, задания остаются в очереди
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    own_connector = connector is None
+    if own_connector:
+        if not TOKEN:
+            raise RuntimeError("не найден токен YANDEX_WORDSTAT_TOKEN в .env")
+        connector = YandexWordstatConnector(TOKEN, rate_limiter=rate_limiter)
+
+    processed = 0
+    try:
+        while True:
+            with get_session() as session:
+                tasks = claim_tasks(session, worker_id, claim_size, lease_seconds)
+                session.expunge_all()
+            if not tasks:
+                if not wait_for_tasks:
+                    break
+                time.sleep(poll_interval)
+                continue
+            try:
+                processed += process_tasks(connector, tasks, max_attempts, retry_delay)
+            except WorkerStopped as stopped:
+                processed += stopped.done
+                logger.error("воркер %s остановлен: %s; выполнено заданий — %s", worker_id, stopped, processed)
+                break
+            logger.info("воркер %s: выполнено заданий — %s", worker_id, processed)
+    finally:
+        if own_connector:
+            connector.close()
+    return processed
+
+
+def _read_phrases(path: str) -> List[str]:
+    stream = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    with stream:
+        text = stream.read()
+    return [phrase.strip() for line in text.splitlines() for phrase in line.split(",") if phrase.strip()]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="очередь заданий Wordstat в базе данных")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    enqueue = commands.add_parser("enqueue", help="поставить фразы в очередь")
+    enqueue.add_argument("endpoint", choices=ENDPOINTS)
+    enqueue.add_argument("phrases_file", help="файл с фразами (через запятую или по строкам), '-' — stdin")
+    enqueue.add_argument("--regions", type=int, nargs="*")
+    enqueue.add_argument("--devices", nargs="*")
+    enqueue.add_argument("--period", choices=["daily", "weekly", "monthly"])
+    enqueue.add_argument("--from-date")
+    enqueue.add_argument("--to-date")
+
+    run = commands.add_parser("run", help="разбирать очередь")
+    run.add_argument("--worker-id")
+    run.add_argument("--claim-size", type=int, default=DEFAULT_CLAIM_SIZE)
+    run.add_argument("--lease-seconds", type=float, default=DEFAULT_LEASE_SECONDS)
+    run.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS)
+    run.add_argument("--retry-delay", type=float, default=DEFAULT_RETRY_DELAY, help="секунд до первого повтора")
+    run.add_argument("--wait", action="store_true", help="не завершаться на пустой очереди")
+
+    commands.add_parser("stats", help="состояние очереди")
+
+    args = parser.parse_args()
+    init_db()
+
+    if args.command == "enqueue":
+        params = {"regions": args.regions, "devices": args.devices}
+        if args.endpoint == DYNAMICS:
+            if not args.period or not args.from_date:
+                parser.error("для dynamics нужны --period и --from-date")
+            params.update(period=args.period, from_date=args.from_date, to_date=args.to_date)
+        with get_session() as session:
+            enqueue_tasks(session, _read_phrases(args.phrases_file), args.endpoint, params)
+            session.commit()
+    elif args.command == "run":
+        run_worker(
+            worker_id=args.worker_id,
+            claim_size=args.claim_size,
+            lease_seconds=args.lease_seconds,
+            max_attempts=args.max_attempts,
+            retry_delay=args.retry_delay,
+            wait_for_tasks=args.wait,
+        )
+    else:
+        with get_session() as session:
+            print(queue_stats(session))
+
+
+if __name__ == "__main__":
+    main()
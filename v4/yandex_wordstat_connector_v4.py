@@ -1,23 +1,189 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import dotenv_values
-from typing import Optional, List, Dict, Any
+from typing import (
+    Optional,
+    List,
+    Dict,
+    Any,
+    Tuple,
+    Union,
+    Awaitable,
+    AsyncIterator,
+    Callable,
+    Iterable,
+    Iterator,
+)
 import time
 
 from logger import get_logger
+from metrics import RequestEvent
+from rate_limiter import RateLimiter, get_default_rate_limiter
+from regions_index import (
+    RegionsIndex,
+    load_regions_tree,
+    DEFAULT_REGIONS_CACHE_PATH,
+    DEFAULT_REGIONS_TTL,
+)
+from response_cache import (
+    ResponseCache,
+    TOP_REQUESTS_ENDPOINT,
+    DYNAMICS_ENDPOINT,
+    make_cache_key,
+    normalize_phrase,
+)
+from retry_policy import (
+    RetryPolicy,
+    WordstatError,
+    WordstatAuthError,
+    WordstatQuotaError,
+    WordstatTransientError,
+    WordstatClientError,
+    error_from_status,
+)
 
 logger = get_logger(__name__)
 
-MAX_REQUESTS_PER_RUN = 100  # ограничение на число фраз за раз
+MAX_REQUESTS_PER_RUN = 100  # ограничение на число фраз в get_*_batch, длинные списки — через iter_*
+
+BASE_URL = "https://api.wordstat.yandex.net"
+DEFAULT_POOL_SIZE = 10  # сколько соединений держим открытыми к api
+DEFAULT_TIMEOUT = (5.0, 60.0)  # (connect, read) в секундах
+DEFAULT_CONCURRENCY = 5  # сколько запросов асинхронный коннектор держит в полете
+DEDUP_WINDOW = 1000  # сколько последних результатов iter_* помнит для повторов во входном потоке
+
+RequestHook = Callable[[RequestEvent], None]
+
+
+def create_http_session(
+    pool_size: int = DEFAULT_POOL_SIZE, keep_alive: bool = True
+) -> requests.Session:
+    # одна сессия на коннектор: tcp/tls соединения переиспользуются между запросами
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if not keep_alive:
+        session.headers["Connection"] = "close"
+    return session
+
+
+def _top_requests_payload(
+    phrase: str,
+    regions: Optional[List[int]] = None,
+    devices: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    json_data = {"phrase": phrase}
+    if regions:
+        json_data["regions"] = regions
+    if devices:
+        json_data["devices"] = devices
+    return json_data
+
+
+def _dynamics_payload(
+    phrase: str,
+    period: str,
+    from_date: str,
+    to_date: Optional[str] = None,
+    regions: Optional[List[int]] = None,
+    devices: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    json_data = {
+        "phrase": phrase,
+        "period": period,
+        "fromDate": from_date,
+    }
+    if to_date:
+        json_data["toDate"] = to_date
+    if regions:
+        json_data["regions"] = regions
+    if devices:
+        json_data["devices"] = devices
+    return json_data
+
+
+def _count_attempt(
+    error: WordstatError, quota_attempts: int, transient_attempts: int
+) -> Tuple[int, int]:
+    if isinstance(error, WordstatQuotaError):
+        return quota_attempts + 1, transient_attempts
+    return quota_attempts, transient_attempts + 1
+
+
+def _check_batch_size(phrases: List[str]) -> None:
+    if len(phrases) > MAX_REQUESTS_PER_RUN:
+        logger.error("слишком много фраз — максимум %s!", MAX_REQUESTS_PER_RUN)
+        raise ValueError(f"слишком много фраз — максимум {MAX_REQUESTS_PER_RUN}!")
 
 
 class YandexWordstatConnector:
-    def __init__(self, token: str):
-        self.base_url = "https://api.wordstat.yandex.net"
+    def __init__(
+        self,
+        token: str,
+        base_url: str = BASE_URL,
+        session: Optional[requests.Session] = None,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        keep_alive: bool = True,
+        timeout: Union[float, Tuple[float, float], None] = DEFAULT_TIMEOUT,
+        rate_limiter: Optional[RateLimiter] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        cache: Optional[ResponseCache] = None,
+        regions_cache_path: Optional[str] = DEFAULT_REGIONS_CACHE_PATH,
+        regions_ttl: float = DEFAULT_REGIONS_TTL,
+        hooks: Optional[Iterable[RequestHook]] = None,
+    ):
+        self.base_url = base_url.rstrip("/")
         self.token = token
         self.headers = {
             "Content-Type": "application/json;charset=utf-8",
             "Authorization": f"Bearer {self.token}",
         }
+        self.timeout = timeout
+        # транспорт можно подменить (например, сессией к локальному фейковому серверу),
+        # чужую сессию коннектор не закрывает
+        self._owns_session = session is None
+        self.session = session or create_http_session(pool_size, keep_alive)
+        # все коннекторы процесса по умолчанию делят одну квоту
+        self.rate_limiter = rate_limiter or get_default_rate_limiter()
+        self.retry_policy = retry_policy or RetryPolicy()
+        # кэш ответов topRequests/dynamics, по умолчанию выключен
+        self.cache = cache
+        # дерево регионов грузится лениво при первом обращении: создание коннектора сеть не трогает
+        self.regions_cache_path = regions_cache_path
+        self.regions_ttl = regions_ttl
+        self._regions_index: Optional[RegionsIndex] = None
+        self._regions_lock = threading.Lock()
+        # одинаковые запросы из разных потоков, пока первый в полете, ждут его результат
+        self._inflight: Dict[str, Future] = {}
+        self._inflight_lock = threading.Lock()
+        # метрики и трассировка: каждый хук получает RequestEvent на каждую попытку и ответ из кэша
+        self.hooks: List[RequestHook] = list(hooks or [])
+
+    def close(self) -> None:
+        if self._owns_session:
+            self.session.close()
+
+    def __enter__(self) -> "YandexWordstatConnector":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def _emit(self, event: RequestEvent) -> None:
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except Exception as e:
+                # сбой метрик не должен ронять запрос
+                logger.warning("хук метрик %r упал: %s", hook, e)
 
     def _make_request(
         self,
@@ -25,51 +191,167 @@ class YandexWordstatConnector:
         endpoint: str,
         params: Optional[Dict[str, Any]] = None,
         json_data: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        quota_attempts = transient_attempts = 0
+        while True:
+            wait_started = time.perf_counter()
+            self.rate_limiter.acquire()
+            quota_wait = time.perf_counter() - wait_started
+            try:
+                return self._send(
+                    method,
+                    endpoint,
+                    params,
+                    json_data,
+                    attempt=quota_attempts + transient_attempts,
+                    quota_wait=quota_wait,
+                )
+            except WordstatError as e:
+                delay = self.retry_policy.next_delay(e, quota_attempts, transient_attempts)
+                if delay is None:
+                    raise
+                quota_attempts, transient_attempts = _count_attempt(
+                    e, quota_attempts, transient_attempts
+                )
+                logger.warning("%s %s: %s; повтор через %.1fs", method, endpoint, e, delay)
+                time.sleep(delay)
+
+    def _send(
+        self,
+        method: str,
+        endpoint: str,
+        params: Optional[Dict[str, Any]] = None,
+        json_data: Optional[Dict[str, Any]] = None,
+        attempt: int = 0,
+        quota_wait: float = 0.0,
     ) -> Dict[str, Any]:
         url = f"{self.base_url}{endpoint}"
+        event = RequestEvent(endpoint, method, attempt=attempt, quota_wait=quota_wait)
+        started = time.perf_counter()
         try:
-            response = requests.request(
+            response = self.session.request(
                 method=method,
                 url=url,
                 headers=self.headers,
                 params=params,
                 json=json_data,
+                timeout=self.timeout,
             )
-            if response.status_code != 200:
-                logger.error(f"{method} {url} failed: ")
-                raise Exception(
-                    f"Ошибка при выполнении запроса: {response.status_code}, {response.text}"
-                )
+        except requests.exceptions.RequestException as e:
+            logger.error("Requests error during %s %s: %s", method, url, e)
+            event.latency = time.perf_counter() - started
+            event.error = type(e).__name__
+            self._emit(event)
+            raise WordstatTransientError(f"Сетевая ошибка: {e}") from e
 
-            logger.info(f"{method} {url} succeeded.")
-            return response.json()
+        event.latency = time.perf_counter() - started
+        event.status = response.status_code
+        # тело запроса уже сериализовано requests в PreparedRequest
+        event.bytes_sent = len(getattr(getattr(response, "request", None), "body", None) or b"")
+        event.bytes_received = len(response.content or b"")
+        self._emit(event)
 
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Requests error during {method} {url}: {e}")
+        if response.status_code != 200:
+            logger.error("%s %s failed: %s", method, url, response.status_code)
+            raise error_from_status(
+                response.status_code, response.text, response.headers.get("Retry-After")
+            )
+
+        logger.info("%s %s succeeded.", method, url)
+        return response.json()
+
+    def _cached_request(self, endpoint: str, json_data: Dict[str, Any]) -> Dict[str, Any]:
+        if self.cache is not None:
+            cached = self.cache.get(endpoint, json_data)
+            if cached is not None:
+                logger.info("POST %s: ответ взят из кэша", endpoint)
+                self._emit(RequestEvent(endpoint, cache_hit=True))
+                return cached
+
+        key = make_cache_key(endpoint, json_data)
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            logger.info("POST %s: такой же запрос уже выполняется, жду его ответ", endpoint)
+            started = time.perf_counter()
+            try:
+                return future.result()
+            finally:
+                self._emit(RequestEvent(endpoint, latency=time.perf_counter() - started, coalesced=True))
+
+        try:
+            result = self._make_request("POST", endpoint, json_data=json_data)
+            if self.cache is not None:
+                self.cache.set(endpoint, json_data, result)
+        except BaseException as e:
+            future.set_exception(e)
             raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+
+    def _iter_unique(
+        self,
+        phrases: Iterable[str],
+        fetch: Callable[[str], Dict[str, Any]],
+        pause_seconds: Optional[float],
+    ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        # повторы фразы (с точностью до регистра и пробелов) квоту не тратят: результат
+        # берется из последних DEDUP_WINDOW ответов и отдается под исходным написанием
+        recent: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        fetched = 0
+        for phrase in phrases:
+            key = normalize_phrase(phrase)
+            result = recent.get(key)
+            if result is not None:
+                recent.move_to_end(key)
+                yield phrase, result
+                continue
+            if pause_seconds and fetched:
+                time.sleep(pause_seconds)
+            fetched += 1
+            try:
+                result = fetch(phrase)
+            except Exception as e:
+                result = {"ошибка": str(e)}
+            recent[key] = result
+            if len(recent) > DEDUP_WINDOW:
+                recent.popitem(last=False)
+            yield phrase, result
+
+    def _fetch_regions_tree(self) -> List[Dict[str, Any]]:
+        return self._make_request("POST", "/v1/getRegionsTree", json_data={})
+
+    @property
+    def regions_index(self) -> RegionsIndex:
+        if self._regions_index is None:
+            with self._regions_lock:
+                if self._regions_index is None:
+                    tree = load_regions_tree(
+                        self._fetch_regions_tree, self.regions_cache_path, self.regions_ttl
+                    )
+                    self._regions_index = RegionsIndex(tree)
+        return self._regions_index
 
     def get_regions(self) -> List[dict[str, Any]]:
         try:
-            regions_data = self._make_request(
-                "POST", "/v1/getRegionsTree", json_data={}
-            )
+            index = self.regions_index
         except Exception as e:
-            logger.error(f"Не удалось получить регионы: {e}")
+            logger.error("Не удалось получить регионы: %s", e)
             raise
+        return index.to_flat_list()
 
-        def extract_regions(data: dict[str, Any]) -> List[dict[str, Any]]:
-            regions = []
-            if "value" in data:
-                regions.append({"value": (data["value"]), "label": (data["label"])})
-            if "children" in data and isinstance(data["children"], list):
-                for child in data["children"]:
-                    regions.extend(extract_regions(child))
-            return regions
+    def validate_regions(self, regions: Optional[List[int]]) -> bool:
+        return self.regions_index.validate(regions)
 
-        all_ids = []
-        for root in regions_data:
-            all_ids.extend(extract_regions(data=root))
-        return all_ids
+    def region_label(self, region_id: int) -> Optional[str]:
+        return self.regions_index.label(region_id)
 
     def get_top_requests(
         self,
@@ -77,12 +359,8 @@ class YandexWordstatConnector:
         regions: Optional[List[int]] = None,
         devices: Optional[List[str]] = None,
     ) -> Dict[str, Any]:
-        json_data = {"phrase": phrase}
-        if regions:
-            json_data["regions"] = regions
-        if devices:
-            json_data["devices"] = devices
-        return self._make_request("POST", "/v1/topRequests", json_data=json_data)
+        json_data = _top_requests_payload(phrase, regions, devices)
+        return self._cached_request(TOP_REQUESTS_ENDPOINT, json_data)
 
     def get_dynamics(
         self,
@@ -93,39 +371,62 @@ class YandexWordstatConnector:
         regions: Optional[List[int]] = None,
         devices: Optional[List[str]] = None,
     ) -> Dict[str, Any]:
-        json_data = {
-            "phrase": phrase,
-            "period": period,
-            "fromDate": from_date,
-        }
-        if to_date:
-            json_data["toDate"] = to_date
-        if regions:
-            json_data["regions"] = regions
-        if devices:
-            json_data["devices"] = devices
-        return self._make_request("POST", "/v1/dynamics", json_data=json_data)
+        json_data = _dynamics_payload(
+            phrase, period, from_date, to_date, regions, devices
+        )
+        return self._cached_request(DYNAMICS_ENDPOINT, json_data)
+
+    def iter_top_requests(
+        self,
+        phrases: Iterable[str],
+        regions: Optional[List[int]] = None,
+        devices: Optional[List[str]] = None,
+        pause_seconds: Optional[float] = None,
+    ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        # отдает (фраза, результат) по мере получения, без ограничения на число фраз
+        # темп запросов задает rate_limiter, pause_seconds — только дополнительная пауза между фразами
+        def fetch(phrase: str) -> Dict[str, Any]:
+            logger.info("запрашиваю топ по фразе: %s", phrase)
+            return self.get_top_requests(phrase, regions=regions, devices=devices)
+
+        return self._iter_unique(phrases, fetch, pause_seconds)
+
+    def iter_dynamics(
+        self,
+        phrases: Iterable[str],
+        period: str,
+        from_date: str,
+        to_date: Optional[str] = None,
+        regions: Optional[List[int]] = None,
+        devices: Optional[List[str]] = None,
+        pause_seconds: Optional[float] = None,
+    ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        def fetch(phrase: str) -> Dict[str, Any]:
+            logger.info("запрашиваю динамику по фразе: %s", phrase)
+            return self.get_dynamics(
+                phrase=phrase,
+                period=period,
+                from_date=from_date,
+                to_date=to_date,
+                regions=regions,
+                devices=devices,
+            )
+
+        return self._iter_unique(phrases, fetch, pause_seconds)
 
     def get_top_requests_batch(
         self,
         phrases: List[str],
         regions: Optional[List[int]] = None,
         devices: Optional[List[str]] = None,
-        pause_seconds: float = 1.0,
+        pause_seconds: Optional[float] = None,
     ) -> Dict[str, Dict[str, Any]]:
-        if len(phrases) > MAX_REQUESTS_PER_RUN:
-            logger.error(f"слишком много фраз — максимум {MAX_REQUESTS_PER_RUN}!")
-            raise ValueError(f"слишком много фраз — максимум {MAX_REQUESTS_PER_RUN}!")
-        results = {}
-        for phrase in phrases:
-            logger.info(f"запрашиваю топ по фразе: {phrase}")
-            try:
-                result = self.get_top_requests(phrase, regions=regions, devices=devices)
-                results[phrase] = result
-            except Exception as e:
-                results[phrase] = {"ошибка": str(e)}
-            time.sleep(pause_seconds)
-        return results
+        _check_batch_size(phrases)
+        return dict(
+            self.iter_top_requests(
+                phrases, regions=regions, devices=devices, pause_seconds=pause_seconds
+            )
+        )
 
     def get_dynamics_batch(
         self,
@@ -135,27 +436,20 @@ class YandexWordstatConnector:
         to_date: Optional[str] = None,
         regions: Optional[List[int]] = None,
         devices: Optional[List[str]] = None,
-        pause_seconds: float = 1.0,
+        pause_seconds: Optional[float] = None,
     ) -> Dict[str, Dict[str, Any]]:
-        if len(phrases) > MAX_REQUESTS_PER_RUN:
-            raise ValueError(f"слишком много фраз — максимум {MAX_REQUESTS_PER_RUN}!")
-        results = {}
-        for phrase in phrases:
-            logger.info(f"запрашиваю динамику по фразе: {phrase}")
-            try:
-                result = self.get_dynamics(
-                    phrase=phrase,
-                    period=period,
-                    from_date=from_date,
-                    to_date=to_date,
-                    regions=regions,
-                    devices=devices,
-                )
-                results[phrase] = result
-            except Exception as e:
-                results[phrase] = {"ошибка": str(e)}
-            time.sleep(pause_seconds)
-        return results
+        _check_batch_size(phrases)
+        return dict(
+            self.iter_dynamics(
+                phrases,
+                period=period,
+                from_date=from_date,
+                to_date=to_date,
+                regions=regions,
+                devices=devices,
+                pause_seconds=pause_seconds,
+            )
+        )
 
     def phrases_to_list(self, phrases_str: str) -> List[str]:
         phrases = []
@@ -167,24 +461,314 @@ class YandexWordstatConnector:
         return phrases
 
 
+class AsyncYandexWordstatConnector:
+    def __init__(
+        self,
+        token: str,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        base_url: str = BASE_URL,
+        session: Optional[requests.Session] = None,
+        keep_alive: bool = True,
+        timeout: Union[float, Tuple[float, float], None] = DEFAULT_TIMEOUT,
+        rate_limiter: Optional[RateLimiter] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        cache: Optional[ResponseCache] = None,
+        regions_cache_path: Optional[str] = DEFAULT_REGIONS_CACHE_PATH,
+        regions_ttl: float = DEFAULT_REGIONS_TTL,
+        hooks: Optional[Iterable[RequestHook]] = None,
+    ):
+        if concurrency < 1:
+            raise ValueError("concurrency должен быть не меньше 1")
+        self.concurrency = concurrency
+        # http выполняет синхронный коннектор в пуле потоков: пул соединений общий,
+        # а семафор не дает запустить больше concurrency запросов одновременно
+        self._sync = YandexWordstatConnector(
+            token,
+            base_url=base_url,
+            session=session,
+            pool_size=concurrency,
+            keep_alive=keep_alive,
+            timeout=timeout,
+            rate_limiter=rate_limiter,
+            retry_policy=retry_policy,
+            cache=cache,
+            regions_cache_path=regions_cache_path,
+            regions_ttl=regions_ttl,
+            hooks=hooks,
+        )
+        self.rate_limiter = self._sync.rate_limiter
+        self.retry_policy = self._sync.retry_policy
+        self.cache = cache
+        self._executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="wordstat"
+        )
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # одинаковые запросы в полете делят одну задачу (и один http-вызов)
+        self._inflight: Dict[str, "asyncio.Task[Dict[str, Any]]"] = {}
+
+    async def close(self) -> None:
+        # дожидаюсь запросов в полете в отдельном потоке, чтобы не блокировать цикл событий
+        await asyncio.to_thread(self._executor.shutdown, True)
+        self._sync.close()
+
+    async def __aenter__(self) -> "AsyncYandexWordstatConnector":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close()
+
+    async def _make_request(
+        self,
+        method: str,
+        endpoint: str,
+        params: Optional[Dict[str, Any]] = None,
+        json_data: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        quota_attempts = transient_attempts = 0
+        while True:
+            # ждем квоту до захвата семафора, чтобы не занимать слот сном
+            wait_started = time.perf_counter()
+            await self.rate_limiter.acquire_async()
+            quota_wait = time.perf_counter() - wait_started
+            try:
+                async with self._semaphore:
+                    loop = asyncio.get_running_loop()
+                    return await loop.run_in_executor(
+                        self._executor,
+                        self._sync._send,
+                        method,
+                        endpoint,
+                        params,
+                        json_data,
+                        quota_attempts + transient_attempts,
+                        quota_wait,
+                    )
+            except WordstatError as e:
+                delay = self.retry_policy.next_delay(e, quota_attempts, transient_attempts)
+                if delay is None:
+                    raise
+                quota_attempts, transient_attempts = _count_attempt(
+                    e, quota_attempts, transient_attempts
+                )
+                logger.warning("%s %s: %s; повтор через %.1fs", method, endpoint, e, delay)
+                await asyncio.sleep(delay)
+
+    async def _cached_request(self, endpoint: str, json_data: Dict[str, Any]) -> Dict[str, Any]:
+        if self.cache is not None:
+            cached = self.cache.get(endpoint, json_data)
+            if cached is not None:
+                logger.info("POST %s: ответ взят из кэша", endpoint)
+                self._sync._emit(RequestEvent(endpoint, cache_hit=True))
+                return cached
+
+        key = make_cache_key(endpoint, json_data)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._request_and_cache(endpoint, json_data))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            logger.info("POST %s: такой же запрос уже выполняется, жду его ответ", endpoint)
+            self._sync._emit(RequestEvent(endpoint, coalesced=True))
+        # shield: отмена одного ожидающего не отменяет общий запрос для остальных
+        return await asyncio.shield(task)
+
+    async def _request_and_cache(self, endpoint: str, json_data: Dict[str, Any]) -> Dict[str, Any]:
+        result = await self._make_request("POST", endpoint, json_data=json_data)
+        if self.cache is not None:
+            self.cache.set(endpoint, json_data, result)
+        return result
+
+    async def get_regions_index(self) -> RegionsIndex:
+        # загрузка дерева (с диска или из api) блокирующая, поэтому уходит в пул потоков
+        if self._sync._regions_index is not None:
+            return self._sync._regions_index
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, lambda: self._sync.regions_index
+        )
+
+    async def validate_regions(self, regions: Optional[List[int]]) -> bool:
+        return (await self.get_regions_index()).validate(regions)
+
+    async def get_regions(self) -> List[dict[str, Any]]:
+        try:
+            index = await self.get_regions_index()
+        except Exception as e:
+            logger.error("Не удалось получить регионы: %s", e)
+            raise
+        return index.to_flat_list()
+
+    async def get_top_requests(
+        self,
+        phrase: str,
+        regions: Optional[List[int]] = None,
+        devices: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
+        json_data = _top_requests_payload(phrase, regions, devices)
+        return await self._cached_request(TOP_REQUESTS_ENDPOINT, json_data)
+
+    async def get_dynamics(
+        self,
+        phrase: str,
+        period: str,
+        from_date: str,
+        to_date: Optional[str] = None,
+        regions: Optional[List[int]] = None,
+        devices: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
+        json_data = _dynamics_payload(
+            phrase, period, from_date, to_date, regions, devices
+        )
+        return await self._cached_request(DYNAMICS_ENDPOINT, json_data)
+
+    @staticmethod
+    async def _result_or_error(request: Awaitable[Dict[str, Any]]) -> Dict[str, Any]:
+        # ошибка по одной фразе не должна ронять весь батч
+        try:
+            return await request
+        except Exception as e:
+            return {"ошибка": str(e)}
+
+    async def _iter_as_completed(
+        self,
+        phrases: Iterable[str],
+        make_request: Callable[[str], Awaitable[Dict[str, Any]]],
+    ) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        # в полете держу не больше 2*concurrency задач, поэтому память не растет с длиной списка
+        window = self.concurrency * 2
+        phrases_iter = iter(phrases)
+        pending: Dict[asyncio.Future, str] = {}
+
+        def start_next() -> bool:
+            phrase = next(phrases_iter, None)
+            if phrase is None:
+                return False
+            task = asyncio.ensure_future(self._result_or_error(make_request(phrase)))
+            pending[task] = phrase
+            return True
+
+        try:
+            while len(pending) < window and start_next():
+                pass
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    phrase = pending.pop(task)
+                    start_next()
+                    yield phrase, task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def aiter_requests(
+        self,
+        keys: Iterable[Any],
+        make_request: Callable[[Any], Awaitable[Dict[str, Any]]],
+    ) -> AsyncIterator[Tuple[Any, Dict[str, Any]]]:
+        # то же окно для произвольных ключей, например ячеек матрицы фраза × регион × устройство
+        return self._iter_as_completed(keys, make_request)
+
+    def aiter_top_requests(
+        self,
+        phrases: Iterable[str],
+        regions: Optional[List[int]] = None,
+        devices: Optional[List[str]] = None,
+    ) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        return self._iter_as_completed(
+            phrases,
+            lambda phrase: self.get_top_requests(phrase, regions=regions, devices=devices),
+        )
+
+    def aiter_dynamics(
+        self,
+        phrases: Iterable[str],
+        period: str,
+        from_date: str,
+        to_date: Optional[str] = None,
+        regions: Optional[List[int]] = None,
+        devices: Optional[List[str]] = None,
+    ) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        return self._iter_as_completed(
+            phrases,
+            lambda phrase: self.get_dynamics(
+                phrase=phrase,
+                period=period,
+                from_date=from_date,
+                to_date=to_date,
+                regions=regions,
+                devices=devices,
+            ),
+        )
+
+    async def get_top_requests_batch(
+        self,
+        phrases: List[str],
+        regions: Optional[List[int]] = None,
+        devices: Optional[List[str]] = None,
+    ) -> Dict[str, Dict[str, Any]]:
+        _check_batch_size(phrases)
+        logger.info("запрашиваю топы по %s фразам (параллельно до %s)", len(phrases), self.concurrency)
+        responses = await asyncio.gather(
+            *(
+                self._result_or_error(
+                    self.get_top_requests(phrase, regions=regions, devices=devices)
+                )
+                for phrase in phrases
+            )
+        )
+        return dict(zip(phrases, responses))
+
+    async def get_dynamics_batch(
+        self,
+        phrases: List[str],
+        period: str,
+        from_date: str,
+        to_date: Optional[str] = None,
+        regions: Optional[List[int]] = None,
+        devices: Optional[List[str]] = None,
+    ) -> Dict[str, Dict[str, Any]]:
+        _check_batch_size(phrases)
+        logger.info("запрашиваю динамику по %s фразам (параллельно до %s)", len(phrases), self.concurrency)
+        responses = await asyncio.gather(
+            *(
+                self._result_or_error(
+                    self.get_dynamics(
+                        phrase=phrase,
+                        period=period,
+                        from_date=from_date,
+                        to_date=to_date,
+                        regions=regions,
+                        devices=devices,
+                    )
+                )
+                for phrase in phrases
+            )
+        )
+        return dict(zip(phrases, responses))
+
+    def phrases_to_list(self, phrases_str: str) -> List[str]:
+        return self._sync.phrases_to_list(phrases_str)
+
+
 if __name__ == "__main__":
     config = dotenv_values(".env")
     TOKEN = config["YANDEX_WORDSTAT_TOKEN"]
     client = YandexWordstatConnector(token=TOKEN)
 
     valid_regions = client.get_regions()
-    logger.info(f"Первые 10 регионов{valid_regions[:10]}")
+    logger.info("Первые 10 регионов%s", valid_regions[:10])
 
     # пример использования
     raw_input = "купить телефон, пицца москва\nманикюр на дому"
     phrases = client.phrases_to_list(raw_input)
-    logger.info(f"Введенные фразы: {phrases}")
+    logger.info("Введенные фразы: %s", phrases)
 
     # пример запроса топов
     result1 = client.get_top_requests_batch(
         phrases=phrases, regions=[213], devices=["phone"]
     )
-    logger.info(f"Результат выполнения запросов топов: {result1}")
+    logger.info("Результат выполнения запросов топов: %s", result1)
 
     # пример запроса динамики
     result2 = client.get_dynamics_batch(
@@ -194,6 +778,6 @@ if __name__ == "__main__":
         regions=[2],
         devices=["desktop"],
     )
-    logger.info(f"Результат выполнения запросов динамики: {result2}")
+    logger.info("Результат выполнения запросов динамики: %s", result2)
 
     pass
\ No newline at end of file